@@ -0,0 +1,177 @@
+"""准入控制：按排队深度和近期查询耗时估算新请求的完成时间，无法在期限内完成的请求立即返回429和Retry-After，并限制同时处理的请求总数"""
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger('ServiceQueryAPI.Admission')
+
+# 是否启用准入控制
+ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', '1') == '1'
+# 同时处理的请求总数上限（0表示不限），超出时直接拒绝，避免线程和内存随请求数无限增长
+ADMISSION_MAX_CONCURRENT = int(os.getenv('ADMISSION_MAX_CONCURRENT', '64'))
+# 请求未指定期限时的默认期限（秒），可通过 X-Request-Timeout 请求头或 timeout 参数指定，最长 ADMISSION_MAX_DEADLINE
+ADMISSION_DEFAULT_DEADLINE = float(os.getenv('ADMISSION_DEFAULT_DEADLINE', '30'))
+ADMISSION_MAX_DEADLINE = float(os.getenv('ADMISSION_MAX_DEADLINE', '120'))
+# 查询耗时的指数加权平均系数，越大越偏向最近的耗时
+ADMISSION_EWMA_ALPHA = float(os.getenv('ADMISSION_EWMA_ALPHA', '0.2'))
+# Retry-After 的取值范围（秒）
+ADMISSION_MIN_RETRY_AFTER = 1
+ADMISSION_MAX_RETRY_AFTER = int(os.getenv('ADMISSION_MAX_RETRY_AFTER', '60'))
+
+
+class Overloaded(Exception):
+    """请求无法在期限内完成，应返回429"""
+    def __init__(self, message, retry_after=ADMISSION_MIN_RETRY_AFTER):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class BatchTooLarge(Exception):
+    """批量请求本身的查询耗时就超过期限（与排队无关），重试也无法完成，应返回400；max_units 为期限内最多可占用名额的次数"""
+    def __init__(self, message, max_units):
+        super().__init__(message)
+        self.max_units = max_units
+
+
+def retry_after_seconds(seconds):
+    """把预计需要等待的秒数转换为 Retry-After 的取值"""
+    return int(min(ADMISSION_MAX_RETRY_AFTER, max(ADMISSION_MIN_RETRY_AFTER, math.ceil(seconds))))
+
+
+def parse_deadline(value):
+    """把请求中的期限参数转换为秒数，无法识别时使用默认期限"""
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return ADMISSION_DEFAULT_DEADLINE
+    if seconds <= 0:
+        return ADMISSION_DEFAULT_DEADLINE
+    return min(seconds, ADMISSION_MAX_DEADLINE)
+
+
+class Ewma:
+    """指数加权移动平均"""
+    __slots__ = ('value', 'samples')
+
+    def __init__(self):
+        self.value = None
+        self.samples = 0
+
+    def update(self, sample):
+        self.value = sample if self.value is None else self.value + ADMISSION_EWMA_ALPHA * (sample - self.value)
+        self.samples += 1
+
+
+class AdmissionController:
+    """一个厂商的准入控制：记录每次占用查询名额的耗时，结合优先级通道的排队深度估算新请求的完成时间"""
+    def __init__(self, name, lanes):
+        self.name = name
+        self.lanes = lanes
+        self.lock = threading.Lock()
+        self.hold = Ewma()  # 所有通道每次占用名额的耗时，用于估算名额空出的速度
+        self.service = {lane: Ewma() for lane in lanes.weights}  # 各通道每次占用名额的耗时
+        self.admitted = 0
+        self.rejections = 0
+        self.too_large = 0
+        self.expired = 0
+
+    def record(self, lane, seconds):
+        """记录一次占用名额的耗时"""
+        with self.lock:
+            self.hold.update(seconds)
+            self.service[lane].update(seconds)
+
+    def estimate(self, lane, units=1):
+        """估算新请求的排队等待时间和总耗时（秒），units 为需要占用名额的次数；尚无耗时样本时均为0"""
+        with self.lock:
+            hold = self.hold.value
+            service = self.service[lane].value
+        if hold is None:
+            return 0.0, 0.0
+        wait = self.lanes.backlog(lane) * hold / self.lanes.slots
+        return wait, wait + units * (service if service is not None else hold)
+
+    def admit(self, lane, deadline, units=1):
+        """预计无法在 deadline 秒内完成时抛出异常，否则返回截止时刻（time.monotonic）；未启用时返回 None
+
+        排队等待超过期限时抛出 Overloaded（429，稍后重试可能成功）；批量请求（units > 1）排队不超期、
+        但查询本身需要的时间超过期限时抛出 BatchTooLarge，重试无济于事，应减少个数或改用异步任务。
+        """
+        if not ADMISSION_ENABLED:
+            return None
+        wait, total = self.estimate(lane, units)
+        if total > deadline and units > 1 and wait <= deadline:
+            per_unit = (total - wait) / units
+            max_units = int((deadline - wait) // per_unit) if per_unit > 0 else units
+            with self.lock:
+                self.too_large += 1
+            logger.warning(f"{self.name} {lane} 通道批量请求需要占用 {units} 次名额，预计 {total:.1f} 秒，"
+                           f"超过期限 {deadline:.1f} 秒，期限内最多 {max_units} 次")
+            raise BatchTooLarge(f"{self.name}批量查询预计需要 {total:.1f} 秒，超过期限 {deadline:.1f} 秒", max_units)
+        if total > deadline:
+            with self.lock:
+                self.rejections += 1
+            logger.warning(f"{self.name} {lane} 通道预计需要 {total:.1f} 秒（排队 {wait:.1f} 秒），超过期限 {deadline:.1f} 秒，拒绝请求")
+            # 批量请求只有排队部分会随负载下降而缩短
+            raise Overloaded(f"{self.name}查询繁忙，预计需要 {total:.1f} 秒，超过期限 {deadline:.1f} 秒",
+                             retry_after_seconds((wait if units > 1 else total) - deadline))
+        with self.lock:
+            self.admitted += 1
+        return time.monotonic() + deadline
+
+    def deadline_exceeded(self, lane):
+        """已准入的请求排队超过截止时刻时调用，返回应抛出的 Overloaded"""
+        with self.lock:
+            self.expired += 1
+        wait, _ = self.estimate(lane)
+        logger.warning(f"{self.name} {lane} 通道排队超过期限，放弃查询")
+        return Overloaded(f"{self.name}查询繁忙，排队超过期限", retry_after_seconds(wait))
+
+    def stats(self):
+        waits = {lane: round(self.estimate(lane)[0], 2) for lane in self.service}
+        with self.lock:
+            return {
+                "admitted": self.admitted,
+                "rejected": self.rejections,
+                "too_large": self.too_large,
+                "expired": self.expired,
+                "hold_ms": round(self.hold.value * 1000, 1) if self.hold.value is not None else None,
+                "service_ms": {lane: round(ewma.value * 1000, 1) if ewma.value is not None else None
+                               for lane, ewma in self.service.items()},
+                "estimated_wait_s": waits,
+            }
+
+
+class ConcurrencyLimiter:
+    """限制同时处理的请求总数"""
+    def __init__(self, limit=ADMISSION_MAX_CONCURRENT):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+        self.rejections = 0
+
+    def try_enter(self):
+        """占用一个处理名额，已满时返回 False"""
+        with self.lock:
+            if ADMISSION_ENABLED and self.limit > 0 and self.in_flight >= self.limit:
+                self.rejections += 1
+                return False
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "peak": self.peak,
+                "rejected": self.rejections,
+            }
@@ -1,69 +1,216 @@
-import requests
+"""批量查询设备维保信息：从文件或标准输入读取序列号，并发调用查询API，流式输出结果并支持断点续查"""
+import argparse
+import csv
 import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
 
-# 华为设备序列号列表
-sn_list = [
-    "",""
-]
+# 各厂商结果字段（与API返回的中文字段一致）
+VENDOR_FIELDS = {
+    "sangfor": ["序列号", "网关id", "设备型号", "服务商名称", "服务电话", "网络远程支持有效期", "同等功能软件升级有效期", "硬件维保有效期"],
+    "huawei": ["序列号", "设备型号", "服务套餐", "开始日期", "结束日期", "状态", "国家/地区", "保修区域", "描述"],
+    "lenovo": ["序列号"],
+}
+VENDORS = list(VENDOR_FIELDS)
 
-# API端点
-api_endpoint = "http://localhost:9876/sn_query/huawei"
 
-# 存储查询结果
-results = []
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="批量查询设备维保信息")
+    parser.add_argument("input", nargs="?", default="-",
+                        help="序列号文件，每行一个序列号或\"厂商,序列号\"；默认从标准输入读取")
+    parser.add_argument("--vendor", choices=VENDORS, default="huawei", help="未指定厂商的行使用的默认厂商")
+    parser.add_argument("--api", default="http://localhost:9876", help="查询API地址")
+    parser.add_argument("--concurrency", type=int, default=4, help="并发查询数")
+    parser.add_argument("--timeout", type=float, default=120, help="单次查询超时时间（秒）")
+    parser.add_argument("--format", choices=["jsonl", "csv", "md"], help="输出格式，默认根据输出文件扩展名推断，否则为jsonl")
+    parser.add_argument("--output", "-o", default="-", help="输出文件，默认输出到标准输出")
+    parser.add_argument("--checkpoint", help="断点文件，默认为\"<输出文件>.checkpoint\"；输出到标准输出时不记录断点")
+    return parser.parse_args(argv)
 
-print("开始批量查询华为设备维保信息...")
-print("=" * 80)
 
-for sn in sn_list:
-    print(f"查询序列号: {sn}")
-    
+def infer_format(args):
+    if args.format:
+        return args.format
+    ext = os.path.splitext(args.output)[1].lower()
+    return {".csv": "csv", ".md": "md", ".markdown": "md"}.get(ext, "jsonl")
+
+
+def read_serials(path, default_vendor):
+    """逐行读取序列号，返回 (厂商, 序列号) 生成器"""
+    stream = sys.stdin if path == "-" else open(path, encoding="utf-8-sig")
     try:
-        # 发送GET请求
-        response = requests.get(f"{api_endpoint}?sn={sn}", timeout=30)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if data.get("success") == 1:
-                if data.get("data"):
-                    # 每个序列号可能有多个维保记录
-                    for item in data["data"]:
-                        item["序列号"] = sn  # 确保序列号在结果中
-                        results.append(item)
-                    print(f"✓ 查询成功，找到 {len(data['data'])} 条记录")
-                else:
-                    print(f"✗ 查询成功，但未找到维保记录")
-                    # 添加空记录，确保所有序列号都在结果中
-                    results.append({"序列号": sn, "设备型号": "", "服务套餐": "", "开始日期": "", "结束日期": "", "状态": "", "国家/地区": "", "保修区域": "", "描述": "未找到维保记录"})
+        for line in stream:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            vendor, sep, serial_number = line.replace("\t", ",").partition(",")
+            if sep and vendor.strip().lower() in VENDOR_FIELDS:
+                yield vendor.strip().lower(), serial_number.strip()
             else:
-                print(f"✗ 查询失败: {data.get('message', '未知错误')}")
-                # 添加错误记录
-                results.append({"序列号": sn, "设备型号": "", "服务套餐": "", "开始日期": "", "结束日期": "", "状态": "", "国家/地区": "", "保修区域": "", "描述": f"查询失败: {data.get('message', '未知错误')}"})
-        else:
-            print(f"✗ 请求失败，状态码: {response.status_code}")
-            # 添加错误记录
-            results.append({"序列号": sn, "设备型号": "", "服务套餐": "", "开始日期": "", "结束日期": "", "状态": "", "国家/地区": "", "保修区域": "", "描述": f"请求失败，状态码: {response.status_code}"})
+                yield default_vendor, line
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def load_checkpoint(path):
+    """读取已完成的 (厂商, 序列号)"""
+    done = set()
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                vendor, _, serial_number = line.rstrip("\n").partition("\t")
+                if serial_number:
+                    done.add((vendor, serial_number))
+    return done
+
+
+def error_row(vendor, serial_number, message):
+    return {"厂商": vendor, "查询序列号": serial_number, "序列号": serial_number, "备注": message}
+
+
+def query_one(api, vendor, serial_number, timeout, local):
+    """查询单个序列号，返回 (结果行列表, 是否已得到最终结果)；网络异常和查询失败等可重试的结果不记入断点"""
+    if not hasattr(local, "session"):
+        local.session = requests.Session()
+    try:
+        response = local.session.get(f"{api}/sn_query/{vendor}", params={"sn": serial_number}, timeout=timeout)
+        if response.status_code != 200:
+            return [error_row(vendor, serial_number, f"请求失败，状态码: {response.status_code}")], False
+        data = response.json()
+        if data.get("success") != 1:
+            # 只有厂商明确答复没有记录才是最终结果；验证码、上游错误、登录失败等 failure 类型留到续查时重试
+            final = data.get("failure") == "not_found"
+            return [error_row(vendor, serial_number, f"查询失败: {data.get('message', '未知错误')}")], final
+        items = data.get("data") or []
+        if not isinstance(items, list) or not items:
+            return [error_row(vendor, serial_number, "未找到维保记录")], True
+        rows = []
+        for item in items:
+            row = {"厂商": vendor}
+            row.update(item)
+            row["序列号"] = row.get("序列号") or serial_number
+            row["查询序列号"] = serial_number
+            rows.append(row)
+        return rows, True
     except Exception as e:
-        print(f"✗ 发生异常: {str(e)}")
-        # 添加异常记录
-        results.append({"序列号": sn, "设备型号": "", "服务套餐": "", "开始日期": "", "结束日期": "", "状态": "", "国家/地区": "", "保修区域": "", "描述": f"发生异常: {str(e)}"})
-    
-    print("-" * 80)
+        return [error_row(vendor, serial_number, f"发生异常: {str(e)}")], False
+
+
+class ResultWriter:
+    """按指定格式逐条写出结果"""
+    def __init__(self, stream, fmt, columns, write_header):
+        self.stream = stream
+        self.fmt = fmt
+        self.columns = columns
+        self.csv_writer = None
+        if fmt == "csv":
+            self.csv_writer = csv.DictWriter(stream, fieldnames=columns, extrasaction="ignore")
+            if write_header:
+                self.csv_writer.writeheader()
+        elif fmt == "md" and write_header:
+            stream.write("| " + " | ".join(columns) + " |\n")
+            stream.write("|" + "|".join("------" for _ in columns) + "|\n")
+
+    def write(self, row):
+        if self.fmt == "jsonl":
+            self.stream.write(json.dumps(row, ensure_ascii=False) + "\n")
+        elif self.fmt == "csv":
+            self.csv_writer.writerow(row)
+        else:
+            cells = [str(row.get(col, "")).replace("|", "\\|").replace("\n", " ") for col in self.columns]
+            self.stream.write("| " + " | ".join(cells) + " |\n")
+        self.stream.flush()
+
 
-print("批量查询完成！")
-print("=" * 80)
+def columns_for(vendors):
+    columns = ["厂商", "查询序列号"]
+    for vendor in vendors:
+        for field in VENDOR_FIELDS[vendor]:
+            if field not in columns:
+                columns.append(field)
+    columns.append("备注")
+    return columns
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    fmt = infer_format(args)
+    to_stdout = args.output == "-"
+    checkpoint_path = args.checkpoint or (None if to_stdout else f"{args.output}.checkpoint")
+    # 只有断点文件和输出文件同时存在时才续查，否则重新开始
+    resuming = bool(checkpoint_path and os.path.exists(checkpoint_path)
+                    and (to_stdout or os.path.exists(args.output)))
+    done = load_checkpoint(checkpoint_path) if resuming else set()
+
+    # CSV/Markdown需要固定表头：文件输入时预先扫描涉及的厂商，标准输入无法预扫描则输出全部厂商字段
+    if args.input == "-":
+        vendors = VENDORS
+    else:
+        vendors = sorted({vendor for vendor, _ in read_serials(args.input, args.vendor)}, key=VENDORS.index)
+    columns = columns_for(vendors or [args.vendor])
+
+    out = sys.stdout if to_stdout else open(args.output, "a" if resuming else "w", encoding="utf-8", newline="")
+    checkpoint = open(checkpoint_path, "a" if resuming else "w", encoding="utf-8") if checkpoint_path else None
+    write_header = not resuming or (not to_stdout and os.path.getsize(args.output) == 0)
+    writer = ResultWriter(out, fmt, columns, write_header=write_header)
+    if done:
+        print(f"从断点恢复，已跳过 {len(done)} 个已完成的序列号", file=sys.stderr)
+
+    local = threading.local()
+    completed = failed = retryable = 0
+    pending = {}
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            def drain():
+                nonlocal completed, failed, retryable
+                finished, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    vendor, serial_number = pending.pop(future)
+                    rows, final = future.result()
+                    # 记录断点时只输出最终结果，可重试的失败留到续查时重新查询，避免同一序列号在输出中出现两次
+                    if final or not checkpoint:
+                        for row in rows:
+                            writer.write(row)
+                    else:
+                        retryable += 1
+                    if checkpoint and final:
+                        checkpoint.write(f"{vendor}\t{serial_number}\n")
+                        checkpoint.flush()
+                    completed += 1
+                    if rows[0].get("备注"):
+                        failed += 1
+                    print(f"[{completed}] {vendor} {serial_number}: {rows[0].get('备注') or f'找到 {len(rows)} 条记录'}",
+                          file=sys.stderr)
 
-# 生成Markdown表格
-print("\n## 华为设备维保信息查询结果\n")
-print("| 序列号 | 设备型号 | 服务套餐 | 开始日期 | 结束日期 | 状态 | 国家/地区 | 保修区域 | 描述 |")
-print("|--------|----------|----------|----------|----------|------|----------|----------|------|")
+            seen = set()
+            for vendor, serial_number in read_serials(args.input, args.vendor):
+                key = (vendor, serial_number)
+                if key in done or key in seen:
+                    continue
+                seen.add(key)
+                future = pool.submit(query_one, args.api, vendor, serial_number, args.timeout, local)
+                pending[future] = key
+                # 限制在途任务数量，保持内存占用恒定
+                if len(pending) >= args.concurrency * 2:
+                    drain()
+            while pending:
+                drain()
+    finally:
+        if checkpoint:
+            checkpoint.close()
+        if not to_stdout:
+            out.close()
 
-for item in results:
-    row = f"| {item.get('序列号', '')} | {item.get('设备型号', '')} | {item.get('服务套餐', '')} | {item.get('开始日期', '')} | {item.get('结束日期', '')} | {item.get('状态', '')} | {item.get('国家/地区', '')} | {item.get('保修区域', '')} | {item.get('描述', '')} |"
-    print(row)
+    print(f"批量查询完成！本次查询 {completed} 个序列号，失败 {failed} 个", file=sys.stderr)
+    if retryable:
+        print(f"其中 {retryable} 个为可重试的失败，未写入输出文件，重新执行同一命令即可重试", file=sys.stderr)
+    return 0
 
-# 保存结果到JSON文件
-with open('query_results.json', 'w', encoding='utf-8') as f:
-    json.dump(results, f, ensure_ascii=False, indent=2)
 
-print("\n查询结果已保存到 query_results.json 文件")
+if __name__ == "__main__":
+    sys.exit(main())
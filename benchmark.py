@@ -0,0 +1,352 @@
+"""离线性能基准测试：启动本地模拟上游服务器，以指定并发驱动真实的Flask应用并统计吞吐量与延迟分位数"""
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from mock_upstream import MockConfig, MockServer, MockRedisServer, MockProxyServer, start_mock_upstreams
+from upstream_cassette import arrivals, load_cassette
+
+
+def percentile(sorted_values, pct):
+    """最近秩法计算分位数"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies, failures, elapsed, batch_size=1):
+    """汇总单轮压测结果"""
+    ordered = sorted(latencies)
+    total = len(latencies) + failures
+    return {
+        "requests": total,
+        "serials_per_s": round(total * batch_size / elapsed, 2) if elapsed > 0 else 0.0,
+        "succeeded": len(latencies),
+        "failed": failures,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 1),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 1),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 1),
+        "max_ms": round(ordered[-1] * 1000, 1) if ordered else 0.0,
+    }
+
+
+def query_ok(session, base_url, vendor, item, timeout, batch_size=1):
+    """发起一次查询，batch_size 大于1时调用批量查询接口，返回是否全部成功"""
+    try:
+        if batch_size > 1:
+            response = session.post(f"{base_url}/sn_query/{vendor}/batch", json={"sn": item}, timeout=timeout)
+            data = response.json()
+            return response.status_code == 200 and data.get("success") == 1 and \
+                all(result.get("success") == 1 for result in data.get("data", []))
+        response = session.get(f"{base_url}/sn_query/{vendor}", params={"sn": item}, timeout=timeout)
+        return response.status_code == 200 and response.json().get("success") == 1
+    except Exception:
+        return False
+
+
+def run_load(base_url, vendor, serials, concurrency, timeout=120, batch_size=1):
+    """以给定并发向服务发起查询，batch_size 大于1时调用批量查询接口，返回汇总结果
+
+    base_url 为列表时（多节点），各压测线程轮流固定使用其中一个节点，模拟负载均衡。
+    """
+    base_urls = base_url if isinstance(base_url, list) else [base_url]
+    latencies = []
+    failures = 0
+    lock = threading.Lock()
+    local = threading.local()
+    threads = [0]
+
+    def one(item):
+        nonlocal failures
+        # 每个压测线程复用自己的连接，避免客户端建连开销干扰结果
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            with lock:
+                local.base_url = base_urls[threads[0] % len(base_urls)]
+                threads[0] += 1
+        start = time.perf_counter()
+        ok = query_ok(local.session, local.base_url, vendor, item, timeout, batch_size)
+        duration = time.perf_counter() - start
+        with lock:
+            if ok:
+                latencies.append(duration)
+            else:
+                failures += 1
+
+    items = serials if batch_size <= 1 else [serials[i:i + batch_size] for i in range(0, len(serials), batch_size)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, items))
+    return summarize(latencies, failures, time.perf_counter() - start, max(batch_size, 1))
+
+
+def run_arrivals(base_url, vendor, offsets, concurrency, timeout=120):
+    """按录制的到达时刻（秒）开环发起单个查询：不等待之前的请求返回，最多 concurrency 个同时进行
+
+    延迟从计划发起时刻算起，包含压测端排队等待的时间，避免服务变慢时压测端随之放慢而低估延迟。
+    """
+    base_urls = base_url if isinstance(base_url, list) else [base_url]
+    latencies = []
+    failures = 0
+    lock = threading.Lock()
+    local = threading.local()
+
+    def one(index, scheduled):
+        nonlocal failures
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        ok = query_ok(local.session, base_urls[index % len(base_urls)], vendor, f"REPLAY{index:06d}", timeout)
+        duration = time.perf_counter() - scheduled
+        with lock:
+            if ok:
+                latencies.append(duration)
+            else:
+                failures += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for index, offset in enumerate(offsets):
+            scheduled = start + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(one, index, scheduled)
+    return summarize(latencies, failures, time.perf_counter() - start)
+
+
+def start_bulk_load(base_url, vendor, threads, stop, batch_size=10, timeout=600):
+    """后台持续提交批量查询（bulk通道），模拟大批量同步任务，返回已完成的序列号计数和线程列表"""
+    base_urls = base_url if isinstance(base_url, list) else [base_url]
+    completed = [0]
+    lock = threading.Lock()
+
+    def loop(index):
+        session = requests.Session()
+        base_url = base_urls[index % len(base_urls)]
+        batch = 0
+        while not stop.is_set():
+            serials = [f"BULK{index:02d}{batch:04d}{i:02d}" for i in range(batch_size)]
+            batch += 1
+            try:
+                session.post(f"{base_url}/sn_query/{vendor}/batch", json={"sn": serials},
+                             headers={"X-Priority": "bulk"}, timeout=timeout)
+                with lock:
+                    completed[0] += batch_size
+            except Exception:
+                pass
+
+    workers = [threading.Thread(target=loop, args=(index,), daemon=True) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    return completed, workers
+
+
+class ClusterNode:
+    """以子进程运行的服务节点，与其他节点通过集群后端共享状态"""
+    def __init__(self, index, env):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        workdir = tempfile.mkdtemp(prefix=f"bench-node{index}-")
+        env = dict(os.environ, **env, PORT=str(port), CLUSTER_NODE_ID=f"bench-node-{index}",
+                   WARRANTY_DB_PATH=os.path.join(workdir, "warranty.db"))
+        # 每个节点在独立的工作目录中运行，日志和session文件互不干扰
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "service_query_api.py")],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def wait_ready(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"节点 {self.url} 启动失败，退出码 {self.process.returncode}")
+            try:
+                if requests.get(f"{self.url}/healthz", timeout=1).status_code == 200:
+                    return self
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"节点 {self.url} 启动超时")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="服务查询API离线性能基准测试")
+    parser.add_argument("--vendor", choices=["sangfor", "huawei", "all"], default="all", help="压测的厂商接口")
+    parser.add_argument("--requests", type=int, default=200, help="每个厂商的请求总数")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发请求数")
+    parser.add_argument("--warmup", type=int, default=5, help="正式计时前的预热请求数")
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟上游基础延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.02, help="模拟上游延迟抖动（秒）")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="模拟上游长尾请求比例")
+    parser.add_argument("--tail-latency", type=float, default=2.0, help="模拟上游长尾延迟（秒）")
+    parser.add_argument("--captcha-fail-rate", type=float, default=0.0, help="验证码被拒绝的概率")
+    parser.add_argument("--session-ttl", type=float, default=0, help="深信服session有效期（秒，0不过期）")
+    parser.add_argument("--session-max-queries", type=int, default=0, help="深信服单个session最多查询次数（0不限）")
+    parser.add_argument("--captcha-ttl", type=float, default=0, help="已验证验证码的有效期（秒，0不过期）")
+    parser.add_argument("--captcha-max-uses", type=int, default=0, help="已验证验证码最多可用于几次查询（0不限）")
+    parser.add_argument("--page-padding", type=int, default=0, help="深信服HTML页面额外填充的字符数，模拟真实页面大小")
+    parser.add_argument("--tail-queries-only", action="store_true", help="长尾延迟只出现在查询接口上")
+    parser.add_argument("--hedge", action="store_true", help="启用对冲请求（HEDGE_ENABLED=1）")
+    parser.add_argument("--pipeline", action="store_true", help="以分阶段流水线执行查询（PIPELINE_ENABLED=1）")
+    parser.add_argument("--upstream-concurrency", type=int, default=0, help="模拟上游同时处理的请求数上限，0表示不限")
+    parser.add_argument("--bulk-load", type=int, default=0, help="压测期间后台持续提交批量查询的线程数，观察交互查询延迟")
+    parser.add_argument("--nodes", type=int, default=0, help="以集群模式启动的服务节点数（子进程），0表示在压测进程内运行单个节点")
+    parser.add_argument("--batch-size", type=int, default=1, help="每个请求包含的序列号个数，大于1时使用批量查询接口")
+    parser.add_argument("--query-error-rate", type=float, default=0.0, help="模拟上游查询接口返回503的概率")
+    parser.add_argument("--per-ip-rate", type=float, default=0, help="模拟上游每个来源IP每秒允许的请求数，0表示不限")
+    parser.add_argument("--proxies", type=int, default=0, help="启动的本地模拟出口代理数，服务经出口代理池访问上游")
+    parser.add_argument("--banned-proxies", type=int, default=0, help="其中模拟被封禁（返回403）的代理数")
+    parser.add_argument("--ocr-latency", type=float, default=0.02, help="模拟OCR接口延迟（秒）")
+    parser.add_argument("--ocr-fail-rate", type=float, default=0.0, help="模拟OCR识别错误的概率")
+    parser.add_argument("--cassette", help="回放指定的cassette文件代替模拟上游服务器")
+    parser.add_argument("--replay-speed", choices=["realtime", "fast"], default="realtime", help="回放速度：按原始耗时或最快速度")
+    parser.add_argument("--replay-arrivals", action="store_true",
+                        help="回放时按cassette中录制的查询时刻开环发起请求，代替固定并发的闭环压测（忽略 --requests）")
+    parser.add_argument("--record", help="将压测期间的上游交互录制到指定cassette文件")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+    parser.add_argument("--log-level", default="WARNING", help="服务日志级别")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.replay_arrivals and not args.cassette:
+        print("--replay-arrivals 需要同时指定 --cassette", file=sys.stderr)
+        return 2
+    config = MockConfig(
+        latency=args.latency, jitter=args.jitter, tail_rate=args.tail_rate, tail_latency=args.tail_latency,
+        captcha_fail_rate=args.captcha_fail_rate, session_ttl=args.session_ttl,
+        session_max_queries=args.session_max_queries, captcha_ttl=args.captcha_ttl,
+        captcha_max_uses=args.captcha_max_uses, ocr_latency=args.ocr_latency,
+        ocr_fail_rate=args.ocr_fail_rate, page_padding=args.page_padding,
+        tail_queries_only=args.tail_queries_only, max_concurrency=args.upstream_concurrency,
+        per_ip_rate=args.per_ip_rate, query_error_rate=args.query_error_rate
+    )
+    if args.cassette:
+        mocks, env = [], {
+            "UPSTREAM_CASSETTE_MODE": "replay",
+            "UPSTREAM_CASSETTE": args.cassette,
+            "UPSTREAM_REPLAY_SPEED": args.replay_speed,
+        }
+    else:
+        mocks, env = start_mock_upstreams(config)
+        if args.record:
+            env.update({"UPSTREAM_CASSETTE_MODE": "record", "UPSTREAM_CASSETTE": args.record})
+    proxies = [MockProxyServer(banned=index < args.banned_proxies).start() for index in range(args.proxies)]
+    mocks.extend(proxies)
+    if proxies:
+        env["EGRESS_PROXIES"] = ",".join(proxy.url for proxy in proxies)
+    # 上游地址和录制/回放模式在服务模块导入时读取，必须先设置环境变量再导入
+    os.environ.update(env)
+    os.environ.setdefault("SANGFOR_USERNAME", "bench")
+    os.environ.setdefault("SANGFOR_PASSWORD", "bench")
+    # 压测需要每次都走完整的上游查询流程，不使用本地保存的结果
+    os.environ["WARRANTY_FRESH_SECONDS"] = "0"
+    if args.hedge:
+        os.environ["HEDGE_ENABLED"] = "1"
+    if args.pipeline:
+        os.environ["PIPELINE_ENABLED"] = "1"
+    # 在压测进程内运行的服务使用临时工作目录中的数据库和session文件，不覆盖当前目录下真实服务的session.json
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.environ.setdefault("WARRANTY_DB_PATH", os.path.join(workdir, "warranty.db"))
+    os.environ["SESSION_FILE"] = os.path.join(workdir, "session.json")
+    if args.nodes:
+        # 集群模式：各节点以子进程运行，共享本地的Redis协议替身
+        mocks.append(MockRedisServer().start())
+        nodes = [ClusterNode(index, {"CLUSTER_REDIS_URL": mocks[-1].url, "LOG_LEVEL": args.log_level.upper()})
+                 for index in range(args.nodes)]
+        for node in nodes:
+            node.wait_ready()
+        urls = [node.url for node in nodes]
+    else:
+        import service_query_api
+        logging.getLogger('ServiceQueryAPI').setLevel(args.log_level.upper())
+        logging.getLogger('werkzeug').setLevel(args.log_level.upper())
+        nodes = [MockServer(service_query_api.app).start()]
+        urls = nodes[0].url
+    vendors = ["sangfor", "huawei"] if args.vendor == "all" else [args.vendor]
+    report = {}
+    try:
+        for vendor in vendors:
+            if args.warmup:
+                run_load(urls, vendor, [f"WARM{i:04d}" for i in range(args.warmup * max(args.nodes, 1))],
+                         max(args.nodes, 1))
+            serials = [f"BENCH{i:06d}" for i in range(args.requests * max(args.batch_size, 1))]
+            stop_bulk = threading.Event()
+            bulk = start_bulk_load(urls, vendor, args.bulk_load, stop_bulk) if args.bulk_load else None
+            with config.counters_lock:
+                before = dict(config.counters)
+            proxies_before = [proxy.counters['requests'] for proxy in proxies]
+            if args.replay_arrivals:
+                report[vendor] = run_arrivals(urls, vendor, arrivals(load_cassette(args.cassette), vendor), args.concurrency)
+            else:
+                report[vendor] = run_load(urls, vendor, serials, args.concurrency, batch_size=args.batch_size)
+            stop_bulk.set()
+            if bulk is not None:
+                # 等待进行中的批量查询结束，避免影响下一个厂商的压测
+                for worker in bulk[1]:
+                    worker.join()
+                report[vendor]["bulk_serials"] = bulk[0][0]
+            with config.counters_lock:
+                report[vendor]["upstream_calls"] = {name: count - before.get(name, 0)
+                                                    for name, count in config.counters.items()}
+            if proxies:
+                report[vendor]["proxy_requests"] = {proxy.source: proxy.counters['requests'] - count
+                                                    for proxy, count in zip(proxies, proxies_before)}
+            if args.pipeline and not args.nodes:
+                report[vendor]["pipeline"] = service_query_api.get_pipeline(vendor).stats()
+    finally:
+        for node in nodes:
+            node.stop()
+        for mock in mocks:
+            mock.stop()
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        if args.cassette:
+            # 回放模式下上游响应来自cassette，模拟上游的延迟和验证码失败率设置不生效
+            load = "按录制时刻开环发起" if args.replay_arrivals else "固定并发闭环压测"
+            print(f"并发: {args.concurrency}  回放cassette: {args.cassette}  回放速度: {args.replay_speed}  请求发起: {load}")
+        else:
+            print(f"并发: {args.concurrency}  上游延迟: {args.latency}s  验证码失败率: {args.captcha_fail_rate}")
+        print("| 厂商 | 请求数 | 成功 | 失败 | 耗时(s) | 吞吐(req/s) | 序列号/s | p50(ms) | p95(ms) | p99(ms) | max(ms) | 上游调用 |")
+        print("|------|--------|------|------|---------|-------------|----------|---------|---------|---------|---------|----------|")
+        for vendor, stats in report.items():
+            calls = ", ".join(f"{name}={count}" for name, count in sorted(stats.get("upstream_calls", {}).items()))
+            print(f"| {vendor} | {stats['requests']} | {stats['succeeded']} | {stats['failed']} | {stats['elapsed_s']} | "
+                  f"{stats['throughput_rps']} | {stats['serials_per_s']} | {stats['p50_ms']} | {stats['p95_ms']} | "
+                  f"{stats['p99_ms']} | {stats['max_ms']} | {calls} |")
+        for vendor, stats in report.items():
+            if "proxy_requests" in stats:
+                print(f"{vendor} 各出口代理请求数: " + ", ".join(f"{name}={count}" for name, count in stats["proxy_requests"].items()))
+            if "pipeline" in stats:
+                stages = stats["pipeline"]["stages"]
+                print(f"{vendor} 流水线各阶段利用率（瓶颈: {stats['pipeline']['bottleneck']}）: " + ", ".join(
+                    f"{name}={stage['utilization']:.0%}/{stage['avg_service_ms']}ms" for name, stage in stages.items()))
+    return 0 if all(stats["failed"] == 0 for stats in report.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
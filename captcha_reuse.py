@@ -0,0 +1,141 @@
+"""验证码复用策略：记录已验证的验证码在被上游拒绝前能用多久、能用几次，批量查询时据此复用或主动重新识别"""
+import collections
+import os
+import threading
+import time
+
+# 人工指定的复用上限（0表示根据观测自动学习）
+CAPTCHA_REUSE_MAX_USES = int(os.getenv('CAPTCHA_REUSE_MAX_USES', '0'))
+CAPTCHA_REUSE_MAX_AGE = float(os.getenv('CAPTCHA_REUSE_MAX_AGE', '0'))
+# 学习到的有效期按该比例提前失效，避免在临界点上被拒绝
+SAFETY_FACTOR = 0.9
+# 取观测值的该分位数作为上限，个别原因无关的提前拒绝不会把上限压低
+LIMIT_PERCENTILE = 0.9
+# 每识别多少个验证码有一个不受学习到的上限约束、一直用到被拒绝为止，用来发现上游放宽的上限（0表示不试探）
+CAPTCHA_REUSE_PROBE_INTERVAL = int(os.getenv('CAPTCHA_REUSE_PROBE_INTERVAL', '10'))
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+
+class CaptchaTicket:
+    """一个已识别的验证码及其使用情况；probe 为 True 时不受学习到的上限约束"""
+    __slots__ = ('value', 'solved_at', 'uses', 'probe')
+
+    def __init__(self, value, probe=False):
+        self.value = value
+        self.solved_at = time.monotonic()
+        self.uses = 0
+        self.probe = probe
+
+    @property
+    def age(self):
+        return time.monotonic() - self.solved_at
+
+
+class CaptchaReuseTracker:
+    """按厂商统计验证码复用情况，并根据被拒绝时的使用次数和时长分别推断两个复用上限
+
+    被拒绝时的使用次数只作为次数上限的观测，时长只作为时长上限的观测；之后有验证码成功用到更多次数（更长时间），
+    说明该次拒绝与对应上限无关，从观测中剔除。
+    """
+    def __init__(self, name, max_uses=CAPTCHA_REUSE_MAX_USES, max_age=CAPTCHA_REUSE_MAX_AGE, window=20,
+                 probe_interval=CAPTCHA_REUSE_PROBE_INTERVAL):
+        self.name = name
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.probe_interval = probe_interval
+        self.lock = threading.Lock()
+        # 被拒绝时验证码已成功使用的次数和时长，只记录至少成功过一次的验证码
+        self.use_observations = collections.deque(maxlen=window)
+        self.age_observations = collections.deque(maxlen=window)
+        self.limits = (None, None)
+        self.solved = 0
+        self.queries = 0
+        self.rejections = 0
+        self.probes = 0
+        self.hedges = 0
+
+    def new_ticket(self, value):
+        with self.lock:
+            self.solved += 1
+            probe = self.probe_interval > 0 and self.solved % self.probe_interval == 0 and \
+                any(self.limits) and not (self.max_uses and self.max_age)
+            if probe:
+                self.probes += 1
+        return CaptchaTicket(value, probe)
+
+    def _learn(self):
+        """根据当前观测重新计算 (最大使用次数, 最大时长)，调用方持有锁"""
+        max_uses = _percentile(self.use_observations, LIMIT_PERCENTILE) if self.use_observations else None
+        max_age = _percentile(self.age_observations, LIMIT_PERCENTILE) * SAFETY_FACTOR if self.age_observations else None
+        self.limits = (max_uses, max_age)
+
+    def learned_limits(self):
+        """返回 (最大使用次数, 最大时长)，未知时为 None；手动指定的上限优先"""
+        with self.lock:
+            max_uses, max_age = self.limits
+        return self.max_uses or max_uses, self.max_age or max_age
+
+    def should_resolve(self, ticket):
+        """验证码是否已接近复用上限，需要在下一次查询前重新识别；试探用的验证码只受手动指定的上限约束"""
+        if ticket is None:
+            return True
+        if ticket.probe:
+            max_uses, max_age = self.max_uses, self.max_age
+        else:
+            max_uses, max_age = self.learned_limits()
+        if max_uses and ticket.uses >= max_uses:
+            return True
+        if max_age and ticket.age >= max_age:
+            return True
+        return False
+
+    def accepted(self, ticket):
+        ticket.uses += 1
+        uses, age = ticket.uses, ticket.age
+        with self.lock:
+            self.queries += 1
+            # 成功用到的次数和时长超过某些观测值，说明那些拒绝不是由对应上限造成的
+            changed = False
+            if self.use_observations and min(self.use_observations) < uses:
+                self.use_observations = collections.deque(
+                    (value for value in self.use_observations if value >= uses), maxlen=self.use_observations.maxlen)
+                changed = True
+            if self.age_observations and min(self.age_observations) < age:
+                self.age_observations = collections.deque(
+                    (value for value in self.age_observations if value >= age), maxlen=self.age_observations.maxlen)
+                changed = True
+            if changed:
+                self._learn()
+
+    def hedged(self, ticket):
+        """携带该验证码的请求发起了对冲，上游多消耗一次使用次数"""
+        ticket.uses += 1
+        with self.lock:
+            self.hedges += 1
+
+    def rejected(self, ticket):
+        with self.lock:
+            self.rejections += 1
+            # 第一次使用就被拒绝说明识别错误，与复用上限无关
+            if ticket.uses > 0:
+                self.use_observations.append(ticket.uses)
+                self.age_observations.append(ticket.age)
+                self._learn()
+
+    def stats(self):
+        max_uses, max_age = self.learned_limits()
+        with self.lock:
+            return {
+                "solved": self.solved,
+                "queries": self.queries,
+                "rejected": self.rejections,
+                "probes": self.probes,
+                "hedges": self.hedges,
+                "queries_per_captcha": round(self.queries / self.solved, 2) if self.solved else 0.0,
+                "max_uses": max_uses,
+                "max_age_s": round(max_age, 2) if max_age else None,
+            }
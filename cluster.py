@@ -0,0 +1,581 @@
+"""集群模式：多个节点通过Redis协议的后端共享查询结果缓存、深信服登录session（登录时持有分布式锁）和异步任务队列
+
+只使用少量Redis命令（GET/SET/INCR/EVAL/哈希/列表/BLMOVE），自带最小的RESP客户端，不依赖redis库，
+可以对接Redis、Valkey、KeyDB等兼容服务器，也可以对接 mock_upstream.MockRedisServer 做离线测试。
+"""
+import collections
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from urllib.parse import urlparse, unquote
+
+from requests.cookies import create_cookie
+
+from response_encoding import dumps, loads
+from job_queue import JOB_WORKERS, JOB_CHUNK_SIZE, JOB_RETENTION, JOB_MAX_WAIT, QUEUED, RUNNING, DONE, FAILED
+
+logger = logging.getLogger('ServiceQueryAPI.Cluster')
+
+# 集群后端地址，例如 redis://:password@10.0.0.5:6379/0；为空时不启用集群模式
+CLUSTER_REDIS_URL = os.getenv('CLUSTER_REDIS_URL', '')
+# 所有键的前缀，多套服务共用一个Redis时用于区分
+CLUSTER_KEY_PREFIX = os.getenv('CLUSTER_KEY_PREFIX', 'sqapi:')
+# 节点名称，默认为主机名；任务队列的处理中列表按 节点名称-进程号-随机后缀 区分，同一主机的多个工作进程互不干扰
+CLUSTER_NODE_ID = os.getenv('CLUSTER_NODE_ID', socket.gethostname())
+# 连接池大小与命令超时（秒）
+CLUSTER_POOL_SIZE = int(os.getenv('CLUSTER_POOL_SIZE', '32'))
+CLUSTER_TIMEOUT = float(os.getenv('CLUSTER_TIMEOUT', '5'))
+# 登录锁的有效期（秒），持锁节点异常退出后锁会自动过期
+CLUSTER_LOGIN_LOCK_TTL = float(os.getenv('CLUSTER_LOGIN_LOCK_TTL', '120'))
+# 同一序列号查询锁的有效期（秒），其他节点在此期间等待持锁节点的查询结果
+CLUSTER_QUERY_LOCK_TTL = float(os.getenv('CLUSTER_QUERY_LOCK_TTL', '60'))
+# 任务队列工作进程的心跳有效期（秒），进程停止心跳超过该时间后，其处理中的批次由其他进程放回队列
+CLUSTER_JOB_LEASE = float(os.getenv('CLUSTER_JOB_LEASE', '30'))
+
+# 只有持有者才能释放锁：值等于持有者令牌时才删除
+RELEASE_LOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+
+class RespError(Exception):
+    """服务器返回的错误"""
+
+
+# 后端不可用时可能抛出的异常：服务器错误、连接失败和超时
+BACKEND_ERRORS = (RespError, OSError)
+
+
+def encode_command(args):
+    """按RESP协议编码命令"""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        elif isinstance(arg, str):
+            data = arg.encode('utf-8')
+        else:
+            data = str(arg).encode('utf-8')
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+class RespConnection:
+    """一个到服务器的连接"""
+    def __init__(self, host, port, timeout):
+        self.timeout = timeout
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+
+    def _read(self):
+        line = self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("连接已断开")
+        prefix, body = line[:1], line[1:-2]
+        if prefix == b"+":
+            return body.decode('utf-8')
+        if prefix == b"-":
+            # 错误也要读完，连接才能继续使用
+            return RespError(body.decode('utf-8'))
+        if prefix == b":":
+            return int(body)
+        if prefix == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            return self.reader.read(length + 2)[:-2]
+        if prefix == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [self._read() for _ in range(length)]
+        raise ConnectionError(f"无法识别的响应: {line[:50]!r}")
+
+    def execute(self, args, timeout=None):
+        self.sock.settimeout(self.timeout if timeout is None else timeout)
+        self.sock.sendall(encode_command(args))
+        reply = self._read()
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RespClient:
+    """带连接池的最小RESP客户端，线程安全"""
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None,
+                 timeout=CLUSTER_TIMEOUT, pool_size=CLUSTER_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        """解析 redis://[:password@]host[:port][/db] 格式的地址"""
+        parsed = urlparse(url)
+        db = parsed.path.strip('/')
+        return cls(parsed.hostname or '127.0.0.1', parsed.port or 6379, int(db) if db else 0,
+                   unquote(parsed.password) if parsed.password else None, **kwargs)
+
+    def _connect(self):
+        conn = RespConnection(self.host, self.port, self.timeout)
+        try:
+            if self.password:
+                conn.execute(("AUTH", self.password))
+            if self.db:
+                conn.execute(("SELECT", self.db))
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def execute(self, *args, timeout=None):
+        """执行一条命令；timeout 用于阻塞命令，应大于命令自身的阻塞时间"""
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            reply = conn.execute(args, timeout)
+        except RespError:
+            self._release(conn)
+            raise
+        except Exception:
+            # 网络错误后连接状态未知，直接丢弃
+            conn.close()
+            raise
+        self._release(conn)
+        return reply
+
+    def _release(self, conn):
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _pairs(reply):
+    """把 HGETALL 的结果转换为字典"""
+    reply = reply or []
+    return {_text(reply[index]): _text(reply[index + 1]) for index in range(0, len(reply), 2)}
+
+
+def export_cookies(jar):
+    """把cookie jar转换为可JSON序列化的列表"""
+    return [{
+        "name": cookie.name,
+        "value": cookie.value,
+        "domain": cookie.domain,
+        "path": cookie.path,
+        "expires": cookie.expires,
+        "secure": cookie.secure,
+    } for cookie in jar]
+
+
+def import_cookies(jar, cookies):
+    """把 export_cookies 导出的列表写回cookie jar"""
+    for cookie in cookies:
+        jar.set_cookie(create_cookie(cookie["name"], cookie["value"], domain=cookie.get("domain", ""),
+                                     path=cookie.get("path", "/"), expires=cookie.get("expires"),
+                                     secure=cookie.get("secure", False)))
+
+
+class ClusterBackend:
+    """集群共享状态：查询结果缓存、分布式锁和同一序列号的跨节点去重"""
+    def __init__(self, url=CLUSTER_REDIS_URL, prefix=CLUSTER_KEY_PREFIX, node_id=CLUSTER_NODE_ID):
+        self.client = RespClient.from_url(url)
+        self.prefix = prefix
+        self.node_id = node_id
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def key(self, *parts):
+        return self.prefix + ':'.join(parts)
+
+    def execute(self, *args, timeout=None):
+        return self.client.execute(*args, timeout=timeout)
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def cached_result(self, vendor, serial_number):
+        """读取共享缓存中的查询结果，不存在时返回 None"""
+        raw = self.execute("GET", self.key('result', vendor, serial_number))
+        self._count('cache_hits' if raw is not None else 'cache_misses')
+        return loads(raw) if raw is not None else None
+
+    def cache_result(self, vendor, serial_number, payload, ttl):
+        """写入共享缓存，ttl 秒后过期"""
+        if ttl > 0:
+            self.execute("SET", self.key('result', vendor, serial_number), dumps(payload), "PX", int(ttl * 1000))
+
+    def try_lock(self, name, ttl):
+        """尝试获取锁，成功时返回持有者令牌，否则返回 None"""
+        token = uuid.uuid4().hex
+        if self.execute("SET", self.key('lock', name), token, "NX", "PX", int(ttl * 1000)) == "OK":
+            return token
+        return None
+
+    def unlock(self, name, token):
+        self.execute("EVAL", RELEASE_LOCK_SCRIPT, 1, self.key('lock', name), token)
+
+    def is_locked(self, name):
+        return self.execute("EXISTS", self.key('lock', name)) == 1
+
+    @contextmanager
+    def lock_wait(self, name, ttl, timeout):
+        """等待获取锁，最多等待 timeout 秒；返回是否获得了锁，未获得时调用方自行决定是否继续"""
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+        token = self.try_lock(name, ttl)
+        start = time.perf_counter()
+        while token is None and time.monotonic() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+            token = self.try_lock(name, ttl)
+        waited = time.perf_counter() - start
+        if waited > 0.01:
+            self._count('lock_waits')
+            logger.info(f"等待集群锁 {name} {waited:.2f} 秒")
+        try:
+            yield token is not None
+        finally:
+            if token is not None:
+                self.unlock(name, token)
+
+    def single_flight(self, name, compute, cached, ttl=CLUSTER_QUERY_LOCK_TTL):
+        """同一时间只有一个节点执行 compute()，其他节点等待并读取 cached() 的结果
+
+        持锁节点查询失败（没有写入缓存）或锁过期后，等待的节点自己执行 compute()。
+        后端不可用时不做跨节点去重，直接执行 compute()，查询不受影响。
+        """
+        try:
+            token = self.try_lock(name, ttl)
+        except BACKEND_ERRORS as e:
+            self._count('backend_errors')
+            logger.warning(f"集群后端不可用，直接查询 {name}: {str(e)}")
+            return compute()
+        if token is not None:
+            try:
+                return compute()
+            finally:
+                try:
+                    self.unlock(name, token)
+                except BACKEND_ERRORS as e:
+                    # 锁会在有效期后自动过期
+                    self._count('backend_errors')
+                    logger.warning(f"释放集群锁 {name} 失败: {str(e)}")
+        self._count('single_flight_waits')
+        deadline = time.monotonic() + ttl
+        delay = 0.05
+        while time.monotonic() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+            try:
+                result = cached()
+                if result is not None:
+                    self._count('single_flight_shared')
+                    return result
+                if not self.is_locked(name):
+                    break
+            except BACKEND_ERRORS as e:
+                self._count('backend_errors')
+                logger.warning(f"集群后端不可用，直接查询 {name}: {str(e)}")
+                break
+        return compute()
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+        return {
+            "node": self.node_id,
+            "backend": f"{self.client.host}:{self.client.port}/{self.client.db}",
+            "pooled_connections": self.client.pool.qsize(),
+            "counters": counters,
+        }
+
+
+class SharedSessionStore:
+    """共享的登录session：cookie以JSON保存并带递增的版本号，登录时持有分布式锁避免多个节点同时登录"""
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def load(self):
+        """返回 (版本号, cookie列表)，不存在时返回 (None, None)"""
+        raw = self.backend.execute("GET", self.backend.key('session', self.name))
+        if raw is None:
+            return None, None
+        data = loads(raw)
+        return data.get("version"), data.get("cookies")
+
+    def save(self, cookies):
+        """保存cookie，返回新的版本号"""
+        version = self.backend.execute("INCR", self.backend.key('session', self.name, 'version'))
+        self.backend.execute("SET", self.backend.key('session', self.name), dumps({
+            "version": version,
+            "cookies": cookies,
+            "saved_at": time.time(),
+            "node": self.backend.node_id,
+        }))
+        return version
+
+    def login_lock(self):
+        """登录锁，最多等待一次登录的时间"""
+        return self.backend.lock_wait(f'login:{self.name}', CLUSTER_LOGIN_LOCK_TTL, CLUSTER_LOGIN_LOCK_TTL)
+
+
+class ClusterJobQueue:
+    """共享任务队列：任务按批拆分后放入共享列表，任意节点的工作线程都可以领取执行，接口与 JobQueue 相同
+
+    领取的批次先移到本进程的处理中列表，执行完再删除。每个进程定期刷新自己的心跳键（有效期 CLUSTER_JOB_LEASE），
+    并登记在共享的进程表中；任意进程发现某个进程的心跳已过期（进程崩溃或所在节点宕机），就把它未完成的批次放回队列。
+    """
+    def __init__(self, backend, runner, workers=JOB_WORKERS):
+        self.backend = backend
+        self.runner = runner
+        self.workers = workers
+        self.threads = []
+        # 进程ID在创建队列时生成，gunicorn 等先加载应用再fork的部署中每个工作进程各自创建
+        self.owner = f"{backend.node_id}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.chunks_key = backend.key('jobs', 'chunks')
+        self.processing_key = self._processing_key(self.owner)
+        self.owners_key = backend.key('jobs', 'owners')
+        self.counts_key = backend.key('jobs', 'counts')
+
+    def _processing_key(self, owner):
+        return self.backend.key('jobs', 'processing', owner)
+
+    def _alive_key(self, owner):
+        return self.backend.key('jobs', 'alive', owner)
+
+    def _job_key(self, job_id, *parts):
+        return self.backend.key('job', job_id, *parts)
+
+    def submit(self, devices, options=None):
+        """提交任务，devices 为 (厂商, 序列号) 列表，返回任务ID"""
+        job_id = uuid.uuid4().hex
+        self.backend.execute(
+            "HSET", self._job_key(job_id), "status", QUEUED, "options", dumps(options or {}),
+            "total", len(devices), "completed", 0, "succeeded", 0, "created_at", time.time())
+        chunks = []
+        start = 0
+        while start < len(devices):
+            # 相邻的同厂商序列号合并为一批
+            vendor = devices[start][0]
+            end = start
+            while end < len(devices) and end - start < JOB_CHUNK_SIZE and devices[end][0] == vendor:
+                end += 1
+            chunks.append(dumps({"job": job_id, "vendor": vendor, "items": [
+                [index, devices[index][1]] for index in range(start, end)]}))
+            start = end
+        if chunks:
+            self.backend.execute("RPUSH", self.chunks_key, *chunks)
+        self.backend.execute("HINCRBY", self.counts_key, QUEUED, 1)
+        if not chunks:
+            self._finish(job_id, DONE)
+        logger.info(f"已提交集群任务 {job_id}，序列号个数: {len(devices)}，批次数: {len(chunks)}")
+        return job_id
+
+    def get(self, job_id, include_results=True):
+        """返回任务状态及已完成的结果，任务不存在时返回 None"""
+        fields = _pairs(self.backend.execute("HGETALL", self._job_key(job_id)))
+        if not fields:
+            return None
+        job = {
+            "id": job_id,
+            "status": fields.get("status"),
+            "total": int(fields.get("total", 0)),
+            "completed": int(fields.get("completed", 0)),
+            "succeeded": int(fields.get("succeeded", 0)),
+            "created_at": float(fields["created_at"]) if fields.get("created_at") else None,
+            "started_at": float(fields["started_at"]) if fields.get("started_at") else None,
+            "finished_at": float(fields["finished_at"]) if fields.get("finished_at") else None,
+        }
+        if fields.get("error"):
+            job["error"] = fields["error"]
+        if include_results:
+            results = _pairs(self.backend.execute("HGETALL", self._job_key(job_id, 'results')))
+            job["results"] = [loads(results[index]) for index in sorted(results, key=int)]
+        return job
+
+    def wait(self, job_id, timeout, since=None):
+        """长轮询：等待任务结束（或已完成数超过 since），最多等待 timeout 秒"""
+        deadline = time.monotonic() + min(timeout, JOB_MAX_WAIT)
+        delay = 0.05
+        while True:
+            job = self.get(job_id, include_results=False)
+            if job is None or job["status"] in (DONE, FAILED):
+                break
+            if since is not None and job["completed"] > since:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.5)
+        return self.get(job_id)
+
+    def _finish(self, job_id, status, error=None):
+        """任务结束，只有第一个写入结束时间的节点更新状态"""
+        key = self._job_key(job_id)
+        if self.backend.execute("HSETNX", key, "finished_at", time.time()) != 1:
+            return
+        previous = _text(self.backend.execute("HGET", key, "status"))
+        fields = ["status", status] + (["error", error] if error else [])
+        self.backend.execute("HSET", key, *fields)
+        self.backend.execute("HINCRBY", self.counts_key, previous, -1)
+        self.backend.execute("HINCRBY", self.counts_key, status, 1)
+        retention = max(1, int(JOB_RETENTION))
+        self.backend.execute("EXPIRE", key, retention)
+        self.backend.execute("EXPIRE", self._job_key(job_id, 'results'), retention)
+
+    def _run_chunk(self, chunk):
+        job_id = chunk["job"]
+        key = self._job_key(job_id)
+        fields = _pairs(self.backend.execute("HGETALL", key))
+        if not fields or fields.get("status") in (DONE, FAILED):
+            return
+        if self.backend.execute("HSETNX", key, "started_at", time.time()) == 1:
+            self.backend.execute("HSET", key, "status", RUNNING)
+            self.backend.execute("HINCRBY", self.counts_key, QUEUED, -1)
+            self.backend.execute("HINCRBY", self.counts_key, RUNNING, 1)
+        vendor = chunk["vendor"]
+        serial_numbers = [serial for _, serial in chunk["items"]]
+        try:
+            results = self.runner(vendor, serial_numbers, loads(fields.get("options") or "{}"))
+        except Exception as e:
+            logger.error(f"集群任务 {job_id} 执行异常: {str(e)}")
+            self._finish(job_id, FAILED, str(e))
+            return
+        by_serial = {result["sn"]: result for result in results}
+        mapping = []
+        succeeded = 0
+        for index, serial in chunk["items"]:
+            result = by_serial.get(serial) or {"sn": serial, "success": 0, "message": "服务查询失败"}
+            succeeded += result.get("success") == 1
+            mapping.extend([index, dumps(dict(vendor=vendor, **result))])
+        self.backend.execute("HSET", self._job_key(job_id, 'results'), *mapping)
+        self.backend.execute("HINCRBY", key, "succeeded", succeeded)
+        completed = self.backend.execute("HINCRBY", key, "completed", len(chunk["items"]))
+        if completed >= int(fields.get("total", 0)):
+            self._finish(job_id, DONE)
+            logger.info(f"集群任务 {job_id} 已完成")
+
+    def _worker(self):
+        while True:
+            try:
+                raw = self.backend.execute("BLMOVE", self.chunks_key, self.processing_key, "LEFT", "RIGHT", 1,
+                                           timeout=CLUSTER_TIMEOUT + 1)
+            except Exception as e:
+                logger.error(f"领取集群任务失败: {str(e)}")
+                time.sleep(1)
+                continue
+            if raw is None:
+                continue
+            try:
+                self._run_chunk(loads(raw))
+            except Exception as e:
+                logger.error(f"集群任务批次执行异常: {str(e)}")
+            finally:
+                try:
+                    self.backend.execute("LREM", self.processing_key, 1, raw)
+                except Exception as e:
+                    logger.error(f"移除已完成的集群任务批次失败: {str(e)}")
+
+    def purge(self):
+        """已结束的任务由后端按 JOB_RETENTION 自动过期，无需清理"""
+
+    def _beat(self):
+        """刷新本进程的心跳并登记到进程表（先写心跳，其他进程不会把刚登记的进程当作已退出）"""
+        self.backend.execute("SET", self._alive_key(self.owner), 1, "PX", int(CLUSTER_JOB_LEASE * 1000))
+        self.backend.execute("HSET", self.owners_key, self.owner, time.time())
+
+    def reclaim(self):
+        """把心跳已过期的进程处理中的批次放回队列，返回放回的批次数"""
+        recovered = 0
+        for owner in _pairs(self.backend.execute("HGETALL", self.owners_key)):
+            if owner == self.owner or self.backend.execute("EXISTS", self._alive_key(owner)) == 1:
+                continue
+            moved = 0
+            # LMOVE 逐个原子移动，多个进程同时回收时每个批次只会被放回一次
+            processing_key = self._processing_key(owner)
+            while self.backend.execute("LMOVE", processing_key, self.chunks_key, "RIGHT", "LEFT") is not None:
+                moved += 1
+            self.backend.execute("HDEL", self.owners_key, owner)
+            if moved:
+                logger.info(f"进程 {owner} 的心跳已过期，已把其未完成的 {moved} 个集群任务批次放回队列")
+            recovered += moved
+        return recovered
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(CLUSTER_JOB_LEASE / 3)
+            try:
+                self._beat()
+                self.reclaim()
+            except Exception as e:
+                logger.error(f"集群任务心跳失败: {str(e)}")
+
+    def start(self):
+        """登记本进程并启动工作线程和心跳线程，同时回收已退出进程未完成的批次"""
+        if self.threads:
+            return self
+        try:
+            self._beat()
+            self.reclaim()
+        except Exception as e:
+            logger.error(f"集群任务队列登记失败: {str(e)}")
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'cluster-job-worker-{index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name='cluster-job-heartbeat', daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        return self
+
+    def stats(self):
+        counts = _pairs(self.backend.execute("HGETALL", self.counts_key))
+        return {
+            "node": self.backend.node_id,
+            "owner": self.owner,
+            "workers": self.workers if self.threads else 0,
+            "backlog": self.backend.execute("LLEN", self.chunks_key),
+            "processing": self.backend.execute("LLEN", self.processing_key),
+            "jobs": {status: int(counts.get(status, 0)) for status in (QUEUED, RUNNING, DONE, FAILED)},
+        }
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_cluster():
+    """获取集群后端，未配置 CLUSTER_REDIS_URL 时返回 None"""
+    global _backend
+    if not CLUSTER_REDIS_URL:
+        return None
+    with _backend_lock:
+        if _backend is None:
+            _backend = ClusterBackend()
+            logger.info(f"集群模式已启用，节点 {_backend.node_id}，后端 {_backend.client.host}:{_backend.client.port}")
+        return _backend
@@ -0,0 +1,187 @@
+"""对冲请求：幂等的上游查询在超过自适应阈值（近期延迟的p90）仍未返回时，通过另一组连接再发一次，取先成功返回的结果，并用预算限制对冲比例"""
+import collections
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from http_transport import clone_session
+from profiling import current_profile, profiled
+
+logger = logging.getLogger('ServiceQueryAPI.Hedge')
+
+# 是否启用对冲请求
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', '0') == '1'
+# 对冲阈值取近期成功请求延迟的该百分位，且不低于最小延迟（秒）
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '90'))
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '0.2'))
+# 样本数不足时不对冲
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+# 每个请求积累的对冲额度，即对冲请求最多占总请求的比例；额度上限限制短时间内的对冲突发
+HEDGE_BUDGET_RATIO = float(os.getenv('HEDGE_BUDGET_RATIO', '0.05'))
+HEDGE_BUDGET_BURST = float(os.getenv('HEDGE_BUDGET_BURST', '5'))
+# 执行原请求和对冲请求的线程数，两者各用一个线程池，对冲请求不会排在原请求后面
+HEDGE_MAX_WORKERS = int(os.getenv('HEDGE_MAX_WORKERS', '64'))
+
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+def _get_executor(role):
+    """获取执行原请求（primary）或对冲请求（backup）的线程池"""
+    with _executor_lock:
+        if role not in _executors:
+            _executors[role] = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix=f'hedge-{role}')
+        return _executors[role]
+
+
+def succeeded(result):
+    """结果是否算作成功：HTTP响应要求2xx状态码，其他返回值都算成功"""
+    status = getattr(result, 'status_code', None)
+    return status is None or 200 <= status < 300
+
+
+class LatencyTracker:
+    """记录最近若干次请求的延迟，计算百分位"""
+    def __init__(self, window=200):
+        self.lock = threading.Lock()
+        self.samples = collections.deque(maxlen=window)
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p):
+        """样本不足 HEDGE_MIN_SAMPLES 时返回 None"""
+        with self.lock:
+            ordered = sorted(self.samples)
+        if len(ordered) < HEDGE_MIN_SAMPLES:
+            return None
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class Hedger:
+    """一个上游查询步骤的对冲器"""
+    def __init__(self, name):
+        self.name = name
+        self.latency = LatencyTracker()
+        self.lock = threading.Lock()
+        self.tokens = HEDGE_BUDGET_BURST
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+
+    def threshold(self):
+        """当前的对冲阈值（秒），样本不足时为 None"""
+        p = self.latency.percentile(HEDGE_PERCENTILE)
+        return None if p is None else max(HEDGE_MIN_DELAY, p)
+
+    def _timed(self, send):
+        start = time.perf_counter()
+        result = send()
+        # 快速返回的错误响应不计入延迟样本，以免拉低阈值
+        if succeeded(result):
+            self.latency.record(time.perf_counter() - start)
+        return result
+
+    def _earn(self):
+        with self.lock:
+            self.calls += 1
+            self.tokens = min(HEDGE_BUDGET_BURST, self.tokens + HEDGE_BUDGET_RATIO)
+
+    def _spend(self):
+        with self.lock:
+            if self.tokens < 1:
+                self.budget_denied += 1
+                return False
+            self.tokens -= 1
+            self.hedged += 1
+            return True
+
+    def call(self, send, backup_send, on_hedge=None):
+        """执行 send()，超过阈值未返回且预算允许时并行执行 backup_send()，返回先成功的结果
+
+        非2xx响应和异常都不算成功，两个请求都失败时返回先收到的失败响应，没有响应时抛出异常。
+        阈值从原请求实际开始执行时计时，线程池排队的时间不计入。
+        on_hedge 在发起对冲请求时调用，例如为携带验证码的请求多计一次验证码使用次数。
+        """
+        if not HEDGE_ENABLED:
+            return send()
+        self._earn()
+        threshold = self.threshold()
+        if threshold is None:
+            return self._timed(send)
+        # 在线程池中执行的请求也计入正在剖析的请求
+        profile = current_profile()
+        started = threading.Event()
+
+        def run_primary():
+            started.set()
+            return self._timed(send)
+
+        primary = _get_executor('primary').submit(profiled, profile, run_primary)
+        started.wait()
+        done, _ = wait([primary], timeout=threshold)
+        if done or not self._spend():
+            return primary.result()
+        logger.info(f"{self.name} 超过 {threshold:.2f} 秒未返回，发起对冲请求")
+        if on_hedge is not None:
+            on_hedge()
+        backup = _get_executor('backup').submit(profiled, profile, self._timed, backup_send)
+        pending = {primary, backup}
+        error = None
+        fallback = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if not succeeded(result):
+                    # 错误响应不算胜出，等另一个请求返回
+                    if fallback is None:
+                        fallback = result
+                    continue
+                if future is backup:
+                    with self.lock:
+                        self.hedge_wins += 1
+                return result
+        if fallback is not None:
+            return fallback
+        raise error
+
+    def request(self, session, method, url, on_hedge=None, **kwargs):
+        """发送可对冲的请求，返回先成功（2xx）的响应
+
+        原请求和对冲请求各用一个复制了cookie的session发出（原请求沿用原session的连接，对冲请求使用另一组连接），
+        只把胜出请求收到的cookie合并回原session；落后的请求返回后不再影响原session。
+        """
+        if not HEDGE_ENABLED:
+            return session.request(method, url, **kwargs)
+        sessions = {}
+
+        def send(pool):
+            clone = clone_session(session, pool)
+            response = clone.request(method, url, **kwargs)
+            sessions[id(response)] = clone
+            return response
+
+        response = self.call(lambda: send(None), lambda: send('hedge'), on_hedge)
+        session.cookies.update(sessions[id(response)].cookies)
+        return response
+
+    def stats(self):
+        threshold = self.threshold()
+        with self.lock:
+            return {
+                "threshold_s": round(threshold, 3) if threshold is not None else None,
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "budget_denied": self.budget_denied,
+                "budget_tokens": round(self.tokens, 2),
+            }
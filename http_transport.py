@@ -0,0 +1,359 @@
+"""统一的上游HTTP传输层：按主机复用连接池、TCP keep-alive、可选HTTP/2和DNS缓存，并统计连接复用情况"""
+import email.message
+import logging
+import os
+import socket
+import threading
+import time
+import weakref
+from io import BytesIO
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers, select_proxy
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+from upstream_cassette import install_adapters
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# httpx 的HTTP/2支持依赖 h2（pip install httpx[http2]）
+try:
+    import h2
+except ImportError:
+    h2 = None
+
+logger = logging.getLogger('ServiceQueryAPI.Transport')
+
+# 每个主机连接池的最大连接数，应不小于该主机上的并发请求数
+POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '32'))
+# 每个session缓存的主机连接池个数
+POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', '16'))
+# 连接池耗尽时是否阻塞等待，而不是临时新建连接
+POOL_BLOCK = os.getenv('HTTP_POOL_BLOCK', '0') == '1'
+# 是否启用HTTP/2多路复用（需要安装 httpx[http2]）
+HTTP2_ENABLED = os.getenv('HTTP2_ENABLED', '0') == '1'
+# DNS解析结果缓存时间（秒），0表示不缓存
+DNS_CACHE_TTL = float(os.getenv('DNS_CACHE_TTL', '300'))
+
+# 开启TCP keep-alive，避免空闲连接被中间设备静默断开
+SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+_stats_lock = threading.Lock()
+_host_stats = {}                                # 主机:端口 -> {"requests": 请求数, "new_connections": 新建连接数}
+_seen_connections = weakref.WeakKeyDictionary()  # 连接池 -> 上次统计时的已建连接数
+_adapters = weakref.WeakSet()                    # 存活的连接池适配器，用于统计当前占用情况
+_shared_sessions = {}
+_shared_lock = threading.Lock()
+# 经代理发出的请求结果回调：observer(代理地址, 耗时秒数, 状态码, 异常)
+_proxy_observer = None
+
+
+def _record(host, new_connections):
+    with _stats_lock:
+        stats = _host_stats.setdefault(host, {"requests": 0, "new_connections": 0})
+        stats["requests"] += 1
+        stats["new_connections"] += new_connections
+
+
+class _CachedDnsMixin:
+    """新建连接时通过 _dns_cache 解析主机名，只影响本模块适配器建立的连接，不修改全局的 socket.getaddrinfo"""
+    def _new_conn(self):
+        if _dns_cache is None:
+            return super()._new_conn()
+        host = self._dns_host
+        try:
+            addresses = _dns_cache.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)
+        except OSError:
+            # 解析失败时交给 urllib3 处理，保持原来的异常类型
+            return super()._new_conn()
+        error = None
+        # 依次尝试解析出的各个地址；TLS的SNI和证书校验仍使用原主机名
+        for address in dict.fromkeys(sockaddr[0] for _, _, _, _, sockaddr in addresses):
+            self._dns_host = address
+            try:
+                return super()._new_conn()
+            except NewConnectionError as e:
+                error = e
+            finally:
+                self._dns_host = host
+        raise error
+
+
+class _CachedDnsHTTPConnection(_CachedDnsMixin, HTTPConnection):
+    pass
+
+
+class _CachedDnsHTTPSConnection(_CachedDnsMixin, HTTPSConnection):
+    pass
+
+
+class _CachedDnsHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _CachedDnsHTTPConnection
+
+
+class _CachedDnsHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _CachedDnsHTTPSConnection
+
+
+POOL_CLASSES = {"http": _CachedDnsHTTPConnectionPool, "https": _CachedDnsHTTPSConnectionPool}
+
+
+class PooledAdapter(HTTPAdapter):
+    """按主机复用连接的适配器，记录请求数与新建连接数"""
+    def __init__(self, **kwargs):
+        kwargs.setdefault('pool_connections', POOL_CONNECTIONS)
+        kwargs.setdefault('pool_maxsize', POOL_MAXSIZE)
+        kwargs.setdefault('pool_block', POOL_BLOCK)
+        super().__init__(**kwargs)
+        _adapters.add(self)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault('socket_options', SOCKET_OPTIONS)
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = POOL_CLASSES
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        # SOCKS代理使用自己的连接类，只有HTTP代理（连接代理服务器本身）使用DNS缓存
+        if not proxy.lower().startswith('socks'):
+            manager.pool_classes_by_scheme = POOL_CLASSES
+        return manager
+
+    def send(self, request, **kwargs):
+        proxy = select_proxy(request.url, kwargs.get('proxies')) if _proxy_observer is not None else None
+        started = time.perf_counter()
+        try:
+            response = super().send(request, **kwargs)
+        except Exception as e:
+            if proxy:
+                _proxy_observer(proxy, time.perf_counter() - started, None, e)
+            raise
+        if proxy:
+            _proxy_observer(proxy, time.perf_counter() - started, response.status_code, None)
+        pool = getattr(response.raw, '_pool', None)
+        if pool is not None:
+            with _stats_lock:
+                previous = _seen_connections.get(pool, 0)
+                _seen_connections[pool] = pool.num_connections
+            _record(f"{pool.host}:{pool.port}", max(pool.num_connections - previous, 0))
+        return response
+
+
+class _OriginalResponse:
+    """为requests的cookie提取提供 _original_response.msg"""
+    def __init__(self, headers):
+        self.msg = email.message.Message()
+        for name, value in headers:
+            self.msg[name] = value
+
+
+class _RawBody(BytesIO):
+    def __init__(self, content, headers):
+        super().__init__(content)
+        self._original_response = _OriginalResponse(headers)
+
+
+class Http2Adapter(BaseAdapter):
+    """基于httpx的HTTP/2适配器，同一主机的并发请求在一条连接上多路复用
+
+    httpx 的证书校验和客户端证书只能在创建客户端时指定，因此按 (verify, cert) 各建一个客户端；
+    需要经代理发出的请求交给HTTP/1.1连接池适配器发送。
+    """
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.fallback = None
+        # 未安装 h2 时在这里抛出 ImportError，由 mount_adapters 回退到HTTP/1.1
+        self._client(True, None)
+
+    def _client(self, verify, cert):
+        key = (verify, tuple(cert) if isinstance(cert, (list, tuple)) else cert)
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                client = self.clients[key] = httpx.Client(
+                    http2=True,
+                    follow_redirects=False,
+                    verify=verify,
+                    cert=key[1],
+                    limits=httpx.Limits(max_connections=POOL_MAXSIZE, max_keepalive_connections=POOL_MAXSIZE)
+                )
+            return client
+
+    def _send_via_proxy(self, request, **kwargs):
+        with self.lock:
+            if self.fallback is None:
+                self.fallback = PooledAdapter()
+        return self.fallback.send(request, **kwargs)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if select_proxy(request.url, proxies):
+            return self._send_via_proxy(request, stream=stream, timeout=timeout, verify=verify, cert=cert,
+                                        proxies=proxies)
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        upstream = self._client(verify, cert).request(
+            request.method, request.url, headers=dict(request.headers),
+            content=request.body, timeout=timeout
+        )
+        _record(f"{upstream.url.host}:{upstream.url.port or 443}", 0)
+        # httpx已解压响应体，去掉压缩相关的头
+        headers = CaseInsensitiveDict((k, v) for k, v in upstream.headers.items()
+                                      if k.lower() not in ('content-encoding', 'transfer-encoding'))
+        response = Response()
+        response.status_code = upstream.status_code
+        response.reason = upstream.reason_phrase
+        response.headers = headers
+        response.raw = _RawBody(upstream.content, upstream.headers.multi_items())
+        response.url = request.url
+        response.request = request
+        response.encoding = get_encoding_from_headers(headers)
+        return response
+
+    def close(self):
+        with self.lock:
+            clients, self.clients = list(self.clients.values()), {}
+            fallback, self.fallback = self.fallback, None
+        for client in clients:
+            client.close()
+        if fallback is not None:
+            fallback.close()
+
+    def __reduce__(self):
+        return (Http2Adapter, ())
+
+
+class _DnsCache:
+    """带过期时间的 getaddrinfo 缓存，由本模块的连接类调用"""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.resolve = socket.getaddrinfo
+
+    def getaddrinfo(self, host, port, *args, **kwargs):
+        key = (host, port, args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+        result = self.resolve(host, port, *args, **kwargs)
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = (now + self.ttl, result)
+        return result
+
+
+_dns_cache = None
+
+
+def enable_dns_cache(ttl=DNS_CACHE_TTL):
+    """在进程内缓存DNS解析结果，只对本模块连接池适配器建立的连接生效，进程中的其他socket不受影响"""
+    global _dns_cache
+    with _shared_lock:
+        if _dns_cache is not None or ttl <= 0:
+            return
+        _dns_cache = _DnsCache(ttl)
+    logger.info(f"已启用DNS缓存，有效期 {ttl} 秒")
+
+
+def mount_adapters(session):
+    """为session挂载连接池（或HTTP/2）适配器，并按配置挂载流量录制/回放适配器"""
+    enable_dns_cache()
+    https_adapter = None
+    if HTTP2_ENABLED and httpx is not None and h2 is not None:
+        try:
+            https_adapter = Http2Adapter()
+        except ImportError as e:
+            logger.warning(f"无法启用HTTP/2（{str(e)}），使用HTTP/1.1连接池")
+    elif HTTP2_ENABLED:
+        logger.warning("未安装httpx[http2]（httpx和h2），无法启用HTTP/2，使用HTTP/1.1连接池")
+    session.mount("https://", https_adapter or PooledAdapter())
+    session.mount("http://", PooledAdapter())
+    return install_adapters(session, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+
+
+def set_proxy_observer(observer):
+    """设置经代理发出的请求结果回调，用于出口代理池统计和剔除"""
+    global _proxy_observer
+    _proxy_observer = observer
+
+
+def use_pooled_https(session):
+    """需要走代理的session直接改用连接池适配器（HTTP/2适配器也会把经代理的请求交给连接池适配器发送）"""
+    if isinstance(session.get_adapter("https://"), Http2Adapter):
+        session.mount("https://", PooledAdapter())
+    return session
+
+
+def create_session():
+    """创建访问上游的session"""
+    return mount_adapters(requests.Session())
+
+
+def shared_session(name):
+    """获取按名称共享的无状态session（如OCR接口），所有调用方复用同一组连接"""
+    with _shared_lock:
+        session = _shared_sessions.get(name)
+    if session is None:
+        session = create_session()
+        with _shared_lock:
+            session = _shared_sessions.setdefault(name, session)
+    return session
+
+
+def clone_session(session, pool='hedge'):
+    """复制session的cookie和请求头，但使用按名称共享的另一组连接，用于对冲请求；pool 为 None 时沿用原session的连接"""
+    clone = requests.Session()
+    clone.headers.update(session.headers)
+    clone.cookies.update(session.cookies)
+    # 对冲请求与原请求经同一个出口代理发出
+    clone.proxies.update(session.proxies)
+    clone.adapters = session.adapters if pool is None else shared_session(pool).adapters
+    return clone
+
+
+def pool_stats():
+    """返回各主机的连接复用率与当前连接池占用情况"""
+    with _stats_lock:
+        hosts = {host: dict(stats) for host, stats in _host_stats.items()}
+    for adapter in list(_adapters):
+        pools = getattr(adapter, 'poolmanager', None)
+        if pools is None:
+            continue
+        for key in list(pools.pools.keys()):
+            pool = pools.pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            stats = hosts.setdefault(f"{pool.host}:{pool.port}", {"requests": 0, "new_connections": 0})
+            idle_slots = pool.pool.qsize()
+            stats["pool_maxsize"] = stats.get("pool_maxsize", 0) + pool.pool.maxsize
+            stats["in_use"] = stats.get("in_use", 0) + pool.pool.maxsize - idle_slots
+            stats["idle_connections"] = stats.get("idle_connections", 0) + sum(
+                1 for conn in list(pool.pool.queue) if conn is not None)
+    for stats in hosts.values():
+        requests_count = stats["requests"]
+        stats["reuse_ratio"] = round(1 - stats["new_connections"] / requests_count, 4) if requests_count else 0.0
+        if stats.get("pool_maxsize"):
+            stats["utilization"] = round(stats["in_use"] / stats["pool_maxsize"], 4)
+    result = {
+        "pool_maxsize": POOL_MAXSIZE,
+        "http2": HTTP2_ENABLED and httpx is not None and h2 is not None,
+        "hosts": hosts,
+    }
+    if _dns_cache is not None:
+        result["dns_cache"] = {"hits": _dns_cache.hits, "misses": _dns_cache.misses, "ttl": _dns_cache.ttl}
+    return result
@@ -0,0 +1,126 @@
+"""批量导入设备清单：流式读取CSV/XLSX文件，规范化并去重序列号，只把唯一且没有最新结果的序列号交给查询，再把结果对应回原文件的每一行"""
+import codecs
+import csv
+import logging
+import os
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+from serial_numbers import canonical_serial, canonical_vendor
+
+logger = logging.getLogger('ServiceQueryAPI.Ingest')
+
+# 单个文件最多读取的数据行数
+INGEST_MAX_ROWS = int(os.getenv('INGEST_MAX_ROWS', '100000'))
+
+# 表头中表示序列号和厂商的列名（小写）
+SERIAL_HEADERS = ("sn", "serial", "serial number", "serial_number", "serialnumber", "序列号", "设备序列号",
+                  "barcode", "条码", "条形码")
+VENDOR_HEADERS = ("vendor", "厂商", "品牌", "brand", "manufacturer", "厂家")
+
+
+class IngestError(Exception):
+    """文件无法读取，应返回400"""
+
+
+def _find_column(header, names):
+    for index, cell in enumerate(header):
+        if str(cell or '').strip().lower() in names:
+            return index
+    return None
+
+
+def _csv_rows(stream, encoding):
+    try:
+        reader = csv.reader(codecs.getreader(encoding)(stream, errors='strict'))
+    except LookupError:
+        raise IngestError(f"不支持的编码: {encoding}")
+    try:
+        yield from reader
+    except UnicodeDecodeError:
+        raise IngestError(f"文件不是 {encoding} 编码，请通过 encoding 参数指定（如 gbk）")
+    except csv.Error as e:
+        raise IngestError(f"CSV格式错误: {str(e)}")
+
+
+def _xlsx_rows(stream):
+    if openpyxl is None:
+        raise IngestError("读取XLSX文件需要安装 openpyxl")
+    try:
+        # 只读模式逐行读取，不把整个工作表加载到内存
+        workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    except Exception as e:
+        raise IngestError(f"无法读取XLSX文件: {str(e)}")
+    try:
+        for row in workbook.active.iter_rows(values_only=True):
+            yield ["" if cell is None else str(cell) for cell in row]
+    finally:
+        workbook.close()
+
+
+def read_rows(stream, filename='', encoding='utf-8-sig'):
+    """逐行读取文件，返回 (行号, 厂商原值, 序列号原值) 生成器；有表头时按列名找序列号和厂商列，否则取第一列为序列号"""
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        rows = _xlsx_rows(stream)
+    else:
+        rows = _csv_rows(stream, encoding)
+    serial_column, vendor_column = 0, None
+    for number, row in enumerate(rows, 1):
+        if number == 1:
+            found = _find_column(row, SERIAL_HEADERS)
+            if found is not None:
+                serial_column, vendor_column = found, _find_column(row, VENDOR_HEADERS)
+                continue
+        if number > INGEST_MAX_ROWS + 1:
+            raise IngestError(f"文件最多 {INGEST_MAX_ROWS} 行")
+        if not any(str(cell).strip() for cell in row):
+            continue
+        serial = row[serial_column] if serial_column < len(row) else ""
+        vendor = row[vendor_column] if vendor_column is not None and vendor_column < len(row) else ""
+        yield number, vendor, serial
+
+
+class IngestPlan:
+    """导入计划：记录每一行对应的规范化设备，以及各厂商需要查询的唯一序列号"""
+    def __init__(self, supported_vendors, default_vendor=None):
+        self.supported_vendors = supported_vendors
+        self.default_vendor = default_vendor
+        self.rows = []  # {"row", "vendor", "input", "sn"} 或带 "error"
+        self.devices = {}  # (厂商, 规范化序列号) -> 首次出现的行号，保持出现顺序
+        self.duplicates = 0
+        self.invalid = 0
+
+    def add(self, number, vendor_value, serial_value):
+        row = {"row": number, "input": serial_value}
+        vendor = canonical_vendor(vendor_value, self.default_vendor)
+        serial = canonical_serial(vendor, serial_value) if vendor else ""
+        if vendor not in self.supported_vendors:
+            row["error"] = f"不支持的厂商: {vendor_value}" if vendor_value else "未指定厂商"
+        elif not serial:
+            row["error"] = "序列号为空"
+        if "error" in row:
+            self.invalid += 1
+            self.rows.append(row)
+            return
+        row.update(vendor=vendor, sn=serial)
+        first = self.devices.setdefault((vendor, serial), number)
+        if first != number:
+            row["duplicate_of"] = first
+            self.duplicates += 1
+        self.rows.append(row)
+
+    def read(self, stream, filename='', encoding='utf-8-sig'):
+        for number, vendor_value, serial_value in read_rows(stream, filename, encoding):
+            self.add(number, vendor_value, serial_value)
+        return self
+
+    def summary(self):
+        return {
+            "rows": len(self.rows),
+            "unique": len(self.devices),
+            "duplicates": self.duplicates,
+            "invalid": self.invalid,
+        }
@@ -0,0 +1,298 @@
+"""异步查询任务：任务与逐个序列号的结果持久化在SQLite中，由内部工作线程池执行，接口只负责提交和查询进度"""
+import logging
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from response_encoding import dumps, loads
+
+logger = logging.getLogger('ServiceQueryAPI.Jobs')
+
+# 任务数据库路径，默认与维保结果存储共用一个文件
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', os.getenv('WARRANTY_DB_PATH', 'warranty.db'))
+# 工作线程数
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+# 每次提交给厂商查询流程的序列号个数，完成一批即可查询到部分结果
+JOB_CHUNK_SIZE = int(os.getenv('JOB_CHUNK_SIZE', '5'))
+# 单个任务最多包含的序列号个数
+JOB_MAX_SIZE = int(os.getenv('JOB_MAX_SIZE', '5000'))
+# 已结束任务的保留时间（秒）
+JOB_RETENTION = float(os.getenv('JOB_RETENTION', str(7 * 86400)))
+# 长轮询最长等待时间（秒）
+JOB_MAX_WAIT = float(os.getenv('JOB_MAX_WAIT', '60'))
+# 任务租约时长（秒）：执行中的任务由领取它的进程定期续约，进程退出后租约过期，任务即可被其他进程接管
+JOB_LEASE = float(os.getenv('JOB_LEASE', '60'))
+# 空闲工作线程检查新任务、长轮询检查任务进度的间隔（秒），用于发现其他进程提交或更新的任务
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    options TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    succeeded INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT,
+    owner TEXT,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status);
+CREATE INDEX IF NOT EXISTS idx_jobs_finished_at ON jobs (finished_at);
+CREATE TABLE IF NOT EXISTS job_items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    vendor TEXT NOT NULL,
+    serial TEXT NOT NULL,
+    result TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+"""
+
+# 任务状态
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# 旧版本创建的表缺少的列
+MIGRATIONS = {
+    "owner": "ALTER TABLE jobs ADD COLUMN owner TEXT",
+    "lease_until": "ALTER TABLE jobs ADD COLUMN lease_until REAL",
+}
+
+
+class JobQueue:
+    """持久化任务队列：runner(vendor, serial_numbers, options) 返回与序列号一一对应的结果列表
+
+    多个进程（如 gunicorn 的多个worker）可以共用同一个数据库文件：工作线程通过一条 UPDATE ... RETURNING
+    原子地领取任务并写入自己的 owner 和租约，执行期间由心跳线程续约；进程退出后租约过期的任务由其他进程（或重启后的进程）接管。
+    """
+    def __init__(self, runner, path=JOB_DB_PATH, workers=JOB_WORKERS):
+        self.runner = runner
+        self.workers = workers
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lock = threading.Lock()
+        self.changed = threading.Condition()
+        self.pending = queue.Queue()
+        self.active = set()
+        self.threads = []
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        for column, sql in MIGRATIONS.items():
+            if column not in columns:
+                self.conn.execute(sql)
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def submit(self, devices, options=None):
+        """提交任务，devices 为 (厂商, 序列号) 列表，返回任务ID"""
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.execute(
+                "INSERT INTO jobs (id, status, options, total, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, QUEUED, dumps(options or {}).decode('utf-8'), len(devices), time.time()))
+            self.conn.executemany(
+                "INSERT INTO job_items (job_id, idx, vendor, serial) VALUES (?, ?, ?, ?)",
+                [(job_id, index, vendor, serial) for index, (vendor, serial) in enumerate(devices)])
+            self.conn.execute("COMMIT")
+        self.pending.put(job_id)
+        logger.info(f"已提交任务 {job_id}，序列号个数: {len(devices)}")
+        return job_id
+
+    def get(self, job_id, include_results=True):
+        """返回任务状态及已完成的结果，任务不存在时返回 None"""
+        rows = self._execute(
+            "SELECT status, total, completed, succeeded, created_at, started_at, finished_at, error "
+            "FROM jobs WHERE id = ?", (job_id,))
+        if not rows:
+            return None
+        status, total, completed, succeeded, created_at, started_at, finished_at, error = rows[0]
+        job = {
+            "id": job_id,
+            "status": status,
+            "total": total,
+            "completed": completed,
+            "succeeded": succeeded,
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+        }
+        if error:
+            job["error"] = error
+        if include_results:
+            items = self._execute(
+                "SELECT vendor, result FROM job_items WHERE job_id = ? AND result IS NOT NULL ORDER BY idx",
+                (job_id,))
+            job["results"] = [dict(vendor=vendor, **loads(result)) for vendor, result in items]
+        return job
+
+    def wait(self, job_id, timeout, since=None):
+        """长轮询：等待任务结束（或已完成数超过 since），最多等待 timeout 秒"""
+        deadline = time.monotonic() + min(timeout, JOB_MAX_WAIT)
+        while True:
+            job = self.get(job_id, include_results=False)
+            if job is None or job["status"] in (DONE, FAILED):
+                break
+            if since is not None and job["completed"] > since:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # 本进程执行的任务有进度时立即唤醒，其他进程执行的任务靠定期查询
+            with self.changed:
+                self.changed.wait(min(remaining, JOB_POLL_INTERVAL))
+        return self.get(job_id)
+
+    def _notify(self):
+        with self.changed:
+            self.changed.notify_all()
+
+    def _claim(self):
+        """原子地领取最早的待执行任务或租约已过期的执行中任务，返回 (任务ID, 选项)，没有可领取的任务时返回 None"""
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.conn.execute(
+                    "UPDATE jobs SET status = ?, owner = ?, lease_until = ?, started_at = COALESCE(started_at, ?) "
+                    "WHERE id = (SELECT id FROM jobs WHERE status = ? OR (status = ? AND COALESCE(lease_until, 0) < ?) "
+                    "ORDER BY created_at LIMIT 1) RETURNING id, options",
+                    (RUNNING, self.owner, now + JOB_LEASE, now, QUEUED, RUNNING, now)).fetchall()
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return rows[0] if rows else None
+
+    def _heartbeat(self):
+        """定期为本进程执行中的任务续约"""
+        while True:
+            time.sleep(JOB_LEASE / 3)
+            try:
+                self._execute("UPDATE jobs SET lease_until = ? WHERE owner = ? AND status = ?",
+                              (time.time() + JOB_LEASE, self.owner, RUNNING))
+            except Exception as e:
+                logger.error(f"任务续约失败: {str(e)}")
+
+    def _run_job(self, job_id, options):
+        self._notify()
+        # 接管的任务只执行尚未完成的序列号
+        items = self._execute(
+            "SELECT idx, vendor, serial FROM job_items WHERE job_id = ? AND result IS NULL ORDER BY idx", (job_id,))
+        try:
+            start = 0
+            while start < len(items):
+                # 相邻的同厂商序列号合并为一批
+                vendor = items[start][1]
+                end = start
+                while end < len(items) and end - start < JOB_CHUNK_SIZE and items[end][1] == vendor:
+                    end += 1
+                chunk = items[start:end]
+                results = self.runner(vendor, [serial for _, _, serial in chunk], options)
+                by_serial = {result["sn"]: result for result in results}
+                updates = []
+                succeeded = 0
+                for index, _, serial in chunk:
+                    result = by_serial.get(serial) or {"sn": serial, "success": 0, "message": "服务查询失败"}
+                    succeeded += result.get("success") == 1
+                    updates.append((dumps(result).decode('utf-8'), job_id, index))
+                with self.lock:
+                    self.conn.execute("BEGIN")
+                    # 租约已被其他进程接管（如本进程长时间停顿）时放弃写入，避免重复计数
+                    owned = self.conn.execute(
+                        "UPDATE jobs SET completed = completed + ?, succeeded = succeeded + ? "
+                        "WHERE id = ? AND owner = ? AND status = ?",
+                        (len(chunk), succeeded, job_id, self.owner, RUNNING)).rowcount
+                    if not owned:
+                        self.conn.execute("ROLLBACK")
+                        logger.warning(f"任务 {job_id} 已被其他进程接管，停止执行")
+                        return
+                    self.conn.executemany("UPDATE job_items SET result = ? WHERE job_id = ? AND idx = ?", updates)
+                    self.conn.execute("COMMIT")
+                self._notify()
+                start = end
+            self._execute("UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND owner = ?",
+                          (DONE, time.time(), job_id, self.owner))
+            logger.info(f"任务 {job_id} 已完成")
+        except Exception as e:
+            logger.error(f"任务 {job_id} 执行异常: {str(e)}")
+            self._execute("UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ? AND owner = ?",
+                          (FAILED, time.time(), str(e), job_id, self.owner))
+        self._notify()
+
+    def _worker(self):
+        while True:
+            try:
+                claimed = self._claim()
+            except Exception as e:
+                logger.error(f"领取任务异常: {str(e)}")
+                claimed = None
+            if claimed is None:
+                # 本进程提交任务时立即唤醒，其他进程提交的任务靠定期检查
+                try:
+                    self.pending.get(timeout=JOB_POLL_INTERVAL)
+                except queue.Empty:
+                    pass
+                continue
+            job_id, options = claimed
+            self.active.add(job_id)
+            try:
+                self._run_job(job_id, loads(options))
+                self.purge()
+            except Exception as e:
+                logger.error(f"任务 {job_id} 调度异常: {str(e)}")
+            finally:
+                self.active.discard(job_id)
+
+    def purge(self):
+        """删除超过保留时间的已结束任务"""
+        cutoff = time.time() - JOB_RETENTION
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.execute(
+                "DELETE FROM job_items WHERE job_id IN (SELECT id FROM jobs WHERE finished_at < ?)", (cutoff,))
+            removed = self.conn.execute("DELETE FROM jobs WHERE finished_at < ?", (cutoff,)).rowcount
+            self.conn.execute("COMMIT")
+        if removed:
+            logger.info(f"已清理过期任务 {removed} 个")
+
+    def start(self):
+        """启动工作线程和续约线程；待执行的任务和租约过期的未完成任务由空闲工作线程领取"""
+        if self.threads:
+            return self
+        self.purge()
+        (unfinished,), = self._execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING))
+        if unfinished:
+            logger.info(f"数据库中有 {unfinished} 个未完成的任务，租约过期后将被领取执行")
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'job-worker-{index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        return self
+
+    def stats(self):
+        counts = dict(self._execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+        return {
+            "owner": self.owner,
+            "workers": self.workers if self.threads else 0,
+            "backlog": counts.get(QUEUED, 0),
+            "active": len(self.active),
+            "jobs": {status: counts.get(status, 0) for status in (QUEUED, RUNNING, DONE, FAILED)},
+        }
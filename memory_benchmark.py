@@ -0,0 +1,105 @@
+"""记录存储基准测试：对比以 {中文字段: 值} 和紧凑格式保存设备维保记录时每条记录的存储字节数
+
+存储字节数对应本地数据库、本机共享缓存和集群结果缓存中实际保存的数据。服务本身不在进程内常驻保存全部记录
+（记录只在处理请求时短暂存在），附带的进程内内存对比是假设性的：只说明如果在进程内缓存大量记录，两种表示各占多少内存。
+"""
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+
+from mock_upstream import sangfor_record, huawei_record
+from response_encoding import dumps, loads
+from warranty_fields import SANGFOR_FIELD_MAP, HUAWEI_FIELD_MAP, translate_items
+from warranty_records import pack_items, load_items
+
+VENDOR_RECORDS = {
+    "sangfor": (sangfor_record, SANGFOR_FIELD_MAP),
+    "huawei": (huawei_record, HUAWEI_FIELD_MAP),
+}
+
+
+def stored_fleet(vendor, count):
+    """模拟缓存/存储层中保存的 count 台设备：每台设备一条记录，返回 [(序列号, 原格式JSON, 紧凑格式JSON)]"""
+    make_record, field_map = VENDOR_RECORDS[vendor]
+    fleet = []
+    for index in range(count):
+        serial_number = f"MEM{index:08d}"
+        items = translate_items([make_record(serial_number)], field_map)
+        fleet.append((serial_number, dumps(items), dumps(pack_items(vendor, items))))
+    return fleet
+
+
+def measure(load, fleet):
+    """假设性测量：逐台设备解析并在进程内保留全部记录，返回新增的内存字节数"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    cache = {serial_number: load(data) for serial_number, data in fleet}
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # cache 本身（序列号到记录的字典）两种方式相同，不计入
+    index_bytes = sys.getsizeof(cache)
+    del cache
+    return after - before - index_bytes
+
+
+def run(vendor, count):
+    fleet = stored_fleet(vendor, count)
+    dict_bytes = measure(loads, [(serial_number, data) for serial_number, data, _ in fleet])
+    record_bytes = measure(lambda data: load_items(vendor, loads(data)),
+                           [(serial_number, packed) for serial_number, _, packed in fleet])
+    json_bytes = sum(len(data) for _, data, _ in fleet)
+    packed_bytes = sum(len(packed) for _, _, packed in fleet)
+    return {
+        "records": count,
+        "storage": {
+            "json_bytes_per_record": round(json_bytes / count, 1),
+            "packed_json_bytes_per_record": round(packed_bytes / count, 1),
+            "saved": round(1 - packed_bytes / json_bytes, 3) if json_bytes else 0.0,
+        },
+        # 服务不在进程内常驻保存记录，以下仅为假设在进程内缓存全部记录时的对比
+        "hypothetical_in_memory": {
+            "dict_bytes_per_record": round(dict_bytes / count, 1),
+            "compact_bytes_per_record": round(record_bytes / count, 1),
+            "saved": round(1 - record_bytes / dict_bytes, 3) if dict_bytes else 0.0,
+        },
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="维保记录存储基准测试")
+    parser.add_argument("--vendor", choices=["sangfor", "huawei", "all"], default="all", help="测试的厂商记录格式")
+    parser.add_argument("--records", type=int, default=100000, help="每个厂商的设备数")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    vendors = ["sangfor", "huawei"] if args.vendor == "all" else [args.vendor]
+    report = {vendor: run(vendor, args.records) for vendor in vendors}
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return 0
+    print("存储字节数（本地数据库、共享缓存和集群缓存中保存的数据）：")
+    print("| 厂商 | 记录数 | 原JSON(B/条) | 紧凑JSON(B/条) | 存储节省 |")
+    print("|------|--------|--------------|----------------|----------|")
+    for vendor, stats in report.items():
+        storage = stats["storage"]
+        print(f"| {vendor} | {stats['records']} | {storage['json_bytes_per_record']} | "
+              f"{storage['packed_json_bytes_per_record']} | {storage['saved']:.0%} |")
+    print()
+    print("假设性对比：如果在进程内常驻保存全部记录（服务目前不这样做）每条记录占用的内存：")
+    print("| 厂商 | 记录数 | 字典(B/条) | 紧凑记录(B/条) | 内存节省 |")
+    print("|------|--------|------------|----------------|----------|")
+    for vendor, stats in report.items():
+        memory = stats["hypothetical_in_memory"]
+        print(f"| {vendor} | {stats['records']} | {memory['dict_bytes_per_record']} | "
+              f"{memory['compact_bytes_per_record']} | {memory['saved']:.0%} |")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,739 @@
+"""本地上游模拟服务器：模拟深信服BBS、华为维保查询和OCR识别接口，用于离线压测"""
+import base64
+import collections
+import hashlib
+import http.client
+import http.server
+import logging
+import random
+import socketserver
+import string
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+from flask import Flask, request, jsonify, make_response
+from werkzeug.serving import make_server
+
+logger = logging.getLogger('ServiceQueryAPI.MockUpstream')
+
+# 模拟验证码图片的前缀，模拟OCR接口据此"识别"出正确答案
+CAPTCHA_MAGIC = b"MOCKCAPTCHA:"
+
+LOGIN_REQUIRED_TEXT = "您必须先登录后才能进行相关操作"
+
+
+class MockConfig:
+    """模拟服务器行为配置"""
+    def __init__(self, latency=0.05, jitter=0.02, tail_rate=0.0, tail_latency=2.0,
+                 captcha_fail_rate=0.0, session_ttl=0, session_max_queries=0,
+                 captcha_ttl=0, captcha_max_uses=0, ocr_latency=0.02, ocr_fail_rate=0.0,
+                 page_padding=0, tail_queries_only=False, max_concurrency=0, per_ip_rate=0,
+                 query_error_rate=0.0):
+        self.latency = latency                          # 每个请求的基础延迟（秒）
+        self.jitter = jitter                            # 延迟抖动（秒）
+        self.tail_rate = tail_rate                      # 出现长尾延迟的概率
+        self.tail_latency = tail_latency                # 长尾延迟（秒）
+        self.captcha_fail_rate = captcha_fail_rate      # 验证码正确时仍被拒绝的概率
+        self.session_ttl = session_ttl                  # 登录session有效期（秒，0表示不过期）
+        self.session_max_queries = session_max_queries  # 单个session最多可查询次数（0表示不限）
+        self.captcha_ttl = captcha_ttl                  # 已验证验证码的有效期（秒，0表示不过期）
+        self.captcha_max_uses = captcha_max_uses        # 已验证验证码最多可用于几次查询（0表示不限）
+        self.ocr_latency = ocr_latency                  # OCR接口延迟（秒）
+        self.ocr_fail_rate = ocr_fail_rate              # OCR识别错误的概率
+        self.page_padding = page_padding                # 深信服HTML页面在特征文本之后追加的字符数，模拟真实页面大小
+        self.tail_queries_only = tail_queries_only      # 长尾延迟只出现在查询接口上
+        self.query_error_rate = query_error_rate        # 查询接口返回503的概率，模拟上游临时故障
+        # 上游同时处理的请求数上限（0表示不限），超出的请求排队等待，模拟容量有限的厂商服务器
+        self.capacity = threading.Semaphore(max_concurrency) if max_concurrency > 0 else None
+        # 每个来源IP每秒允许的请求数（0表示不限），超出时返回429，模拟厂商按IP限流
+        self.per_ip_rate = per_ip_rate
+        self.buckets = {}  # 来源 -> [剩余令牌, 上次补充时间]
+        self.counters = collections.Counter()           # 各类上游调用次数统计
+        self.counters_lock = threading.Lock()
+
+    def count(self, name):
+        with self.counters_lock:
+            self.counters[name] += 1
+
+    def rate_limited(self, source):
+        """按来源令牌桶限流，超出限额时返回 True"""
+        if self.per_ip_rate <= 0:
+            return False
+        now = time.monotonic()
+        with self.counters_lock:
+            tokens, last = self.buckets.get(source, (self.per_ip_rate, now))
+            tokens = min(self.per_ip_rate, tokens + (now - last) * self.per_ip_rate)
+            limited = tokens < 1
+            self.buckets[source] = (tokens if limited else tokens - 1, now)
+            if limited:
+                self.counters['rate_limited'] += 1
+        return limited
+
+    def query_error(self):
+        """按配置的概率模拟查询接口临时故障"""
+        if self.query_error_rate and random.random() < self.query_error_rate:
+            self.count('query_errors')
+            return True
+        return False
+
+    def delay(self, is_query=False):
+        """按配置模拟上游延迟"""
+        if self.capacity is not None:
+            with self.capacity:
+                self._sleep(is_query)
+        else:
+            self._sleep(is_query)
+
+    def _sleep(self, is_query):
+        if (is_query or not self.tail_queries_only) and random.random() < self.tail_rate:
+            time.sleep(self.tail_latency)
+            return
+        wait_time = self.latency + random.uniform(-self.jitter, self.jitter)
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+def _random_code(length=4):
+    return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(length))
+
+
+def _captcha_expired(config, state):
+    """已验证的验证码是否超过有效期或使用次数上限"""
+    if config.captcha_ttl and time.time() - state["validated_at"] > config.captcha_ttl:
+        return True
+    return bool(config.captcha_max_uses and state["uses"] >= config.captcha_max_uses)
+
+
+def _captcha_image(code):
+    """生成模拟验证码图片，正文中嵌入答案"""
+    return CAPTCHA_MAGIC + code.encode('ascii') + b":" + uuid.uuid4().bytes
+
+
+def _fake_digest(serial_number):
+    return hashlib.md5(serial_number.encode('utf-8')).hexdigest()
+
+
+def sangfor_record(serial_number):
+    """根据序列号生成确定性的深信服维保记录"""
+    digest = _fake_digest(serial_number)
+    year = 2024 + int(digest[0], 16) % 4
+    month = 1 + int(digest[1], 16) % 12
+    day = 1 + int(digest[2], 16) % 28
+    expiry = f"{year}-{month:02d}-{day:02d}"
+    return {
+        "rnum": f"WAZ{digest[:7].upper()}",
+        "rid": serial_number,
+        "pdName": "AC-1000-B1300",
+        "cti_channame": "模拟服务商有限公司",
+        "cit_chanphone": "021-00000000",
+        "cti_day2_800": expiry,
+        "cti_day2_up": expiry,
+        "cit_day2_rb": expiry
+    }
+
+
+def huawei_record(serial_number):
+    """根据序列号生成确定性的华为维保记录"""
+    digest = _fake_digest(serial_number)
+    year = 2023 + int(digest[0], 16) % 4
+    month = 1 + int(digest[1], 16) % 12
+    day = 1 + int(digest[2], 16) % 28
+    return {
+        "barcode": serial_number,
+        "snModel": "S5731S-H24T4XC-A",
+        "servicePackage": "15天更换保修",
+        "startDate": f"{year}/{month:02d}/{day:02d}",
+        "endDate": f"{year + 1}/{month:02d}/{day:02d}",
+        "vyborgStutas": "Active" if year + 1 >= 2026 else "Terminated",
+        "country": "China",
+        "warrantyArea": "中国",
+        "itemDescription": "模拟设备描述"
+    }
+
+
+def _page(config, body):
+    """构造深信服HTML页面，特征文本在前，之后按配置填充内容"""
+    return f"<html>{body}<!--{'x' * config.page_padding}--></html>"
+
+
+def _request_source():
+    # 经模拟代理转发的请求以代理标识作为来源IP
+    return request.headers.get('X-Forwarded-For') or request.remote_addr
+
+
+def create_sangfor_app(config):
+    """创建模拟深信服BBS的Flask应用"""
+    mock = Flask('mock_sangfor')
+    lock = threading.Lock()
+    sessions = {}   # auth -> {"created": 时间, "queries": 次数}
+    seccodes = {}   # (saltkey, idhash) -> {"code": 验证码, "validated_at": 时间, "uses": 次数}
+
+    def current_session():
+        auth = request.cookies.get('auth')
+        with lock:
+            state = sessions.get(auth)
+            if not state:
+                return None
+            expired = (config.session_ttl and time.time() - state["created"] > config.session_ttl) or \
+                (config.session_max_queries and state["queries"] >= config.session_max_queries)
+            if expired:
+                sessions.pop(auth, None)
+                return None
+            return state
+
+    @mock.before_request
+    def simulate_latency():
+        if config.rate_limited(_request_source()):
+            return make_response("请求过于频繁，请稍后再试", 429)
+        config.delay(request.args.get('op') == 'doquery')
+
+    @mock.route('/')
+    def home():
+        response = make_response("<html><title>深信服技术社区</title></html>")
+        if not request.cookies.get('saltkey'):
+            response.set_cookie('saltkey', uuid.uuid4().hex[:8])
+        return response
+
+    @mock.route('/member.php', methods=['GET', 'POST'])
+    def member():
+        if request.args.get('loginsubmit') == 'yes':
+            if not request.form.get('username') or not request.form.get('password'):
+                return "<root><![CDATA[登录失败]]></root>"
+            config.count('logins')
+            auth = uuid.uuid4().hex
+            with lock:
+                sessions[auth] = {"created": time.time(), "queries": 0}
+            response = make_response("<root><![CDATA[欢迎您回来]]></root>")
+            response.set_cookie('auth', auth)
+            return response
+        loginhash = _random_code(5)
+        return _page(config, f'<form method="post" id="loginform" '
+                             f'action="member.php?mod=logging&action=login&loginsubmit=yes&loginhash={loginhash}">'
+                             f'</form>')
+
+    @mock.route('/home.php')
+    def space():
+        if current_session():
+            return _page(config, "个人中心 欢迎您 退出")
+        return _page(config, LOGIN_REQUIRED_TEXT)
+
+    @mock.route('/misc.php')
+    def seccode():
+        saltkey = request.cookies.get('saltkey', '')
+        if request.args.get('action') == 'update':
+            idhash = 'S' + uuid.uuid4().hex[:7]
+            with lock:
+                seccodes[(saltkey, idhash)] = {"code": _random_code(), "validated_at": time.time(), "uses": 0}
+            return (f'<span id="seccode_{idhash}"><img onclick="updateseccode(\'{idhash}\')" '
+                    f'src="misc.php?mod=seccode&update={random.randint(10000, 99999)}&idhash={idhash}" /></span>')
+        idhash = request.args.get('idhash', '')
+        code = _random_code()
+        config.count('captcha_images')
+        with lock:
+            seccodes[(saltkey, idhash)] = {"code": code, "validated_at": time.time(), "uses": 0}
+        response = make_response(_captcha_image(code))
+        response.headers['Content-Type'] = 'image/png'
+        return response
+
+    @mock.route('/plugin.php', methods=['GET', 'POST'])
+    def service_query():
+        state = current_session()
+        if request.args.get('op') != 'doquery':
+            if state:
+                return _page(config, "服务查询 请输入设备序列号进行查询")
+            return _page(config, LOGIN_REQUIRED_TEXT)
+        if not state:
+            return jsonify({"success": 0, "message": LOGIN_REQUIRED_TEXT})
+        if config.query_error():
+            return make_response("Service Unavailable", 503)
+        saltkey = request.cookies.get('saltkey', '')
+        answer = (request.args.get('seccodeverify') or '').upper()
+        config.count('queries')
+        with lock:
+            seccode_state = seccodes.get((saltkey, request.args.get('seccodehash', '')))
+            state["queries"] += 1
+            accepted = bool(seccode_state and answer == seccode_state["code"]
+                            and not _captcha_expired(config, seccode_state))
+            if accepted and seccode_state["uses"] == 0 and random.random() < config.captcha_fail_rate:
+                accepted = False
+            if accepted:
+                seccode_state["uses"] += 1
+        if not accepted:
+            return jsonify({"success": -2, "message": "验证码错误"})
+        serial_number = request.args.get('svrid', '')
+        return jsonify({"success": 1, "data": [sangfor_record(serial_number)]})
+
+    return mock
+
+
+def create_huawei_app(config):
+    """创建模拟华为维保查询的Flask应用"""
+    mock = Flask('mock_huawei')
+    lock = threading.Lock()
+    states = {}  # hwsid -> {"code": 验证码, "validated_at": 时间, "uses": 次数}
+
+    def session_id():
+        return request.cookies.get('hwsid') or ''
+
+    @mock.before_request
+    def simulate_latency():
+        if config.rate_limited(_request_source()):
+            return make_response(jsonify({"errorCode": "429", "errorMsg": "请求过于频繁"}), 429)
+        config.delay(request.path.endswith('/findHardWareVyborgForWeb'))
+
+    @mock.route('/enterprise/ecareWechat')
+    def entry():
+        response = make_response("<html>华为企业业务服务</html>")
+        if not request.cookies.get('hwsid'):
+            response.set_cookie('hwsid', uuid.uuid4().hex)
+        return response
+
+    @mock.route('/escpportal/servlet/captcha')
+    def captcha():
+        code = _random_code()
+        sid = session_id()
+        config.count('captcha_images')
+        with lock:
+            states[sid] = {"code": code, "validated_at": None, "uses": 0}
+        response = make_response(_captcha_image(code))
+        response.headers['Content-Type'] = 'image/jpeg'
+        return response
+
+    @mock.route('/escpportal/servlet/captchaValidate', methods=['POST'])
+    def captcha_validate():
+        answer = (request.form.get('paramCode') or '').upper()
+        with lock:
+            state = states.get(session_id())
+            if not state or answer != state["code"] or random.random() < config.captcha_fail_rate:
+                return "no"
+            state["validated_at"] = time.time()
+            state["uses"] = 0
+        return "yes"
+
+    @mock.route('/escpportal/services/portal/vyborgTask/findHardWareVyborgForWeb')
+    def find_warranty():
+        if config.query_error():
+            return make_response("Service Unavailable", 503)
+        answer = (request.args.get('paramCode') or '').upper()
+        config.count('queries')
+        with lock:
+            state = states.get(session_id())
+            accepted = bool(state and state["validated_at"] and answer == state["code"]
+                            and not _captcha_expired(config, state))
+            if accepted:
+                state["uses"] += 1
+        if not accepted:
+            return jsonify({"success": False, "message": "paramCode invalid"})
+        return jsonify([huawei_record(request.args.get('barcode', ''))])
+
+    return mock
+
+
+def create_ocr_app(config):
+    """创建模拟OCR识别接口(/reg)的Flask应用"""
+    mock = Flask('mock_ocr')
+
+    @mock.route('/reg', methods=['POST'])
+    def reg():
+        config.count('ocr_calls')
+        if config.ocr_latency > 0:
+            time.sleep(config.ocr_latency)
+        try:
+            img_bytes = base64.b64decode(request.get_data(as_text=True))
+        except Exception:
+            return "Error", 500
+        if img_bytes.startswith(CAPTCHA_MAGIC) and random.random() >= config.ocr_fail_rate:
+            return img_bytes[len(CAPTCHA_MAGIC):len(CAPTCHA_MAGIC) + 4].decode('ascii')
+        return _random_code()
+
+    return mock
+
+
+class MockServer:
+    """在后台线程中运行的本地HTTP服务器"""
+    def __init__(self, app, host='127.0.0.1', port=0):
+        self.server = make_server(host, port, app, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://{self.server.host}:{self.server.port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.thread.join(timeout=5)
+
+
+def start_mock_upstreams(config=None):
+    """启动全部模拟上游服务器，返回 (服务器列表, 需要设置的环境变量)"""
+    config = config or MockConfig()
+    sangfor = MockServer(create_sangfor_app(config)).start()
+    huawei = MockServer(create_huawei_app(config)).start()
+    ocr = MockServer(create_ocr_app(config)).start()
+    env = {
+        "SANGFOR_BASE_URL": sangfor.url,
+        "HUAWEI_PORTAL_URL": f"{huawei.url}/escpportal",
+        "HUAWEI_ENTRY_URL": f"{huawei.url}/enterprise/ecareWechat?lang=zh",
+        "OCR_API_URL": f"{ocr.url}/reg",
+    }
+    logger.info(f"模拟上游服务器已启动: {env}")
+    return [sangfor, huawei, ocr], env
+
+
+class MockProxyServer:
+    """HTTP正向代理的本地替身：转发绝对地址形式的HTTP请求，并以代理自身标识作为来源IP，用于离线测试出口代理池
+
+    delay 为每个请求额外增加的延迟（秒），banned=True 时对所有请求返回403，模拟被厂商封禁的出口。
+    """
+    HOP_HEADERS = {'connection', 'proxy-connection', 'keep-alive', 'proxy-authorization', 'transfer-encoding', 'te', 'upgrade'}
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0, banned=False):
+        self.delay = delay
+        self.banned = banned
+        self.counters = collections.Counter()
+        self.counters_lock = threading.Lock()
+        owner = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _forward(self):
+                owner._handle(self)
+
+            do_GET = do_POST = do_HEAD = _forward
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def source(self):
+        return f"proxy-{self.server.server_address[1]}"
+
+    def count(self, name):
+        with self.counters_lock:
+            self.counters[name] += 1
+
+    def _reply(self, handler, status, body, headers=()):
+        handler.send_response(status)
+        for name, value in headers:
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        if handler.command != 'HEAD':
+            handler.wfile.write(body)
+
+    def _handle(self, handler):
+        self.count('requests')
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else None
+        target = urlsplit(handler.path)
+        if target.scheme != 'http' or not target.hostname:
+            self.count('rejected')
+            self._reply(handler, 400, b"only absolute http:// URLs are supported")
+            return
+        if self.banned:
+            self.count('banned')
+            self._reply(handler, 403, b"Forbidden")
+            return
+        if self.delay:
+            time.sleep(self.delay)
+        headers = {name: value for name, value in handler.headers.items() if name.lower() not in self.HOP_HEADERS}
+        headers['X-Forwarded-For'] = self.source
+        path = target.path or '/'
+        if target.query:
+            path += '?' + target.query
+        # 同一个客户端连接复用到上游的连接
+        connections = handler.__dict__.setdefault('upstream', {})
+        key = (target.hostname, target.port or 80)
+        connection = connections.get(key) or http.client.HTTPConnection(*key, timeout=30)
+        try:
+            connection.request(handler.command, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connections.pop(key, None)
+            self.count('upstream_errors')
+            self._reply(handler, 502, b"Bad Gateway")
+            return
+        connections[key] = connection
+        self.count('forwarded')
+        self._reply(handler, response.status, data,
+                    [(name, value) for name, value in response.getheaders()
+                     if name.lower() not in self.HOP_HEADERS and name.lower() != 'content-length'])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(timeout=5)
+
+
+class MockRedisServer:
+    """Redis协议的本地替身，只实现集群模式用到的命令，用于离线测试多节点部署"""
+    def __init__(self, host='127.0.0.1', port=0):
+        self.data = {}
+        self.expires = {}
+        self.changed = threading.Condition()
+        self.counters = collections.Counter()
+        owner = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        args = owner._read_command(self.rfile)
+                    except (ConnectionError, ValueError):
+                        return
+                    if args is None:
+                        return
+                    self.wfile.write(owner._reply(owner._dispatch(args)))
+                    self.wfile.flush()
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(timeout=5)
+
+    @staticmethod
+    def _read_command(rfile):
+        line = rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            raise ValueError("只支持RESP数组格式的命令")
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(rfile.readline()[1:-2])
+            args.append(rfile.read(length + 2)[:-2])
+        return args
+
+    def _reply(self, value):
+        if isinstance(value, Exception):
+            return b"-ERR %s\r\n" % str(value).encode('utf-8')
+        if value is True:
+            return b"+OK\r\n"
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, str):
+            return b"+%s\r\n" % value.encode('utf-8')
+        if isinstance(value, (list, tuple)):
+            return b"*%d\r\n" % len(value) + b"".join(self._reply(item) for item in value)
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def _alive(self, key):
+        """键已过期时删除，返回是否存在"""
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def _get(self, key, kind, create=False):
+        if not self._alive(key):
+            if not create:
+                return None
+            self.data[key] = kind()
+        value = self.data[key]
+        if not isinstance(value, kind):
+            raise TypeError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def _dispatch(self, args):
+        command = args[0].decode('utf-8').upper()
+        with self.changed:
+            self.counters[command] += 1
+            handler = getattr(self, f"_cmd_{command.lower()}", None)
+            if handler is None:
+                return ValueError(f"unknown command '{command}'")
+            try:
+                return handler(*args[1:])
+            except Exception as e:
+                return e
+
+    # 以下命令在持有 self.changed 时执行
+    def _cmd_ping(self, *args):
+        return "PONG"
+
+    def _cmd_auth(self, *args):
+        return True
+
+    def _cmd_select(self, db):
+        return True
+
+    def _cmd_flushdb(self):
+        self.data.clear()
+        self.expires.clear()
+        return True
+
+    def _cmd_get(self, key):
+        return self._get(key, bytes)
+
+    def _cmd_set(self, key, value, *options):
+        options = [option.upper() if option.isalpha() else option for option in options]
+        if b"NX" in options and self._alive(key):
+            return None
+        if b"XX" in options and not self._alive(key):
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        for name, scale in ((b"EX", 1.0), (b"PX", 0.001)):
+            if name in options:
+                self.expires[key] = time.monotonic() + float(options[options.index(name) + 1]) * scale
+        return True
+
+    def _cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                del self.data[key]
+                self.expires.pop(key, None)
+                removed += 1
+        return removed
+
+    def _cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._alive(key))
+
+    def _cmd_expire(self, key, seconds):
+        if not self._alive(key):
+            return 0
+        self.expires[key] = time.monotonic() + float(seconds)
+        return 1
+
+    def _cmd_incr(self, key):
+        return self._cmd_incrby(key, b"1")
+
+    def _cmd_incrby(self, key, amount):
+        value = int(self._get(key, bytes) or b"0") + int(amount)
+        self.data[key] = str(value).encode('utf-8')
+        return value
+
+    def _cmd_hset(self, key, *pairs):
+        fields = self._get(key, dict, create=True)
+        added = 0
+        for index in range(0, len(pairs), 2):
+            added += pairs[index] not in fields
+            fields[pairs[index]] = pairs[index + 1]
+        return added
+
+    def _cmd_hsetnx(self, key, field, value):
+        fields = self._get(key, dict, create=True)
+        if field in fields:
+            return 0
+        fields[field] = value
+        return 1
+
+    def _cmd_hget(self, key, field):
+        return (self._get(key, dict) or {}).get(field)
+
+    def _cmd_hdel(self, key, *fields):
+        values = self._get(key, dict) or {}
+        return sum(values.pop(field, None) is not None for field in fields)
+
+    def _cmd_hgetall(self, key):
+        return [item for pair in (self._get(key, dict) or {}).items() for item in pair]
+
+    def _cmd_hincrby(self, key, field, amount):
+        fields = self._get(key, dict, create=True)
+        value = int(fields.get(field, b"0")) + int(amount)
+        fields[field] = str(value).encode('utf-8')
+        return value
+
+    def _cmd_rpush(self, key, *values):
+        items = self._get(key, collections.deque, create=True)
+        items.extend(values)
+        self.changed.notify_all()
+        return len(items)
+
+    def _cmd_lpush(self, key, *values):
+        items = self._get(key, collections.deque, create=True)
+        items.extendleft(values)
+        self.changed.notify_all()
+        return len(items)
+
+    def _cmd_llen(self, key):
+        return len(self._get(key, collections.deque) or ())
+
+    def _cmd_lrange(self, key, start, stop):
+        items = list(self._get(key, collections.deque) or ())
+        stop = int(stop)
+        return items[int(start):None if stop == -1 else stop + 1]
+
+    def _cmd_lrem(self, key, count, value):
+        items = self._get(key, collections.deque)
+        if not items:
+            return 0
+        removed = 0
+        for _ in range(int(count) or len(items)):
+            try:
+                items.remove(value)
+            except ValueError:
+                break
+            removed += 1
+        return removed
+
+    def _cmd_lmove(self, source, destination, where_from, where_to):
+        items = self._get(source, collections.deque)
+        if not items:
+            return None
+        value = items.popleft() if where_from.upper() == b"LEFT" else items.pop()
+        target = self._get(destination, collections.deque, create=True)
+        if where_to.upper() == b"LEFT":
+            target.appendleft(value)
+        else:
+            target.append(value)
+        self.changed.notify_all()
+        return value
+
+    def _cmd_blmove(self, source, destination, where_from, where_to, timeout):
+        deadline = time.monotonic() + float(timeout)
+        while True:
+            value = self._cmd_lmove(source, destination, where_from, where_to)
+            remaining = deadline - time.monotonic()
+            if value is not None or (float(timeout) and remaining <= 0):
+                return value
+            self.changed.wait(remaining if float(timeout) else None)
+
+    def _cmd_eval(self, script, numkeys, *args):
+        # cluster 会导入 job_queue，任务数据库路径在导入时读取；压测先设置环境变量再导入服务模块，这里不能提前导入
+        from cluster import RELEASE_LOCK_SCRIPT
+        # 只支持集群模式释放锁的脚本
+        if script.decode('utf-8') != RELEASE_LOCK_SCRIPT:
+            raise ValueError("only the lock release script is supported")
+        key, token = args[0], args[int(numkeys)]
+        if self._get(key, bytes) == token:
+            return self._cmd_del(key)
+        return 0
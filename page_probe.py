@@ -0,0 +1,100 @@
+"""流式页面探测：边下载边增量查找特征文本，一旦能做出判断就停止读取，并限制最多读取的字节数"""
+import codecs
+import logging
+import os
+
+logger = logging.getLogger('ServiceQueryAPI.Probe')
+
+# 单次探测最多读取的字节数（解压后）
+PROBE_MAX_BYTES = int(os.getenv('SESSION_PROBE_MAX_BYTES', '65536'))
+# 提前结束时剩余内容不超过该字节数则读完，使连接可以放回连接池复用；否则直接关闭连接
+PROBE_DRAIN_BYTES = int(os.getenv('SESSION_PROBE_DRAIN_BYTES', '16384'))
+PROBE_CHUNK_SIZE = 4096
+# 正则匹配跨越数据块边界时保留的上一块末尾字符数
+PATTERN_OVERLAP = 256
+
+
+class PageProbe:
+    """一次探测的结果"""
+    __slots__ = ('status_code', 'url', 'found', 'match', 'chars', 'bytes_read', 'complete')
+
+    def __init__(self, status_code, url):
+        self.status_code = status_code
+        self.url = url
+        self.found = set()   # 已找到的特征文本
+        self.match = None    # pattern 的第一个匹配
+        self.chars = 0       # 已解码的字符数
+        self.bytes_read = 0
+        self.complete = False  # 是否读完了整个响应体
+
+    def first(self, markers):
+        """返回 markers 中第一个已找到的特征文本"""
+        for marker in markers:
+            if marker in self.found:
+                return marker
+        return None
+
+
+def _finish(response, probe):
+    """结束读取：剩余内容较少时读完以复用连接，否则关闭连接"""
+    try:
+        if not probe.complete:
+            # Content-Length 是压缩后的长度，需与从连接上实际读取的字节数比较，而不是解压后的 bytes_read
+            length = response.headers.get('Content-Length')
+            tell = getattr(response.raw, 'tell', None)
+            received = tell() if tell is not None else probe.bytes_read
+            if length is not None and length.isdigit() and 0 <= int(length) - received <= PROBE_DRAIN_BYTES:
+                for _ in response.iter_content(PROBE_CHUNK_SIZE):
+                    pass
+    except Exception:
+        pass
+    finally:
+        response.close()
+
+
+def probe_page(session, url, markers=(), stop_markers=(), pattern=None, stop_chars=None,
+               max_bytes=PROBE_MAX_BYTES, encoding='utf-8', **kwargs):
+    """以流式方式GET页面并查找特征文本
+
+    markers 为需要记录是否出现的特征文本；stop_markers 中任一出现、pattern 匹配成功、
+    或已解码字符数超过 stop_chars 时立即停止读取；最多读取 max_bytes 字节。
+    """
+    markers = tuple(markers) + tuple(marker for marker in stop_markers if marker not in markers)
+    overlap = max([len(marker) for marker in markers] + [PATTERN_OVERLAP if pattern is not None else 1]) - 1
+    response = session.get(url, stream=True, **kwargs)
+    probe = PageProbe(response.status_code, response.url)
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    tail = ""
+    try:
+        iterator = response.iter_content(PROBE_CHUNK_SIZE)
+        while True:
+            chunk = next(iterator, None)
+            if chunk is None:
+                text = decoder.decode(b"", final=True)
+                probe.complete = True
+            else:
+                probe.bytes_read += len(chunk)
+                text = decoder.decode(chunk)
+            probe.chars += len(text)
+            window = tail + text
+            for marker in markers:
+                if marker not in probe.found and marker in window:
+                    probe.found.add(marker)
+            if pattern is not None and probe.match is None:
+                match = pattern.search(window)
+                # 匹配到数据块末尾时可能被截断，等下一块数据到达后再确认
+                if match is not None and (probe.complete or match.end() < len(window)):
+                    probe.match = match
+            if probe.complete:
+                break
+            if probe.found.intersection(stop_markers) or probe.match is not None:
+                break
+            if stop_chars is not None and probe.chars > stop_chars:
+                break
+            if probe.bytes_read >= max_bytes:
+                logger.info(f"探测 {url} 已读取 {probe.bytes_read} 字节，达到上限后停止")
+                break
+            tail = window[-overlap:] if overlap > 0 else ""
+    finally:
+        _finish(response, probe)
+    return probe
@@ -0,0 +1,156 @@
+"""优先级通道：交互查询与批量任务分通道排队，按权重分配厂商查询资源的并发名额，并为交互查询保留名额"""
+import collections
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('ServiceQueryAPI.Lanes')
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+# 每个厂商同时进行的查询名额，可用 LANE_SLOTS_<厂商> 单独指定
+LANE_SLOTS = int(os.getenv('LANE_SLOTS', '8'))
+# 为交互查询保留的名额，批量任务最多使用 LANE_SLOTS - LANE_RESERVED_INTERACTIVE 个
+LANE_RESERVED_INTERACTIVE = int(os.getenv('LANE_RESERVED_INTERACTIVE', '2'))
+# 批量查询每次占用名额最多查询的序列号个数，查询完即释放名额，交互查询不必等待整个批次完成
+LANE_BULK_CHUNK = int(os.getenv('LANE_BULK_CHUNK', '5'))
+# 两类请求同时排队时按权重分配空出的名额
+LANE_WEIGHTS = {
+    INTERACTIVE: float(os.getenv('LANE_WEIGHT_INTERACTIVE', '4')),
+    BULK: float(os.getenv('LANE_WEIGHT_BULK', '1')),
+}
+
+
+def vendor_slots(vendor):
+    """读取厂商的查询名额"""
+    return int(os.getenv(f'LANE_SLOTS_{vendor.upper()}', str(LANE_SLOTS)))
+
+
+def parse_lane(value, default):
+    """把请求中的优先级参数转换为通道名，无法识别时使用默认通道"""
+    value = (value or '').strip().lower()
+    if value in (INTERACTIVE, 'high'):
+        return INTERACTIVE
+    if value in (BULK, 'low', 'batch'):
+        return BULK
+    return default
+
+
+class LaneStats:
+    __slots__ = ('granted', 'timed_out', 'wait_total', 'wait_max')
+
+    def __init__(self):
+        self.granted = 0
+        self.timed_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class LaneScheduler:
+    """按通道加权分配并发名额：每个通道维护虚拟时间，空出名额时分配给可运行且虚拟时间最小的通道"""
+    def __init__(self, name, slots=LANE_SLOTS, reserved_interactive=LANE_RESERVED_INTERACTIVE, weights=None):
+        self.name = name
+        self.slots = slots
+        self.weights = dict(weights or LANE_WEIGHTS)
+        # 每个通道最多可占用的名额
+        self.limits = {
+            INTERACTIVE: slots,
+            BULK: max(1, slots - reserved_interactive),
+        }
+        self.lock = threading.Lock()
+        self.in_flight = {lane: 0 for lane in self.weights}
+        self.waiters = {lane: collections.deque() for lane in self.weights}
+        self.passes = {lane: 0.0 for lane in self.weights}
+        self.virtual_time = 0.0
+        self.stats_by_lane = {lane: LaneStats() for lane in self.weights}
+
+    def _can_run(self, lane):
+        return sum(self.in_flight.values()) < self.slots and self.in_flight[lane] < self.limits[lane]
+
+    def _dispatch(self):
+        while True:
+            eligible = [lane for lane, queue in self.waiters.items() if queue and self._can_run(lane)]
+            if not eligible:
+                return
+            lane = min(eligible, key=lambda name: self.passes[name])
+            event = self.waiters[lane].popleft()
+            self.in_flight[lane] += 1
+            self.virtual_time = self.passes[lane]
+            self.passes[lane] += 1 / self.weights[lane]
+            event.set()
+
+    def acquire(self, lane, timeout=None):
+        """等待获得名额，返回等待的秒数；超过 timeout 秒仍未获得时放弃排队并返回 None"""
+        event = threading.Event()
+        start = time.perf_counter()
+        with self.lock:
+            if not self.waiters[lane] and not self.in_flight[lane]:
+                # 空闲后重新活跃的通道从当前虚拟时间开始，避免积攒的额度造成突发
+                self.passes[lane] = max(self.passes[lane], self.virtual_time)
+            self.waiters[lane].append(event)
+            self._dispatch()
+        if not event.wait(timeout):
+            with self.lock:
+                # 超时与分配名额可能同时发生，已分配时照常返回
+                if not event.is_set():
+                    self.waiters[lane].remove(event)
+                    self.stats_by_lane[lane].timed_out += 1
+                    return None
+        waited = time.perf_counter() - start
+        with self.lock:
+            stats = self.stats_by_lane[lane]
+            stats.granted += 1
+            stats.wait_total += waited
+            stats.wait_max = max(stats.wait_max, waited)
+        if waited > 1:
+            logger.info(f"{self.name} {lane} 通道等待名额 {waited:.2f} 秒")
+        return waited
+
+    def backlog(self, lane):
+        """新请求进入该通道时，轮到它之前还需空出的名额个数（可立即执行时为0）"""
+        with self.lock:
+            own = len(self.waiters[lane])
+            if not own and self._can_run(lane):
+                return 0
+            ahead = own
+            for other, queue in self.waiters.items():
+                if other != lane:
+                    # 其他通道的排队请求按权重比例分走空出的名额
+                    ahead += min(len(queue), (own + 1) * self.weights[other] / self.weights[lane])
+            return ahead + 1
+
+    def release(self, lane):
+        with self.lock:
+            self.in_flight[lane] -= 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, lane):
+        """占用一个名额执行查询"""
+        self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "slots": self.slots,
+                "lanes": {
+                    lane: {
+                        "limit": self.limits[lane],
+                        "weight": self.weights[lane],
+                        "in_flight": self.in_flight[lane],
+                        "waiting": len(self.waiters[lane]),
+                        "granted": stats.granted,
+                        "timed_out": stats.timed_out,
+                        "avg_wait_ms": round(stats.wait_total / stats.granted * 1000, 1) if stats.granted else 0.0,
+                        "max_wait_ms": round(stats.wait_max * 1000, 1),
+                    }
+                    for lane, stats in self.stats_by_lane.items()
+                },
+            }
@@ -0,0 +1,237 @@
+"""按需性能剖析：管理员可对单个请求做cProfile剖析，或在指定秒数内定时采样进程中所有线程的调用栈，输出火焰图可用的折叠栈格式
+
+两种剖析都只覆盖处理该管理员请求的进程；以多个工作进程运行时（如 gunicorn -w 4），需要对每个进程分别采样。
+"""
+import collections
+import contextvars
+import cProfile
+import hmac
+import io
+import logging
+import marshal
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+logger = logging.getLogger('ServiceQueryAPI.Profiling')
+
+# 管理员令牌，未配置时剖析接口不可用
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+# 单请求剖析报告中列出的函数个数
+PROFILE_REPORT_LIMIT = int(os.getenv('PROFILE_REPORT_LIMIT', '40'))
+# 采样剖析的最长时间与默认采样间隔（秒）
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '60'))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+# 调用栈最多记录的层数
+PROFILE_MAX_DEPTH = 128
+
+# 按文件路径或函数名把耗时归类，便于判断时间花在HTML解析、正则、JSON、OCR推理还是网络等待上
+CATEGORIES = (
+    ('html_parsing', ('bs4/', 'html/parser', 'lxml', 'html5lib')),
+    ('regex', ('/re/', 'sre_', "'re.Pattern'", '_sre')),
+    ('ocr', ('ddddocr', 'onnxruntime', 'PIL/')),
+    ('json', ('json/', 'orjson')),
+    ('network', ('socket', 'ssl', 'selectors', 'http/client', 'urllib3/', 'requests/', 'httpx', 'h2/')),
+    ('sleep', ('time.sleep',)),
+    ('lock_wait', ("'_thread.lock'", "'_thread.RLock'", 'threading.py', 'queue.py')),
+)
+
+# 采样时视为空闲等待的栈顶函数
+IDLE_FUNCTIONS = {
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('selectors.py', 'select'),
+    ('queue.py', 'get'),
+    ('socketserver.py', 'serve_forever'),
+}
+
+
+def is_admin(token):
+    """校验管理员令牌"""
+    return bool(ADMIN_TOKEN) and bool(token) and hmac.compare_digest(str(token), ADMIN_TOKEN)
+
+
+def classify(filename, function):
+    """返回函数所属的耗时类别"""
+    location = f"{filename.replace(os.sep, '/')}:{function}"
+    for category, needles in CATEGORIES:
+        if any(needle in location for needle in needles):
+            return category
+    return 'other'
+
+
+# 当前上下文中正在剖析的请求；提交到其他线程的工作（流水线阶段、对冲请求）在提交时读取，执行时一并剖析
+_current_profile = contextvars.ContextVar('request_profile', default=None)
+
+
+class RequestProfile:
+    """单个请求的cProfile剖析，覆盖处理请求的线程，以及通过 profiled() 代为执行的流水线阶段和对冲请求"""
+    # cProfile 在新版本Python中是进程级的，同一时间只剖析一个请求
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.started = None
+        self.elapsed = None
+        self.token = None
+        # 其他线程中为本请求执行的工作各自的剖析结果
+        self.others = []
+        self.others_lock = threading.Lock()
+
+    def start(self):
+        """开始剖析，已有请求在剖析时返回 False"""
+        if not RequestProfile.lock.acquire(blocking=False):
+            return False
+        self.started = time.perf_counter()
+        self.token = _current_profile.set(self)
+        self.profiler.enable()
+        return True
+
+    def stop(self):
+        if self.started is None or self.elapsed is not None:
+            return
+        self.profiler.disable()
+        with self.others_lock:
+            self.elapsed = time.perf_counter() - self.started
+        try:
+            _current_profile.reset(self.token)
+        except ValueError:
+            # 在其他上下文中停止（如 teardown），剖析已结束，不影响结果
+            pass
+        RequestProfile.lock.release()
+
+    def add(self, profiler):
+        """合并其他线程的剖析结果；请求结束后（如被放弃的对冲请求）才完成的工作不再计入"""
+        with self.others_lock:
+            if self.elapsed is None:
+                self.others.append(profiler)
+
+    def stats(self, stream=None):
+        with self.others_lock:
+            others = list(self.others)
+        return pstats.Stats(self.profiler, *others, stream=stream)
+
+    def breakdown(self):
+        """各类别的函数自身耗时（毫秒），包括其他线程中为本请求执行的工作"""
+        totals = collections.Counter()
+        for (filename, _, function), (_, _, own_time, _, _) in self.stats().stats.items():
+            totals[classify(filename, function)] += own_time
+        return {category: round(seconds * 1000, 2) for category, seconds in totals.most_common()}
+
+    def report(self, sort='cumulative', limit=PROFILE_REPORT_LIMIT):
+        """文本报告与耗时分类"""
+        stream = io.StringIO()
+        stats = self.stats(stream)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return {
+            "wall_ms": round(self.elapsed * 1000, 2),
+            "pid": os.getpid(),
+            "other_thread_tasks": len(self.others),
+            "breakdown": self.breakdown(),
+            "report": stream.getvalue(),
+        }
+
+    def dump(self):
+        """pstats 二进制格式，可用 snakeviz、gprof2dot 等工具打开"""
+        return marshal.dumps(self.stats().stats)
+
+
+def current_profile():
+    """当前上下文中正在剖析的请求，没有时返回 None；提交工作到其他线程前调用，再把结果交给 profiled()"""
+    return _current_profile.get()
+
+
+def profiled(profile, fn, *args):
+    """在当前线程执行 fn(*args)，profile 不为 None 时剖析这次执行并合并到该请求的剖析结果中"""
+    if profile is None or profile.elapsed is not None or sys.getprofile() is not None:
+        return fn(*args)
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+ 的 cProfile 基于 sys.monitoring，对所有线程生效，请求的剖析器已覆盖这里的执行
+        return fn(*args)
+    try:
+        return fn(*args)
+    finally:
+        profiler.disable()
+        profiler.create_stats()
+        profile.add(profiler)
+
+
+def _thread_label(name):
+    """线程名中的序号替换为N，使同类线程在火焰图中合并"""
+    return re.sub(r'\d+', 'N', name).replace(';', ',')
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ',')
+
+
+class StackSampler:
+    """定时采样进程中所有线程的调用栈，按折叠栈格式计数"""
+    # 同一时间只运行一个采样
+    lock = threading.Lock()
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL, include_idle=True):
+        self.interval = max(0.001, interval)
+        self.include_idle = include_idle
+        self.stacks = collections.Counter()
+        self.categories = collections.Counter()
+        self.samples = 0
+        self.idle_samples = 0
+        self.elapsed = 0.0
+
+    def _sample(self, own_ident, names):
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            leaf = frame
+            if (os.path.basename(leaf.f_code.co_filename), leaf.f_code.co_name) in IDLE_FUNCTIONS:
+                self.idle_samples += 1
+                if not self.include_idle:
+                    continue
+            stack = []
+            while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(_thread_label(names.get(ident, 'thread')))
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.categories[classify(leaf.f_code.co_filename, leaf.f_code.co_name)] += 1
+            self.samples += 1
+
+    def run(self, seconds):
+        """采样 seconds 秒，已有采样在运行时返回 False"""
+        if not StackSampler.lock.acquire(blocking=False):
+            return False
+        try:
+            own_ident = threading.get_ident()
+            start = time.perf_counter()
+            end = start + min(seconds, PROFILE_MAX_SECONDS)
+            logger.info(f"开始采样剖析，时长 {seconds:.1f} 秒，间隔 {self.interval * 1000:.1f} 毫秒")
+            while time.perf_counter() < end:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                self._sample(own_ident, names)
+                time.sleep(self.interval)
+            self.elapsed = time.perf_counter() - start
+            return True
+        finally:
+            StackSampler.lock.release()
+
+    def folded(self):
+        """折叠栈文本，每行“栈;帧 次数”，可直接交给 flamegraph.pl、speedscope 等工具"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self):
+        return {
+            "pid": os.getpid(),
+            "seconds": round(self.elapsed, 2),
+            "samples": self.samples,
+            "idle_samples": self.idle_samples,
+            "categories": dict(self.categories.most_common()),
+            "top_stacks": [{"stack": stack, "count": count} for stack, count in self.stacks.most_common(20)],
+        }
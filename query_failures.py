@@ -0,0 +1,107 @@
+"""查询失败分类：各查询步骤以类型化的异常报告失败原因，重试时只重做失败的步骤
+
+- 验证码被拒绝或识别失败：只重新获取并识别验证码
+- session失效：重新登录后重试
+- 上游5xx、超时、响应无法解析：等待后重试失败的步骤，已识别的验证码继续使用
+- 厂商确认没有记录：不重试
+
+查询失败的响应在 failure 字段中给出失败类型，调用方据此区分可重试的失败和厂商确认没有记录（not_found）。
+"""
+import collections
+import threading
+from contextlib import contextmanager
+
+import requests
+
+
+class QueryFailure(Exception):
+    """查询步骤失败；stage 为失败的步骤，retryable 表示是否值得重试"""
+    kind = "failed"
+    retryable = True
+
+    def __init__(self, message, stage=None):
+        super().__init__(message)
+        self.stage = stage
+
+
+class CaptchaRejected(QueryFailure):
+    """验证码识别失败或被厂商拒绝"""
+    kind = "captcha_rejected"
+
+
+class SessionExpired(QueryFailure):
+    """登录session已失效"""
+    kind = "session_expired"
+
+
+class UpstreamError(QueryFailure):
+    """厂商返回非200状态码或连接失败"""
+    kind = "upstream_error"
+
+    def __init__(self, message, stage=None, status=None):
+        super().__init__(message, stage)
+        self.status = status
+
+
+class UpstreamTimeout(QueryFailure):
+    """请求厂商超时"""
+    kind = "timeout"
+
+
+class ParseError(QueryFailure):
+    """厂商响应无法解析"""
+    kind = "parse_error"
+
+
+class NotFound(QueryFailure):
+    """厂商明确答复没有该序列号的记录，payload 为返回给调用方的响应数据"""
+    kind = "not_found"
+    retryable = False
+
+    def __init__(self, message, stage=None, payload=None):
+        super().__init__(message, stage)
+        self.payload = payload
+
+
+def failure_kind(error):
+    """返回失败类型，用于响应中的 failure 字段；无法分类的异常为 failed"""
+    return getattr(error, "kind", QueryFailure.kind)
+
+
+def check_status(response, stage, what):
+    """状态码不是200时抛出 UpstreamError"""
+    if response.status_code != 200:
+        raise UpstreamError(f"{what}失败，状态码: {response.status_code}", stage, response.status_code)
+
+
+@contextmanager
+def failure_stage(stage):
+    """把步骤内的网络异常转换为类型化的失败，并标记失败的步骤"""
+    try:
+        yield
+    except QueryFailure as e:
+        if e.stage is None:
+            e.stage = stage
+        raise
+    except requests.Timeout as e:
+        raise UpstreamTimeout(f"{stage} 超时: {str(e)}", stage) from e
+    except requests.RequestException as e:
+        raise UpstreamError(f"{stage} 请求失败: {str(e)}", stage) from e
+
+
+class FailureStats:
+    """按厂商、失败类型和步骤统计查询失败次数"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def record(self, vendor, failure):
+        with self.lock:
+            self.counts[(vendor, failure.kind, failure.stage or "unknown")] += 1
+
+    def stats(self):
+        result = {}
+        with self.lock:
+            for (vendor, kind, stage), count in sorted(self.counts.items()):
+                result.setdefault(vendor, {}).setdefault(kind, {})[stage] = count
+        return result
@@ -0,0 +1,314 @@
+"""后台刷新调度：按数据陈旧程度和距到期日远近排列登记设备的优先级，在各厂商每小时请求预算内平滑地刷新维保数据"""
+import datetime
+import heapq
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger('ServiceQueryAPI.Refresh')
+
+# 是否在服务启动时运行后台刷新
+REFRESH_ENABLED = os.getenv('REFRESH_ENABLED', '1') == '1'
+# 每个厂商每小时最多发起的刷新查询数，可用 REFRESH_BUDGET_<厂商> 单独指定
+REFRESH_BUDGET_PER_HOUR = float(os.getenv('REFRESH_BUDGET_PER_HOUR', '60'))
+# 维保数据的最长刷新间隔（秒），临近到期的设备按比例缩短，但不低于最短间隔
+REFRESH_MAX_AGE = float(os.getenv('REFRESH_MAX_AGE', str(7 * 86400)))
+REFRESH_MIN_AGE = float(os.getenv('REFRESH_MIN_AGE', '86400'))
+# 距到期日少于该天数的设备开始缩短刷新间隔
+REFRESH_EXPIRY_WINDOW_DAYS = float(os.getenv('REFRESH_EXPIRY_WINDOW_DAYS', '90'))
+# 刷新失败后的重试间隔（秒）
+REFRESH_RETRY_DELAY = float(os.getenv('REFRESH_RETRY_DELAY', '1800'))
+# 单次批量刷新最多包含的序列号个数
+REFRESH_BATCH_SIZE = int(os.getenv('REFRESH_BATCH_SIZE', '20'))
+# 多个进程共用同一数据库时只有持有租约的进程执行刷新，租约有效期（秒），持有者退出后由其他进程接管
+REFRESH_LEASE = float(os.getenv('REFRESH_LEASE', '120'))
+# 主调度器重新载入设备清单的间隔（秒），以便接收其他进程登记的设备和交互查询的结果
+REFRESH_RELOAD_INTERVAL = float(os.getenv('REFRESH_RELOAD_INTERVAL', '300'))
+
+LEASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    lease_until REAL NOT NULL
+);
+"""
+
+
+def vendor_budget(vendor):
+    """读取厂商的每小时刷新预算"""
+    return float(os.getenv(f'REFRESH_BUDGET_{vendor.upper()}', str(REFRESH_BUDGET_PER_HOUR)))
+
+
+def days_to_expiry(expiry_dates, today=None):
+    """返回距最近一个未到期日期的天数，全部已过期时为0，没有到期日时为 None"""
+    if not expiry_dates:
+        return None
+    today = today or datetime.date.today()
+    remaining = [(datetime.date.fromisoformat(day) - today).days for day in expiry_dates]
+    upcoming = [days for days in remaining if days >= 0]
+    return min(upcoming) if upcoming else 0
+
+
+def refresh_interval(days_left):
+    """根据距到期日的天数计算刷新间隔，越临近到期刷新越频繁"""
+    if days_left is None or days_left >= REFRESH_EXPIRY_WINDOW_DAYS:
+        return REFRESH_MAX_AGE
+    return max(REFRESH_MIN_AGE, REFRESH_MAX_AGE * days_left / REFRESH_EXPIRY_WINDOW_DAYS)
+
+
+class TokenBucket:
+    """按小时预算匀速补充的令牌桶，桶容量为5分钟的预算，避免集中突发"""
+    def __init__(self, per_hour):
+        self.rate = per_hour / 3600
+        self.capacity = max(1.0, per_hour / 12)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, count):
+        """最多取出 count 个令牌，返回实际取出的个数"""
+        self.refill()
+        taken = min(count, int(self.tokens))
+        self.tokens -= taken
+        return taken
+
+    def wait_time(self):
+        """距下一个令牌可用的秒数"""
+        self.refill()
+        if self.tokens >= 1 or self.rate <= 0:
+            return 0.0 if self.tokens >= 1 else float('inf')
+        return (1 - self.tokens) / self.rate
+
+
+class SchedulerLease:
+    """保存在SQLite中的主调度器租约，共用同一数据库的进程中同时只有一个持有者"""
+    def __init__(self, path, name='refresh', ttl=REFRESH_LEASE):
+        self.name = name
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(LEASE_SCHEMA)
+
+    def acquire(self):
+        """获取或续约租约，返回本进程是否持有"""
+        now = time.time()
+        with self.lock:
+            rows = self.conn.execute(
+                "INSERT INTO leases (name, owner, lease_until) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, lease_until = excluded.lease_until "
+                "WHERE leases.owner = excluded.owner OR leases.lease_until < ? RETURNING owner",
+                (self.name, self.owner, now + self.ttl, now)).fetchall()
+        return bool(rows)
+
+    def release(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (self.name, self.owner))
+
+    def holder(self):
+        """返回当前租约持有者，没有有效租约时为 None"""
+        with self.lock:
+            row = self.conn.execute("SELECT owner FROM leases WHERE name = ? AND lease_until >= ?",
+                                    (self.name, time.time())).fetchone()
+        return row[0] if row else None
+
+
+class RefreshScheduler:
+    """设备刷新调度器：每个厂商一个最小堆，按 (计划刷新时间, 距到期天数) 排序，在预算内批量刷新"""
+    def __init__(self, store, runners, store_result, lease=None):
+        self.store = store
+        self.runners = runners
+        self.store_result = store_result
+        # 为 None 时本进程总是执行刷新
+        self.lease = lease
+        self.leading = lease is None
+        self.buckets = {vendor: TokenBucket(vendor_budget(vendor)) for vendor in runners}
+        self.heaps = {vendor: [] for vendor in runners}
+        self.due = {}  # (厂商, 序列号) -> 当前有效的计划刷新时间，堆中过期的条目惰性删除
+        self.lock = threading.Condition()
+        self.refreshed = 0
+        self.failed = 0
+        self.thread = None
+        self.stopped = False
+
+    def schedule(self, vendor, serial, due_at, days_left=None):
+        with self.lock:
+            if self.due.get((vendor, serial)) == due_at:
+                # 重新载入清单时计划未变，不重复入堆
+                return
+            self.due[(vendor, serial)] = due_at
+            heapq.heappush(self.heaps[vendor], (due_at, days_left if days_left is not None else float('inf'), serial))
+            self.lock.notify()
+
+    def unschedule(self, vendor, serial):
+        with self.lock:
+            self.due.pop((vendor, serial), None)
+
+    def plan(self, vendor, serial, updated_at, expiry_dates):
+        """根据最后查询时间和到期日安排下一次刷新，从未查询过的设备立即刷新"""
+        days_left = days_to_expiry(expiry_dates)
+        due_at = time.time() if updated_at is None else updated_at + refresh_interval(days_left)
+        self.schedule(vendor, serial, due_at, days_left)
+
+    def refreshed_elsewhere(self, vendor, serial, expiry_dates):
+        """登记设备已被交互查询刷新时，顺延其计划刷新时间，避免重复消耗预算"""
+        with self.lock:
+            scheduled = (vendor, serial) in self.due
+        if scheduled:
+            self.plan(vendor, serial, time.time(), expiry_dates)
+
+    def load(self):
+        """从存储中载入设备清单并安排刷新"""
+        devices = self.store.inventory()
+        for vendor, serial, updated_at, expiry_dates in devices:
+            if vendor in self.runners:
+                self.plan(vendor, serial, updated_at, expiry_dates)
+        logger.info(f"已载入 {len(devices)} 台登记设备")
+
+    def _valid(self, vendor, entry):
+        return self.due.get((vendor, entry[2])) == entry[0]
+
+    def _take_due(self):
+        """取出一个厂商在预算内的一批到期设备，返回 (厂商, 序列号列表, 无可刷新设备时的等待秒数)"""
+        now = time.time()
+        waits = []
+        with self.lock:
+            for vendor, heap in self.heaps.items():
+                while heap and not self._valid(vendor, heap[0]):
+                    heapq.heappop(heap)
+                if not heap:
+                    continue
+                if heap[0][0] > now:
+                    waits.append(heap[0][0] - now)
+                    continue
+                batch = []
+                while heap and heap[0][0] <= now and len(batch) < REFRESH_BATCH_SIZE:
+                    entry = heap[0]
+                    if not self._valid(vendor, entry):
+                        heapq.heappop(heap)
+                        continue
+                    if not self.buckets[vendor].take(1):
+                        break
+                    heapq.heappop(heap)
+                    self.due.pop((vendor, entry[2]), None)
+                    batch.append(entry[2])
+                if batch:
+                    return vendor, batch, 0
+                # 该厂商预算已用完，等待令牌补充
+                waits.append(self.buckets[vendor].wait_time())
+        return None, [], min(waits) if waits else None
+
+    def run_once(self):
+        """执行一批刷新，返回下一次需要等待的秒数（None表示没有登记设备）"""
+        vendor, serial_numbers, wait = self._take_due()
+        if not serial_numbers:
+            return wait
+        logger.info(f"后台刷新{vendor}设备 {len(serial_numbers)} 台")
+        try:
+            results = self.runners[vendor](serial_numbers)
+        except Exception as e:
+            logger.error(f"后台刷新{vendor}设备异常: {str(e)}")
+            results = []
+        succeeded = set()
+        for result in results:
+            self.store_result(vendor, result["sn"], result)
+            if result.get("success") == 1:
+                succeeded.add(result["sn"])
+        now = time.time()
+        for serial in serial_numbers:
+            if serial in succeeded:
+                self.refreshed += 1
+                self.plan(vendor, serial, now, self.store.expiry_dates(vendor, serial))
+            else:
+                self.failed += 1
+                self.schedule(vendor, serial, now + REFRESH_RETRY_DELAY)
+        return 0
+
+    def lead(self):
+        """获取或续约主调度器租约，返回本进程是否应执行刷新"""
+        if self.lease is None:
+            return True
+        try:
+            leading = self.lease.acquire()
+        except sqlite3.Error as e:
+            logger.error(f"后台刷新租约续约失败: {str(e)}")
+            leading = False
+        if leading != self.leading:
+            if leading:
+                logger.info(f"本进程成为后台刷新主调度器 ({self.lease.owner})")
+            else:
+                logger.info("后台刷新租约由其他进程持有，本进程转为备用")
+            self.leading = leading
+        return leading
+
+    def run(self):
+        logger.info("后台刷新调度器已启动")
+        loaded_at = time.monotonic()
+        while not self.stopped:
+            if not self.lead():
+                with self.lock:
+                    self.lock.wait(self.lease.ttl / 3)
+                # 接管时清单可能已被其他进程更新
+                loaded_at = 0.0
+                continue
+            try:
+                if self.lease is not None and time.monotonic() - loaded_at >= REFRESH_RELOAD_INTERVAL:
+                    self.load()
+                    loaded_at = time.monotonic()
+                wait = self.run_once()
+            except Exception as e:
+                logger.error(f"后台刷新调度异常: {str(e)}")
+                wait = 60
+            if wait != 0:
+                limit = 300 if self.lease is None else min(300, self.lease.ttl / 3, REFRESH_RELOAD_INTERVAL)
+                with self.lock:
+                    # 有新设备登记时会被提前唤醒
+                    self.lock.wait(limit if wait is None else min(wait, limit))
+        if self.lease is not None and self.leading:
+            self.lease.release()
+            self.leading = False
+
+    def start(self):
+        if self.thread is None:
+            self.load()
+            self.thread = threading.Thread(target=self.run, name='refresh-scheduler', daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        with self.lock:
+            self.lock.notify()
+
+    def next_due(self, vendor, serial):
+        """返回设备的计划刷新时间，未安排时为 None"""
+        with self.lock:
+            return self.due.get((vendor, serial))
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            scheduled = list(self.due.values())
+            for bucket in self.buckets.values():
+                bucket.refill()
+            return {
+                "running": self.thread is not None and not self.stopped,
+                "leader": self.leading,
+                "lease_holder": None if self.lease is None else self.lease.holder(),
+                "scheduled": len(scheduled),
+                "due_now": sum(1 for due_at in scheduled if due_at <= now),
+                "next_due_in_s": round(max(min(scheduled) - now, 0), 1) if scheduled else None,
+                "refreshed": self.refreshed,
+                "failed": self.failed,
+                "budget_per_hour": {vendor: round(bucket.rate * 3600, 2) for vendor, bucket in self.buckets.items()},
+                "tokens": {vendor: round(bucket.tokens, 2) for vendor, bucket in self.buckets.items()},
+            }
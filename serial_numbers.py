@@ -0,0 +1,49 @@
+"""序列号与厂商名称规范化：去除导出文件中常见的空白、全角字符、引号和大小写差异，使同一设备的不同写法对应同一个序列号"""
+import re
+import unicodedata
+
+# 各厂商序列号允许保留的字符，其余字符（空白、零宽字符、引号、分隔符等）在规范化时去除
+SERIAL_ALLOWED = {
+    # 华为条码只包含数字和大写字母
+    "huawei": re.compile(r'[^0-9A-Z]'),
+    # 深信服序列号（网关ID）允许短横线
+    "sangfor": re.compile(r'[^0-9A-Z-]'),
+    "lenovo": re.compile(r'[^0-9A-Z]'),
+}
+# 未配置规则的厂商只去除空白和引号
+DEFAULT_SERIAL_STRIP = re.compile(r'[\s\'"`\u200b-\u200d\ufeff]')
+
+# 厂商名称别名（小写）
+VENDOR_ALIASES = {
+    "huawei": "huawei",
+    "华为": "huawei",
+    "sangfor": "sangfor",
+    "深信服": "sangfor",
+    "lenovo": "lenovo",
+    "联想": "lenovo",
+}
+
+
+def canonical_serial(vendor, value):
+    """返回规范化的序列号：全角转半角、转大写，并按厂商规则去除多余字符；无法得到有效序列号时返回空字符串"""
+    if value is None:
+        return ""
+    value = unicodedata.normalize('NFKC', str(value)).upper()
+    pattern = SERIAL_ALLOWED.get(vendor)
+    if pattern is None:
+        return DEFAULT_SERIAL_STRIP.sub('', value)
+    return pattern.sub('', value).strip('-')
+
+
+def canonical_vendor(value, default=None):
+    """把厂商名称或别名转换为厂商标识，为空时返回 default，无法识别时返回 None"""
+    value = unicodedata.normalize('NFKC', str(value or '')).strip().lower()
+    if not value:
+        return default
+    if value in VENDOR_ALIASES:
+        return VENDOR_ALIASES[value]
+    # “华为技术有限公司”、“Huawei Technologies” 等
+    for alias, vendor in VENDOR_ALIASES.items():
+        if alias in value:
+            return vendor
+    return None
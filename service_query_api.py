@@ -4,18 +4,48 @@ import re
 import time
 import logging
 import random
+import base64
 from functools import wraps
-import pickle
 import os
-from flask import Flask, request, jsonify
+import datetime
+import threading
+import queue
+from contextlib import contextmanager
+from urllib.parse import quote, urlparse
+from flask import Flask, request, g
 from dotenv import load_dotenv
 
-# 加载.env文件
+# 加载.env文件，必须在导入以下按环境变量配置的模块之前
 load_dotenv()
 
+from http_transport import create_session, shared_session, pool_stats
+from captcha_reuse import CaptchaReuseTracker
+from response_encoding import json_response, dumps, loads
+from warranty_fields import SANGFOR_FIELD_MAP, HUAWEI_FIELD_MAP, EXPIRY_FIELDS, translate_items, normalize_date
+from warranty_store import get_warranty_store, store_result, WARRANTY_FRESH_SECONDS
+from warranty_records import pack_payload, load_payload
+from warranty_export import export_chunks, EXPORT_FORMATS
+from serial_numbers import canonical_serial, canonical_vendor
+from ingest import IngestPlan, IngestError
+from refresh_scheduler import RefreshScheduler, SchedulerLease, REFRESH_ENABLED, days_to_expiry
+from job_queue import JobQueue, JOB_MAX_SIZE
+from warmup import Readiness, ComponentUnavailable
+from page_probe import probe_page, PROBE_MAX_BYTES
+from hedging import Hedger, HEDGE_ENABLED
+from priority_lanes import LaneScheduler, INTERACTIVE, BULK, LANE_BULK_CHUNK, parse_lane, vendor_slots
+from admission import AdmissionController, ConcurrencyLimiter, Overloaded, BatchTooLarge, parse_deadline
+from profiling import RequestProfile, StackSampler, is_admin, PROFILE_SAMPLE_INTERVAL
+from cluster import get_cluster, SharedSessionStore, ClusterJobQueue, export_cookies, import_cookies
+from shm_cache import get_shm_cache
+from proxy_pool import get_proxy_pool, bind_session, session_usable
+from session_store import SessionFile, SESSION_FILE, is_trusted
+from query_failures import (QueryFailure, CaptchaRejected, SessionExpired, ParseError, NotFound, FailureStats,
+                            check_status, failure_kind, failure_stage)
+from stage_pipeline import StagePipeline, PIPELINE_ENABLED, PIPELINE_WORKERS
+
 # 配置日志
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
         logging.FileHandler('service_query_api.log', encoding='utf-8'),
@@ -24,16 +54,81 @@ logging.basicConfig(
 )
 logger = logging.getLogger('ServiceQueryAPI')
 
+# 上游服务地址（可通过环境变量指向本地模拟服务器，用于离线压测）
+SANGFOR_BASE_URL = os.getenv('SANGFOR_BASE_URL', 'https://bbs.sangfor.com.cn').rstrip('/')
+HUAWEI_PORTAL_URL = os.getenv('HUAWEI_PORTAL_URL', 'https://app.huawei.com/escpportal').rstrip('/')
+HUAWEI_ENTRY_URL = os.getenv('HUAWEI_ENTRY_URL', 'https://support.huawei.com/enterprise/ecareWechat?lang=zh')
+OCR_API_URL = os.getenv('OCR_API_URL', 'http://char1es.cn:8888/reg')
+
+# 深信服需要登录时的提示文本
+LOGIN_REQUIRED_TEXT = "您必须先登录后才能进行相关操作"
+LOGINHASH_PATTERN = re.compile(r'loginhash=(\w+)')
+# 服务查询页面超过该字符数视为正常加载
+VERIFY_PAGE_MIN_CHARS = 50000
+
+# 华为查询客户端池中保留的空闲客户端个数
+HUAWEI_CLIENT_POOL_SIZE = int(os.getenv('HUAWEI_CLIENT_POOL_SIZE', '4'))
+
+# 批量查询时每个序列号最多重新识别验证码的次数
+BATCH_MAX_RESOLVES = int(os.getenv('BATCH_MAX_RESOLVES', '5'))
+
+# 查询步骤的对冲器，按上游分别统计延迟
+sangfor_query_hedger = Hedger('sangfor_doquery')
+huawei_query_hedger = Hedger('huawei_query')
+
+# 各厂商查询资源的优先级通道，交互查询与批量任务分开排队
+vendor_lanes = {
+    "sangfor": LaneScheduler('sangfor', vendor_slots('sangfor')),
+    "huawei": LaneScheduler('huawei', vendor_slots('huawei')),
+}
+# 各厂商的准入控制，按排队深度和近期耗时拒绝无法在期限内完成的请求
+vendor_admission = {vendor: AdmissionController(vendor, lanes) for vendor, lanes in vendor_lanes.items()}
+# 同时处理的请求总数限制
+request_limiter = ConcurrencyLimiter()
+
+# 验证码复用统计
+sangfor_captcha_reuse = CaptchaReuseTracker('sangfor')
+huawei_captcha_reuse = CaptchaReuseTracker('huawei')
+# 查询失败分类统计
+failure_stats = FailureStats()
+
+def recognize_image(captcha_image):
+    """调用OCR接口识别一次验证码图片，返回只含大写字母和数字的结果；失败时抛出 QueryFailure"""
+    with failure_stage("ocr"):
+        response = shared_session('ocr').post(
+            OCR_API_URL,
+            headers={"Content-Type": "text/plain"},
+            data=base64.b64encode(captcha_image).decode('utf-8'),
+            timeout=15
+        )
+        check_status(response, "ocr", "识别验证码")
+    captcha_text = re.sub(r'[^A-Z0-9]', '', response.text.strip().upper())
+    logger.info(f"验证码识别结果: {captcha_text}")
+    if not captcha_text:
+        raise CaptchaRejected("验证码识别结果为空", "ocr")
+    return captcha_text
+
+
 class SangforBBSLogin:
-    def __init__(self, username, password, max_retries=3, retry_interval=2, session_file='session.pkl'):
+    def __init__(self, username, password, max_retries=3, retry_interval=2, session_file=SESSION_FILE):
         self.username = username
         self.password = password
         self.session = None
-        self.login_url = "https://bbs.sangfor.com.cn/member.php?mod=logging&action=login"
-        self.target_url = "https://bbs.sangfor.com.cn/plugin.php?id=service:query"
+        self.login_url = f"{SANGFOR_BASE_URL}/member.php?mod=logging&action=login"
+        self.target_url = f"{SANGFOR_BASE_URL}/plugin.php?id=service:query"
         self.max_retries = max_retries
         self.retry_interval = retry_interval
         self.session_file = session_file
+        self.session_store = SessionFile(session_file)
+        # 最近一次确认session有效的时间，信任时长内不再访问网站验证
+        self.validated_at = 0
+        # 多个请求同时发现session失效时只重新登录一次
+        self.relogin_lock = threading.Lock()
+        # 批量查询最近识别的验证码，同一批次的各个分块之间继续使用；验证码与session绑定，重新登录后作废
+        self.ticket = None
+        # 集群模式下的共享session存储，设置后不再读写本地session文件
+        self.shared_sessions = None
+        self.session_version = None
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
@@ -45,31 +140,74 @@ class SangforBBSLogin:
     
     def load_session(self):
         """从文件加载session"""
-        if os.path.exists(self.session_file):
-            try:
-                with open(self.session_file, 'rb') as f:
-                    saved_session = pickle.load(f)
-                logger.info(f"从文件 {self.session_file} 加载session成功")
-                # 验证session是否有效
-                if self._validate_session(saved_session):
-                    self.session = saved_session
-                    return True
-                else:
-                    logger.warning("加载的session无效，需要重新登录")
-                    return False
-            except Exception as e:
-                logger.error(f"加载session失败: {str(e)}")
-                return False
-        else:
+        if self.shared_sessions is not None:
+            return self.load_shared_session()
+        if not self.session_store.exists():
             logger.info(f"session文件 {self.session_file} 不存在，需要重新登录")
             return False
+        saved = self.session_store.load()
+        if not saved or not saved["cookies"]:
+            logger.warning("session文件中没有可用的cookie，需要重新登录")
+            return False
+        try:
+            saved_session = create_session()
+            # 保持原来的出口代理，避免cookie出现在新的IP上；代理已不可用时重新绑定
+            saved_session.proxies.update(saved["proxies"])
+            saved_session = bind_session(saved_session)
+            import_cookies(saved_session.cookies, saved["cookies"])
+        except Exception as e:
+            logger.error(f"加载session失败: {str(e)}")
+            return False
+        logger.info(f"从文件 {self.session_file} 加载session成功")
+        if is_trusted(saved["validated_at"]):
+            logger.info(f"session在 {time.time() - saved['validated_at']:.0f} 秒前验证有效，直接使用")
+            self.session = saved_session
+            self.validated_at = saved["validated_at"]
+            return True
+        # 验证session是否有效
+        if self._validate_session(saved_session):
+            self.session = saved_session
+            self.mark_validated()
+            return True
+        logger.warning("加载的session无效，需要重新登录")
+        return False
+    
+    def load_shared_session(self, newer_only=False):
+        """从集群共享存储加载session；newer_only=True 时只加载其他节点保存的更新版本"""
+        try:
+            version, cookies = self.shared_sessions.load()
+        except Exception as e:
+            logger.error(f"读取共享session失败: {str(e)}")
+            return False
+        if not cookies:
+            logger.info("集群中没有共享的session，需要重新登录")
+            return False
+        if newer_only and version == self.session_version:
+            return False
+        session = bind_session(create_session())
+        import_cookies(session.cookies, cookies)
+        logger.info(f"从集群加载共享session，版本 {version}")
+        if self._validate_session(session):
+            self.session = session
+            self.session_version = version
+            self.validated_at = time.time()
+            return True
+        logger.warning("共享session无效，需要重新登录")
+        return False
     
     def save_session(self):
         """保存session到文件"""
+        if self.session and self.shared_sessions is not None:
+            try:
+                self.session_version = self.shared_sessions.save(export_cookies(self.session.cookies))
+                logger.info(f"session已保存到集群，版本 {self.session_version}")
+                return True
+            except Exception as e:
+                logger.error(f"保存共享session失败: {str(e)}")
+                return False
         if self.session:
             try:
-                with open(self.session_file, 'wb') as f:
-                    pickle.dump(self.session, f)
+                self.session_store.save(self.session, self.validated_at)
                 logger.info(f"session已保存到文件 {self.session_file}")
                 return True
             except Exception as e:
@@ -77,23 +215,29 @@ class SangforBBSLogin:
                 return False
         return False
     
+    def mark_validated(self):
+        """记录session刚确认有效；单机模式同时写入session文件，重启后在信任时长内无需重新验证"""
+        self.validated_at = time.time()
+        if self.shared_sessions is None:
+            self.save_session()
+    
     def _validate_session(self, session):
         """验证session是否有效"""
         try:
             # 尝试访问需要登录的页面
-            test_url = "https://bbs.sangfor.com.cn/home.php?mod=space"
-            response = session.get(test_url, headers=self.headers, timeout=10)
-            response.encoding = "utf-8"
+            test_url = f"{SANGFOR_BASE_URL}/home.php?mod=space"
+            success_indicators = ["个人中心", "欢迎您", "会员", "用户"]
+            # 流式读取页面，找到登录成功的特征即停止
+            probe = probe_page(session, test_url, markers=[LOGIN_REQUIRED_TEXT], stop_markers=success_indicators,
+                               headers=self.headers, timeout=10)
             
             # 检查是否包含登录成功的特征
-            success_indicators = ["个人中心", "欢迎您", "会员", "用户"]
-            for indicator in success_indicators:
-                if indicator in response.text:
-                    logger.info("session验证成功")
-                    return True
+            if probe.first(success_indicators):
+                logger.info("session验证成功")
+                return True
             
             # 检查是否需要登录
-            if "您必须先登录后才能进行相关操作" in response.text:
+            if LOGIN_REQUIRED_TEXT in probe.found:
                 logger.warning("session已过期，需要重新登录")
                 return False
             
@@ -103,32 +247,36 @@ class SangforBBSLogin:
             logger.error(f"验证session时发生错误: {str(e)}")
             return False
     
-    def is_session_valid_for_query(self):
-        """验证当前session是否可以用于查询"""
+    def is_session_valid_for_query(self, trust_recent=True):
+        """验证当前session是否可以用于查询；trust_recent=True 时信任时长内验证过的session不再访问网站"""
         if not self.session:
             logger.warning("session不存在")
             return False
+        if trust_recent and is_trusted(self.validated_at):
+            return True
+        self.validated_at = 0
         
         try:
             # 尝试访问服务查询页面验证session
-            test_url = "https://bbs.sangfor.com.cn/plugin.php?id=service:query"
-            response = self.session.get(test_url, headers=self.headers, timeout=10)
-            response.encoding = "utf-8"
+            test_url = f"{SANGFOR_BASE_URL}/plugin.php?id=service:query"
+            success_indicators = ["服务查询", "设备序列号", "查询"]
+            # 流式读取页面，找到登录成功的特征即停止
+            probe = probe_page(self.session, test_url, markers=[LOGIN_REQUIRED_TEXT], stop_markers=success_indicators,
+                               headers=self.headers, timeout=10)
             
             # 检查是否包含登录成功的特征
-            success_indicators = ["服务查询", "设备序列号", "查询"]
-            for indicator in success_indicators:
-                if indicator in response.text:
-                    logger.info("session可用于查询")
-                    return True
+            if probe.first(success_indicators):
+                logger.info("session可用于查询")
+                self.mark_validated()
+                return True
             
             # 检查是否需要登录
-            if "您必须先登录后才能进行相关操作" in response.text:
+            if LOGIN_REQUIRED_TEXT in probe.found:
                 logger.warning("session已过期，无法用于查询")
                 return False
             
             # 检查是否被重定向到登录页面
-            if "member.php?mod=logging&action=login" in response.url:
+            if "member.php?mod=logging&action=login" in probe.url:
                 logger.warning("session已过期，被重定向到登录页面")
                 return False
             
@@ -164,18 +312,19 @@ class SangforBBSLogin:
     def get_loginhash(self):
         """动态获取loginhash值"""
         logger.info("开始获取loginhash值")
-        response = self.session.get(self.login_url, headers=self.headers, timeout=10)
-        response.encoding = "utf-8"
+        # 流式读取登录页面，匹配到loginhash即停止
+        probe = probe_page(self.session, self.login_url, pattern=LOGINHASH_PATTERN, headers=self.headers, timeout=10)
         
         # 使用正则表达式提取loginhash
-        loginhash_match = re.search(r'loginhash=(\w+)', response.text)
-        if loginhash_match:
-            loginhash = loginhash_match.group(1)
-            logger.info(f"成功获取loginhash: {loginhash}")
+        if probe.match:
+            loginhash = probe.match.group(1)
+            logger.info(f"成功获取loginhash: {loginhash}（读取 {probe.bytes_read} 字节）")
             return loginhash
         else:
-            # 使用BeautifulSoup作为备用方案
+            # 使用BeautifulSoup解析完整页面作为备用方案
             logger.warning("正则表达式提取loginhash失败，尝试使用BeautifulSoup")
+            response = self.session.get(self.login_url, headers=self.headers, timeout=10)
+            response.encoding = "utf-8"
             soup = BeautifulSoup(response.text, 'html.parser')
             form = soup.find('form', id='loginform')
             if form:
@@ -193,12 +342,12 @@ class SangforBBSLogin:
         """执行登录操作"""
         # 1. 初始化session
         if not self.session:
-            self.session = requests.Session()
+            self.session = bind_session(create_session())
             logger.info("已初始化新的session对象")
         
         # 2. 先访问首页，获取初始Cookie
         logger.info("访问首页获取初始Cookie")
-        home_response = self.session.get("https://bbs.sangfor.com.cn", headers=self.headers, timeout=10)
+        home_response = self.session.get(SANGFOR_BASE_URL, headers=self.headers, timeout=10)
         home_response.encoding = "utf-8"
         logger.info(f"首页访问状态码: {home_response.status_code}")
         
@@ -209,11 +358,11 @@ class SangforBBSLogin:
             return False
         
         # 4. 构建完整的登录URL
-        full_login_url = f"https://bbs.sangfor.com.cn/member.php?mod=logging&action=login&loginsubmit=yes&loginhash={loginhash}&inajax=1"
+        full_login_url = f"{SANGFOR_BASE_URL}/member.php?mod=logging&action=login&loginsubmit=yes&loginhash={loginhash}&inajax=1"
         
         # 5. 构建登录数据
         login_data = {
-            "referer": "https%3A%2F%2Fbbs.sangfor.com.cn%2F",
+            "referer": quote(f"{SANGFOR_BASE_URL}/", safe=""),
             "username": self.username,
             "password": self.password,  # 显示密码以便调试
             "cookietime": "2592000"
@@ -228,7 +377,7 @@ class SangforBBSLogin:
             "Connection": "keep-alive",
             "Upgrade-Insecure-Requests": "1",
             "Content-Type": "application/x-www-form-urlencoded",
-            "Referer": f"https://bbs.sangfor.com.cn/member.php?mod=logging&action=login&loginhash={loginhash}"
+            "Referer": f"{SANGFOR_BASE_URL}/member.php?mod=logging&action=login&loginhash={loginhash}"
         }
         
         logger.info("开始执行登录操作")
@@ -253,6 +402,7 @@ class SangforBBSLogin:
         # 10. 验证登录是否成功
         if self.verify_login():
             # 登录成功，保存session
+            self.validated_at = time.time()
             self.save_session()
             logger.info("登录成功并保存session")
             return True
@@ -263,19 +413,35 @@ class SangforBBSLogin:
     def force_login(self):
         """强制重新登录"""
         # 删除旧的session文件
-        if os.path.exists(self.session_file):
-            try:
-                os.remove(self.session_file)
-                logger.info(f"已删除旧的session文件 {self.session_file}")
-            except Exception as e:
-                logger.error(f"删除session文件失败: {str(e)}")
+        if self.shared_sessions is None:
+            self.session_store.remove()
         
         # 初始化新的session
-        self.session = requests.Session()
+        self.session = bind_session(create_session())
+        self.validated_at = 0
+        self.ticket = None
         logger.info("已初始化新的session对象")
         
         # 执行登录
-        return self.login()
+        return self.login_exclusive()
+    
+    def relogin(self, expired_session):
+        """expired_session 失效后重新登录；其他请求已经换上新session时直接使用"""
+        with self.relogin_lock:
+            if self.session is not expired_session and self.session is not None:
+                logger.info("其他请求已重新登录，使用新的session")
+                return True
+            return self.force_login()
+    
+    def login_exclusive(self):
+        """登录；集群模式下持有分布式登录锁，拿到锁后先检查其他节点是否已经完成登录"""
+        if self.shared_sessions is None:
+            return self.login()
+        with self.shared_sessions.login_lock():
+            if self.load_shared_session(newer_only=True):
+                logger.info("其他节点已完成登录，使用共享session")
+                return True
+            return self.login()
     
     @retry_request
     def verify_login(self):
@@ -283,34 +449,34 @@ class SangforBBSLogin:
         logger.info("开始验证登录状态")
         
         # 1. 访问个人中心页面验证登录状态
-        profile_url = "https://bbs.sangfor.com.cn/home.php?mod=space"
-        profile_response = self.session.get(profile_url, headers=self.headers, timeout=10)
-        profile_response.encoding = "utf-8"
+        profile_url = f"{SANGFOR_BASE_URL}/home.php?mod=space"
+        # 检查登录成功的多种可能特征
+        success_indicators = [
+            "个人中心",
+            "欢迎您",
+            "登录成功",
+            "会员",
+            "用户",
+            "退出",
+            "修改资料"
+        ]
+        # 流式读取个人中心页面，找到任一成功标识即停止
+        profile_response = probe_page(self.session, profile_url, markers=["登录", "密码", "账号"],
+                                      stop_markers=success_indicators, headers=self.headers, timeout=10)
         
         logger.info(f"个人中心页面状态码: {profile_response.status_code}")
-        logger.info(f"个人中心页面内容长度: {len(profile_response.text)}")
+        logger.info(f"个人中心页面读取长度: {profile_response.chars}")
         
         # 2. 检查个人中心页面的登录状态
         if profile_response.status_code == 200:
-            # 检查登录成功的多种可能特征
-            success_indicators = [
-                "个人中心",
-                "欢迎您",
-                "登录成功",
-                "会员",
-                "用户",
-                "退出",
-                "修改资料"
-            ]
-            
             # 检查是否包含任何成功标识
-            for indicator in success_indicators:
-                if indicator in profile_response.text:
-                    logger.info(f"登录成功！检测到特征: '{indicator}'")
-                    return True
+            indicator = profile_response.first(success_indicators)
+            if indicator:
+                logger.info(f"登录成功！检测到特征: '{indicator}'")
+                return True
             
             # 检查是否包含登录失败的特征
-            if "登录" in profile_response.text and ("密码" in profile_response.text or "账号" in profile_response.text):
+            if "登录" in profile_response.found and ("密码" in profile_response.found or "账号" in profile_response.found):
                 logger.error("登录失败：可能是账号或密码错误")
                 return False
             
@@ -321,11 +487,13 @@ class SangforBBSLogin:
         
         # 3. 尝试访问服务查询页面验证
         logger.info("尝试访问服务查询页面验证登录状态")
-        response = self.session.get(self.target_url, headers=self.headers, timeout=10)
-        response.encoding = "utf-8"
+        # 读到登录提示或页面长度足以判断时即停止，上限至少要能读到判断所需的长度（UTF-8中文每字3字节）
+        response = probe_page(self.session, self.target_url, stop_markers=[LOGIN_REQUIRED_TEXT],
+                              stop_chars=VERIFY_PAGE_MIN_CHARS, max_bytes=max(PROBE_MAX_BYTES, VERIFY_PAGE_MIN_CHARS * 3),
+                              headers=self.headers, timeout=10)
         
         logger.info(f"服务查询页面状态码: {response.status_code}")
-        logger.info(f"服务查询页面内容长度: {len(response.text)}")
+        logger.info(f"服务查询页面读取长度: {response.chars}")
         
         # 检查是否被重定向到登录页面
         if "member.php?mod=logging&action=login" in response.url:
@@ -333,12 +501,12 @@ class SangforBBSLogin:
             return False
         
         # 检查是否包含登录失败的特征
-        if "您必须先登录后才能进行相关操作" in response.text:
+        if LOGIN_REQUIRED_TEXT in response.found:
             logger.error("登录失败：服务查询页面要求登录")
             return False
         
         # 如果页面长度足够大且状态码为200，也视为成功
-        if len(response.text) > 50000 and response.status_code == 200:
+        if response.chars > VERIFY_PAGE_MIN_CHARS and response.status_code == 200:
             logger.info("登录成功！页面加载正常")
             return True
         
@@ -356,41 +524,38 @@ class SangforBBSLogin:
         
         # 2. 如果加载失败或session无效，进行登录
         logger.info("从文件加载session失败，开始登录")
-        if self.login():
+        if self.login_exclusive():
             logger.info("成功获取登录后的Session对象")
             return self.session
         
         logger.error("获取Session对象失败")
         return None
     
-    def query_service(self, serial_number):
-        """使用当前session查询服务信息"""
+    def open_query_page(self):
+        """访问服务查询页面，同时确认session仍然有效；失败时抛出 QueryFailure"""
         if not self.session:
-            logger.error("会话未初始化，无法查询服务信息")
-            return None
-        
-        # 在查询前验证session是否仍然有效
-        logger.info("验证session是否可用于查询")
-        if not self.is_session_valid_for_query():
-            logger.warning("session已失效，无法进行查询")
-            return None
-        
-        try:
-            # 1. 访问服务查询页面，获取初始内容
+            raise SessionExpired("会话未初始化", "query_page")
+        with failure_stage("query_page"):
             logger.info("访问服务查询页面获取初始内容")
             query_page_response = self.session.get(self.target_url, headers=self.headers, timeout=15)
             query_page_response.encoding = "utf-8"
-            
-            if query_page_response.status_code != 200:
-                logger.error(f"访问服务查询页面失败，状态码: {query_page_response.status_code}")
-                return None
+            check_status(query_page_response, "query_page", "访问服务查询页面")
+            if LOGIN_REQUIRED_TEXT in query_page_response.text or \
+                    "member.php?mod=logging&action=login" in query_page_response.url:
+                self.validated_at = 0
+                raise SessionExpired("session已失效", "query_page")
+            # 能打开查询页面说明session有效
+            self.validated_at = time.time()
             
             # 保存服务查询页面内容
             with open('service_query_debug.html', 'w', encoding='utf-8') as f:
                 f.write(query_page_response.text)
             logger.info("已保存服务查询页面到 service_query_debug.html")
-            
-            # 2. 动态获取验证码信息
+    
+    def fetch_seccode(self):
+        """动态获取验证码信息并下载验证码图片，返回 (idhash, 图片内容)；失败时抛出 QueryFailure"""
+        with failure_stage("captcha"):
+            # 1. 动态获取验证码信息
             logger.info("动态获取验证码信息")
             
             # 生成随机数
@@ -398,7 +563,7 @@ class SangforBBSLogin:
             update_random = random.randint(10000, 99999)
             
             # 构建验证码更新URL
-            captcha_update_url = f"https://bbs.sangfor.com.cn/misc.php?mod=seccode&action=update&idhash=cSjSGo8w&{random_num}&modid=plugin::service"
+            captcha_update_url = f"{SANGFOR_BASE_URL}/misc.php?mod=seccode&action=update&idhash=cSjSGo8w&{random_num}&modid=plugin::service"
             logger.info(f"验证码更新URL: {captcha_update_url}")
             
             # 发送验证码更新请求
@@ -420,10 +585,10 @@ class SangforBBSLogin:
                 idhash = "cSjSGo8w"
             
             # 构建验证码图片URL
-            captcha_img_url = f"https://bbs.sangfor.com.cn/misc.php?mod=seccode&update={update_random}&idhash={idhash}"
+            captcha_img_url = f"{SANGFOR_BASE_URL}/misc.php?mod=seccode&update={update_random}&idhash={idhash}"
             logger.info(f"验证码图片URL: {captcha_img_url}")
             
-            # 3. 获取验证码图片
+            # 2. 获取验证码图片
             logger.info("获取验证码图片")
             captcha_headers = {
                 "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
@@ -431,167 +596,86 @@ class SangforBBSLogin:
                 "Accept-Language": "zh-CN,zh;q=0.9",
                 "Accept-Encoding": "gzip, deflate, br",
                 "Connection": "keep-alive",
-                "Referer": "https://bbs.sangfor.com.cn/plugin.php?id=service:query"
+                "Referer": f"{SANGFOR_BASE_URL}/plugin.php?id=service:query"
             }
             
             # 下载验证码图片
             img_response = self.session.get(captcha_img_url, headers=captcha_headers, timeout=10)
-            
-            if img_response.status_code == 200:
-                # 保存验证码图片
-                with open('captcha_debug.jpg', 'wb') as f:
-                    f.write(img_response.content)
-                logger.info(f"已保存验证码图片到 captcha_debug.jpg，大小: {len(img_response.content)} 字节")
-                
-                # 使用用户提供的API接口识别验证码
-                import base64
-                max_retries = 5
-                retry_count = 0
-                captcha_text = "ABCD"
-                
-                while retry_count < max_retries:
-                    try:
-                        # 将验证码图片转换为base64编码
-                        img_base64 = base64.b64encode(img_response.content).decode('utf-8')
-                        
-                        # 构建API请求
-                        api_url = "http://char1es.cn:8888/reg"
-                        api_headers = {"Content-Type": "text/plain"}
-                        
-                        logger.info(f"使用API接口识别验证码 (尝试 {retry_count + 1}/{max_retries})")
-                        # 发送POST请求到API接口
-                        api_response = self.session.post(
-                            api_url,
-                            headers=api_headers,
-                            data=img_base64,
-                            timeout=15
-                        )
-                        
-                        # 记录API响应详情
-                        logger.info(f"API响应状态码: {api_response.status_code}")
-                        logger.info(f"API响应内容: {api_response.text}")
-                        logger.info(f"API响应头: {dict(api_response.headers)}")
-                        
-                        if api_response.status_code == 200:
-                            # 获取API返回的验证码
-                            try:
-                                # 尝试解码响应内容
-                                raw_response = api_response.text
-                                logger.info(f"原始API响应: {raw_response}")
-                                
-                                # 清理和处理响应结果
-                                captcha_text = raw_response.strip().upper()
-                                # 清理返回结果，只保留字母和数字
-                                captcha_text = re.sub(r'[^A-Z0-9]', '', captcha_text)
-                                
-                                logger.info(f"处理后的验证码识别结果: {captcha_text}")
-                                
-                                # 验证验证码长度
-                                if len(captcha_text) == 4:
-                                    logger.info("验证码长度正确，使用该验证码")
-                                    break
-                                else:
-                                    logger.warning(f"验证码长度不正确: {captcha_text}，重新获取验证码图片")
-                                    # 验证码长度不正确，重新获取验证码图片
-                                    retry_count += 1
-                                    if retry_count < max_retries:
-                                        # 重新获取验证码图片
-                                        logger.info("重新获取验证码图片...")
-                                        update_random = random.randint(10000, 99999)
-                                        captcha_img_url = f"https://bbs.sangfor.com.cn/misc.php?mod=seccode&update={update_random}&idhash={idhash}"
-                                        img_response = self.session.get(captcha_img_url, headers=captcha_headers, timeout=10)
-                                        if img_response.status_code == 200:
-                                            # 更新保存的验证码图片
-                                            with open('captcha_debug.jpg', 'wb') as f:
-                                                f.write(img_response.content)
-                                            logger.info(f"已重新保存验证码图片，大小: {len(img_response.content)} 字节")
-                                            # 继续下一次尝试
-                                            continue
-                                        else:
-                                            logger.error(f"重新获取验证码图片失败，状态码: {img_response.status_code}")
-                                            retry_count += 1
-                                    else:
-                                        logger.warning("已达到最大重试次数，使用默认验证码")
-                                        break
-                            except Exception as decode_e:
-                                logger.error(f"解码验证码响应失败: {str(decode_e)}")
-                                retry_count += 1
-                                if retry_count < max_retries:
-                                    logger.info(f"{retry_count}秒后重试...")
-                                    time.sleep(retry_count)  # 递增等待时间
-                                else:
-                                    logger.warning("已达到最大重试次数，解码失败")
-                        else:
-                            logger.error(f"API请求失败，状态码: {api_response.status_code}")
-                            retry_count += 1
-                            if retry_count < max_retries:
-                                logger.info(f"{retry_count}秒后重试...")
-                                time.sleep(retry_count)
-                            else:
-                                logger.warning("已达到最大重试次数，使用默认验证码")
-                    except requests.Timeout as timeout_e:
-                        logger.error(f"API识别超时: {str(timeout_e)}")
-                        retry_count += 1
-                        if retry_count < max_retries:
-                            logger.info(f"{retry_count}秒后重试...")
-                            time.sleep(retry_count)
-                        else:
-                            logger.warning("已达到最大重试次数，使用默认验证码")
-                    except requests.RequestException as req_e:
-                        logger.error(f"API请求异常: {str(req_e)}")
-                        retry_count += 1
-                        if retry_count < max_retries:
-                            logger.info(f"{retry_count}秒后重试...")
-                            time.sleep(retry_count)
-                        else:
-                            logger.warning("已达到最大重试次数，使用默认验证码")
-                    except Exception as api_e:
-                        logger.error(f"API识别失败: {str(api_e)}")
-                        retry_count += 1
-                        if retry_count < max_retries:
-                            logger.info(f"{retry_count}秒后重试...")
-                            time.sleep(retry_count)
-                        else:
-                            logger.warning("已达到最大重试次数，使用默认验证码")
-            else:
-                logger.error(f"获取验证码图片失败，状态码: {img_response.status_code}")
-                captcha_text = "ABCD"
-            
-            logger.info(f"最终使用idhash: {idhash}, 验证码: {captcha_text}")
-            
-            # 4. 构建查询请求
-            logger.info("构建查询请求")
-            
-            # 构建完整的查询URL
-            query_url = f"https://bbs.sangfor.com.cn/plugin.php?id=service:query&op=doquery&type=svrstate&seccodeverify={captcha_text}&seccodehash={idhash}&seccodemodid=plugin::service&svrid={serial_number}"
-            logger.info(f"完整查询URL: {query_url}")
-            
-            # 构建查询请求头
-            request_headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; WOW64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.6285.209 Safari/537.36",
-                "Accept": "application/json, text/plain, */*",
-                "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8,zh-TW;q=0.7",
-                "Accept-Encoding": "gzip, deflate, br",
-                "Content-Type": "application/x-www-form-urlencoded;charset=UTF-8",
-                "X-Requested-With": "XMLHttpRequest",
-                "Origin": "https://bbs.sangfor.com.cn",
-                "Referer": "https://bbs.sangfor.com.cn/plugin.php?id=service:query",
-                "Sec-Fetch-Site": "same-origin",
-                "Sec-Fetch-Mode": "cors",
-                "Sec-Fetch-Dest": "empty",
-                "Pragma": "no-cache",
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive"
-            }
-            
-            # 构建查询数据
-            query_data = "ajaxdata=json"
-            logger.info(f"查询数据: {query_data}")
-            
-            # 5. 发送查询请求
-            logger.info("发送服务查询请求")
-            service_response = self.session.post(
+            check_status(img_response, "captcha", "获取验证码图片")
+        
+        # 保存验证码图片
+        with open('captcha_debug.jpg', 'wb') as f:
+            f.write(img_response.content)
+        logger.info(f"已保存验证码图片到 captcha_debug.jpg，大小: {len(img_response.content)} 字节")
+        return idhash, img_response.content
+    
+    def recognize_seccode(self, captcha_image):
+        """识别验证码图片，结果不是4位时抛出 CaptchaRejected"""
+        captcha_text = recognize_image(captcha_image)
+        if len(captcha_text) != 4:
+            raise CaptchaRejected(f"验证码长度不正确: {captcha_text}", "ocr")
+        return captcha_text
+    
+    def solve_seccode(self):
+        """动态获取验证码并识别，返回 (idhash, 验证码)；识别失败时重新获取验证码图片，失败时抛出 QueryFailure"""
+        max_retries = 5
+        failure = None
+        for retry_count in range(max_retries):
+            idhash, captcha_image = self.fetch_seccode()
+            try:
+                logger.info(f"使用API接口识别验证码 (尝试 {retry_count + 1}/{max_retries})")
+                captcha_text = self.recognize_seccode(captcha_image)
+                logger.info(f"最终使用idhash: {idhash}, 验证码: {captcha_text}")
+                return idhash, captcha_text
+            except QueryFailure as e:
+                failure = e
+                logger.warning(f"识别验证码失败（{e.kind}）: {str(e)}，重新获取验证码图片")
+                if not isinstance(e, CaptchaRejected) and retry_count + 1 < max_retries:
+                    # OCR接口异常时递增等待
+                    logger.info(f"{retry_count + 1}秒后重试...")
+                    time.sleep(retry_count + 1)
+        logger.warning("已达到最大重试次数，验证码识别失败")
+        raise failure
+    
+    def doquery(self, serial_number, idhash, captcha_text, ticket=None):
+        """使用已识别的验证码查询单个设备序列号，返回原始响应内容；ticket 为复用的验证码，对冲时多计一次使用次数"""
+        # 1. 构建查询请求
+        logger.info("构建查询请求")
+        
+        # 构建完整的查询URL
+        query_url = f"{SANGFOR_BASE_URL}/plugin.php?id=service:query&op=doquery&type=svrstate&seccodeverify={captcha_text}&seccodehash={idhash}&seccodemodid=plugin::service&svrid={serial_number}"
+        logger.info(f"完整查询URL: {query_url}")
+        
+        # 构建查询请求头
+        request_headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; WOW64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.6285.209 Safari/537.36",
+            "Accept": "application/json, text/plain, */*",
+            "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8,zh-TW;q=0.7",
+            "Accept-Encoding": "gzip, deflate, br",
+            "Content-Type": "application/x-www-form-urlencoded;charset=UTF-8",
+            "X-Requested-With": "XMLHttpRequest",
+            "Origin": SANGFOR_BASE_URL,
+            "Referer": f"{SANGFOR_BASE_URL}/plugin.php?id=service:query",
+            "Sec-Fetch-Site": "same-origin",
+            "Sec-Fetch-Mode": "cors",
+            "Sec-Fetch-Dest": "empty",
+            "Pragma": "no-cache",
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive"
+        }
+        
+        # 构建查询数据
+        query_data = "ajaxdata=json"
+        logger.info(f"查询数据: {query_data}")
+        
+        # 2. 发送查询请求
+        logger.info("发送服务查询请求")
+        with failure_stage("query"):
+            service_response = sangfor_query_hedger.request(
+                self.session,
+                'POST',
                 query_url,
+                on_hedge=(lambda: sangfor_captcha_reuse.hedged(ticket)) if ticket is not None else None,
                 headers=request_headers,
                 data=query_data,
                 timeout=15,
@@ -603,15 +687,70 @@ class SangforBBSLogin:
             logger.info(f"查询响应头: {dict(service_response.headers)}")
             
             # 检查响应
-            if service_response.status_code == 200:
-                logger.info("查询服务信息成功")
-                return service_response.text
-            else:
-                logger.error(f"查询服务信息失败，状态码: {service_response.status_code}")
-                return None
-        except Exception as e:
-            logger.error(f"查询服务信息异常: {str(e)}")
-            return None
+            check_status(service_response, "query", "查询服务信息")
+        logger.info("查询服务信息成功")
+        return service_response.text
+    
+    def solve_query_captcha(self):
+        """获取并识别查询验证码，网络异常转换为 QueryFailure"""
+        with failure_stage("captcha"):
+            return self.solve_seccode()
+    
+    def query_service_many(self, serial_numbers):
+        """批量查询：同一个验证码连续用于多个序列号，仅在被拒绝或接近复用上限时重新识别，逐个返回 (序列号, 原始响应内容)"""
+        if not self.session or not self.is_session_valid_for_query():
+            logger.warning("session不可用，需要重新登录")
+            if not self.force_login():
+                logger.error("重新登录失败，无法进行批量查询")
+                for serial_number in serial_numbers:
+                    yield serial_number, None
+                return
+        
+        # 沿用上一次批量查询（例如同一批次的上一个分块）留下的验证码
+        ticket = self.ticket
+        for serial_number in serial_numbers:
+            service_result = None
+            for attempt in range(BATCH_MAX_RESOLVES):
+                try:
+                    if sangfor_captcha_reuse.should_resolve(ticket):
+                        ticket = sangfor_captcha_reuse.new_ticket(self.solve_query_captcha())
+                    idhash, captcha_text = ticket.value
+                    service_result = self.doquery(serial_number, idhash, captcha_text, ticket)
+                    try:
+                        classify_sangfor_result(service_result)
+                    except NotFound:
+                        pass
+                    sangfor_captcha_reuse.accepted(ticket)
+                    break
+                except CaptchaRejected as e:
+                    failure_stats.record("sangfor", e)
+                    if ticket is not None:
+                        logger.info(f"验证码已被拒绝（已使用 {ticket.uses} 次，{ticket.age:.1f} 秒），重新识别")
+                        sangfor_captcha_reuse.rejected(ticket)
+                    else:
+                        # 还没有可用的验证码（识别失败），重试该序列号
+                        logger.warning(f"批量查询 {serial_number} 验证码识别失败: {str(e)}")
+                    ticket = None
+                    service_result = None
+                except SessionExpired as e:
+                    logger.warning("批量查询中session已失效，重新登录")
+                    failure_stats.record("sangfor", e)
+                    ticket = None
+                    service_result = None
+                    if not self.force_login():
+                        break
+                except QueryFailure as e:
+                    # 上游错误、超时或响应无法解析：验证码仍可使用，只重试失败的步骤
+                    logger.warning(f"批量查询 {serial_number} 失败（{e.stage}: {e.kind}）: {str(e)}")
+                    failure_stats.record("sangfor", e)
+                    service_result = None
+                    time.sleep(attempt + 1)
+                except Exception as e:
+                    logger.error(f"批量查询 {serial_number} 异常: {str(e)}")
+                    ticket = None
+                    service_result = None
+            self.ticket = ticket
+            yield serial_number, service_result
 
 # 创建Flask应用
 app = Flask(__name__)
@@ -619,29 +758,356 @@ app = Flask(__name__)
 # 配置Flask以确保中文正确显示
 app.config['JSON_AS_ASCII'] = False
 
+# 健康检查和统计接口不受并发限制，繁忙时仍可查看服务状态
+# 变更订阅是长连接，不占用处理名额
+ADMISSION_EXEMPT_PATHS = ('/healthz', '/readyz', '/stats/', '/warranty/changes')
+
+# 后台预热、异步任务和刷新调度器是否已在本进程中启动
+background_started = False
+background_lock = threading.Lock()
+
+def start_background():
+    """在本进程中启动后台预热、异步任务工作线程和后台刷新调度器，重复调用只启动一次
+
+    直接运行时在启动时调用；gunicorn 等多进程部署下每个工作进程在处理第一个请求时调用，
+    不在导入时启动，避免 --preload 时线程创建在 fork 之前的主进程里。
+    """
+    global background_started
+    if background_started:
+        return
+    with background_lock:
+        if background_started:
+            return
+        # 后台预热：深信服登录、华为客户端池、OCR模型和上游连接，不阻塞端口监听
+        logger.info("启动后台预热，可通过 /readyz 查看各组件就绪状态")
+        readiness.start()
+        
+        # 启动异步任务工作线程，恢复上次未完成的任务
+        get_job_queue()
+        
+        # 启动后台刷新调度器
+        if REFRESH_ENABLED:
+            logger.info("启动后台刷新调度器")
+            get_refresh_scheduler().start()
+        background_started = True
+
+@app.before_request
+def ensure_background():
+    """工作进程收到第一个请求（包括 /readyz 探测）时启动后台组件"""
+    start_background()
+
+@app.before_request
+def limit_concurrency():
+    """同时处理的请求过多时直接返回429"""
+    if request.path.startswith(ADMISSION_EXEMPT_PATHS):
+        return None
+    if not request_limiter.try_enter():
+        return overloaded_response(Overloaded("服务繁忙，同时处理的请求过多"))
+    g.admission_entered = True
+    return None
+
+@app.teardown_request
+def release_concurrency(exc=None):
+    if g.pop('admission_entered', False):
+        request_limiter.leave()
+
+def request_admin_token():
+    """请求中的管理员令牌：X-Admin-Token 请求头或 admin_token 参数"""
+    return request.headers.get('X-Admin-Token') or request.args.get('admin_token')
+
+@app.before_request
+def start_request_profile():
+    """带 X-Profile 请求头或 profile 参数的管理员请求，剖析整个请求的处理过程"""
+    mode = request.headers.get('X-Profile') or request.args.get('profile')
+    if not mode:
+        return None
+    if not is_admin(request_admin_token()):
+        return json_response({"success": 0, "message": "需要管理员令牌"}, status=403)
+    profile = RequestProfile()
+    if not profile.start():
+        return json_response({"success": 0, "message": "已有请求正在剖析，请稍后重试"}, status=409)
+    g.profile = profile
+    g.profile_mode = mode
+    return None
+
+@app.after_request
+def finish_request_profile(response):
+    """用剖析报告替换原响应，原响应的状态码放在 X-Profiled-Status 中"""
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    profile.stop()
+    headers = {"X-Profiled-Status": str(response.status_code)}
+    if g.profile_mode == 'pstats':
+        return app.response_class(profile.dump(), mimetype='application/octet-stream', headers=dict(
+            headers, **{"Content-Disposition": "attachment; filename=request.prof"}))
+    sort = request.args.get('profile_sort', 'cumulative')
+    if sort not in ('cumulative', 'tottime', 'calls'):
+        sort = 'cumulative'
+    return json_response({"success": 1, "data": profile.report(sort)}, headers=headers)
+
+@app.teardown_request
+def stop_request_profile(exc=None):
+    # 请求处理异常时 after_request 不会执行，在这里停止剖析
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.stop()
+
 # 全局登录客户端实例
 login_client = None
 
+def get_request_serial_number(vendor):
+    """从GET参数、JSON请求体或表单中获取设备序列号，并按厂商规则规范化"""
+    if request.method == 'GET':
+        value = request.args.get('sn')
+    else:
+        value = request.json.get('sn') if request.is_json else request.form.get('sn')
+    return canonical_serial(vendor, value)
+
+def get_request_serial_numbers(vendor):
+    """获取批量查询的序列号列表：JSON请求体中的数组，或以逗号分隔的参数，规范化后去重并保持顺序"""
+    if request.is_json:
+        value = request.json.get('sn') or []
+    else:
+        value = request.values.get('sn', '')
+    if isinstance(value, str):
+        value = value.split(',')
+    serial_numbers = []
+    for serial_number in value:
+        serial_number = canonical_serial(vendor, serial_number)
+        if serial_number and serial_number not in serial_numbers:
+            serial_numbers.append(serial_number)
+    return serial_numbers
+
+def get_request_devices():
+    """获取设备清单：JSON请求体中的 devices 数组（[{"vendor": ..., "sn": ...}]），或 vendor 参数加序列号列表"""
+    if request.is_json and isinstance(request.json.get('devices'), list):
+        devices = []
+        for device in request.json['devices']:
+            if isinstance(device, dict):
+                vendor = canonical_vendor(device.get('vendor')) or str(device.get('vendor', '')).strip()
+                devices.append((vendor, canonical_serial(vendor, device.get('sn'))))
+        return devices
+    value = (request.json.get('vendor') if request.is_json else request.values.get('vendor')) or ''
+    vendor = canonical_vendor(value) or value.strip()
+    return [(vendor, serial_number) for serial_number in get_request_serial_numbers(vendor)]
+
+def request_refresh():
+    """请求参数 refresh=1 表示强制查询厂商网站"""
+    if request.is_json:
+        return str(request.json.get('refresh', '')) in ('1', 'True', 'true')
+    return request.values.get('refresh') == '1'
+
+def request_lane(default):
+    """请求的优先级通道：X-Priority 请求头或 priority 参数（interactive/bulk）"""
+    value = request.headers.get('X-Priority') or request.values.get('priority')
+    if not value and request.is_json:
+        value = request.json.get('priority')
+    return parse_lane(value, default)
+
+def request_deadline():
+    """请求的期限（秒）：X-Request-Timeout 请求头或 timeout 参数"""
+    value = request.headers.get('X-Request-Timeout') or request.values.get('timeout')
+    if not value and request.is_json:
+        value = request.json.get('timeout')
+    return parse_deadline(value)
+
+def admit(vendor, lane, units=1):
+    """准入检查，预计无法在请求期限内完成时抛出 Overloaded，否则返回截止时刻"""
+    return vendor_admission[vendor].admit(lane, request_deadline(), units)
+
+def overloaded_response(error):
+    """繁忙时的429响应"""
+    return json_response({
+        "success": 0,
+        "message": str(error)
+    }, status=429, headers={"Retry-After": str(error.retry_after)})
+
+def batch_too_large_response(error):
+    """批量请求超过期限内可完成的个数时的400响应"""
+    max_serials = error.max_units * LANE_BULK_CHUNK
+    return json_response({
+        "success": 0,
+        "message": f"{error}，期限内最多约可查询 {max_serials} 个序列号，请分批查询或通过 POST /jobs 异步提交",
+        "data": {"max_serials": max_serials}
+    }, status=400)
+
+def run_in_lane(vendor, lane, runner, *args, deadline=None):
+    """在厂商的优先级通道中占用名额执行查询，排队超过截止时刻 deadline 时抛出 Overloaded"""
+    lanes = vendor_lanes[vendor]
+    timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+    if lanes.acquire(lane, timeout) is None:
+        raise vendor_admission[vendor].deadline_exceeded(lane)
+    start = time.perf_counter()
+    try:
+        return runner(*args)
+    finally:
+        lanes.release(lane)
+        vendor_admission[vendor].record(lane, time.perf_counter() - start)
+
+def fresh_result(vendor, serial_number, refresh=False):
+    """返回本地保存且未过期的查询结果，refresh=True 时返回 None"""
+    if refresh:
+        return None
+    shm_cache = get_shm_cache()
+    if shm_cache is not None:
+        # 本机其他工作进程查询过的结果
+        try:
+            payload = load_payload(vendor, shm_cache.get_json(f"{vendor}:{serial_number}"))
+            if payload is not None:
+                return payload
+        except Exception as e:
+            logger.error(f"读取共享缓存失败: {str(e)}")
+    try:
+        payload = get_warranty_store().fresh(vendor, serial_number)
+    except Exception as e:
+        logger.error(f"读取本地维保记录失败: {str(e)}")
+        payload = None
+    cluster = get_cluster()
+    if payload is None and cluster is not None:
+        # 其他节点查询过的结果
+        try:
+            payload = load_payload(vendor, cluster.cached_result(vendor, serial_number))
+        except Exception as e:
+            logger.error(f"读取集群结果缓存失败: {str(e)}")
+    return payload
+
+def remember_result(vendor, serial_number, payload):
+    """保存查询结果，并通知后台刷新调度器该设备已是最新数据"""
+    store_result(vendor, serial_number, payload)
+    shm_cache = get_shm_cache()
+    if payload.get("success") == 1 and shm_cache is not None and WARRANTY_FRESH_SECONDS > 0:
+        try:
+            shm_cache.set_json(f"{vendor}:{serial_number}", pack_payload(vendor, payload), WARRANTY_FRESH_SECONDS)
+        except Exception as e:
+            logger.error(f"写入共享缓存失败: {str(e)}")
+    cluster = get_cluster()
+    if payload.get("success") == 1 and cluster is not None:
+        try:
+            cluster.cache_result(vendor, serial_number, pack_payload(vendor, payload), WARRANTY_FRESH_SECONDS)
+        except Exception as e:
+            logger.error(f"写入集群结果缓存失败: {str(e)}")
+    if payload.get("success") == 1 and refresh_scheduler is not None:
+        refresh_scheduler.refreshed_elsewhere(
+            vendor, serial_number, get_warranty_store().expiry_dates(vendor, serial_number))
+
+def lookup(vendor, serial_number, runner):
+    """在优先级通道中查询单个序列号并保存结果；集群模式下同一序列号同一时间只由一个节点查询，其他节点等待共享结果，后端不可用时直接查询"""
+    lane = request_lane(INTERACTIVE)
+    deadline = admit(vendor, lane)
+    
+    def query():
+        payload = run_in_lane(vendor, lane, runner, serial_number, deadline=deadline)
+        remember_result(vendor, serial_number, payload)
+        return payload
+    
+    cluster = get_cluster()
+    if cluster is None:
+        return query()
+    return cluster.single_flight(f"query:{vendor}:{serial_number}", query,
+                                 lambda: load_payload(vendor, cluster.cached_result(vendor, serial_number)))
+
+def classify_sangfor_result(service_result):
+    """对深信服查询响应分类：有记录时返回响应数据，否则抛出对应的 QueryFailure（厂商答复没有记录时为 NotFound）"""
+    if LOGIN_REQUIRED_TEXT in service_result:
+        raise SessionExpired("session已失效", "query")
+    try:
+        result = loads(service_result)
+    except ValueError:
+        raise ParseError("解析结果失败", "parse")
+    if not isinstance(result, dict):
+        raise ParseError("解析结果失败", "parse")
+    if result.get("success") == -2:
+        raise CaptchaRejected("验证码错误", "query")
+    if "您必须先登录" in str(result.get("message") or ""):
+        raise SessionExpired("session已失效", "query")
+    if isinstance(result.get("data"), list):
+        payload = {"success": 1, "data": translate_items(result["data"], SANGFOR_FIELD_MAP)}
+        if not result["data"]:
+            raise NotFound("未查询到维保记录", "query", payload)
+        return payload
+    if result.get("success") == 1:
+        return result
+    # 厂商明确答复的其他结果（如序列号不存在）原样返回并标记为没有记录，不再重试
+    raise NotFound(result.get("message") or "未查询到维保记录", "query", dict(result, failure=NotFound.kind))
+
+def parse_sangfor_result(service_result):
+    """将深信服原始响应转换为响应数据"""
+    if not service_result:
+        return {"success": 0, "message": "服务查询失败", "failure": QueryFailure.kind}
+    try:
+        return classify_sangfor_result(service_result)
+    except NotFound as e:
+        return e.payload
+    except QueryFailure as e:
+        return {"success": 0, "message": str(e), "failure": e.kind}
+
+def classify_huawei_result(service_result):
+    """对华为查询响应分类：有记录时返回响应数据，否则抛出对应的 QueryFailure（没有记录时为 NotFound）"""
+    try:
+        result = loads(service_result)
+    except ValueError:
+        raise ParseError("解析华为查询结果失败", "parse")
+    if not isinstance(result, list):
+        # 验证码失效时华为返回错误对象而不是记录列表
+        raise CaptchaRejected("华为验证码已失效", "query")
+    payload = {"success": 1, "data": translate_items(result, HUAWEI_FIELD_MAP)}
+    if not result:
+        raise NotFound("未查询到维保记录", "query", payload)
+    return payload
+
+def parse_huawei_result(service_result):
+    """将华为原始响应转换为响应数据"""
+    if not service_result:
+        return {"success": 0, "message": "华为服务查询失败", "failure": QueryFailure.kind}
+    try:
+        return classify_huawei_result(service_result)
+    except NotFound as e:
+        return e.payload
+    except ParseError as e:
+        return {"success": 0, "message": str(e), "failure": e.kind}
+    except QueryFailure as e:
+        return {"success": 0, "message": "华为服务查询失败", "failure": e.kind}
+
 @app.route('/sn_query/sangfor', methods=['GET', 'POST'])
 def query_service_sangfor():
     """API接口：查询深信服设备维保信息"""
     try:
-        # 获取设备序列号
-        if request.method == 'GET':
-            serial_number = request.args.get('sn')
-        else:
-            serial_number = request.json.get('sn') if request.is_json else request.form.get('sn')
-        
+        serial_number = get_request_serial_number("sangfor")
         if not serial_number:
-            return jsonify({
+            return json_response({
                 "success": 0,
                 "message": "设备序列号不能为空"
             })
         
         logger.info(f"收到深信服查询请求，设备序列号: {serial_number}")
-        
-        # 确保登录客户端已初始化
-        global login_client
+        payload = fresh_result("sangfor", serial_number, request_refresh())
+        if payload is None:
+            payload = lookup("sangfor", serial_number, run_sangfor_query)
+        return json_response(payload)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        logger.error(f"API请求异常: {str(e)}")
+        return json_response({
+            "success": 0,
+            "message": f"请求异常: {str(e)}"
+        })
+
+login_client_lock = threading.Lock()
+
+def use_shared_session(client):
+    """集群模式下让深信服登录客户端使用集群共享的session"""
+    cluster = get_cluster()
+    if cluster is not None:
+        client.shared_sessions = SharedSessionStore(cluster, 'sangfor')
+    return client
+
+def ensure_login_client():
+    """确保深信服登录客户端已初始化并持有session"""
+    global login_client
+    # 后台预热与请求可能同时到达，加锁避免重复登录
+    with login_client_lock:
         if not login_client:
             # 从环境变量读取登录信息
             username = os.getenv('SANGFOR_USERNAME', '19533323645')  # 默认值作为备用
@@ -649,171 +1115,78 @@ def query_service_sangfor():
             
             # 创建登录客户端实例
             logger.info("创建登录客户端实例")
-            login_client = SangforBBSLogin(username, password)
+            login_client = use_shared_session(SangforBBSLogin(username, password))
         
         # 确保获取有效的session
         if not login_client.session:
             logger.info("获取session")
             login_client.get_session()
-        
-        # 执行服务查询，添加失败重试机制
-        logger.info("执行服务查询")
-        max_retries = 5
-        retry_count = 0
-        service_result = None
-        
-        while retry_count < max_retries:
-            try:
-                logger.info(f"执行服务查询 (尝试 {retry_count + 1}/{max_retries})")
-                service_result = login_client.query_service(serial_number)
-                
-                if service_result:
-                    logger.info(f"服务查询成功")
-                    # 解析结果
-                    import json
-                    try:
-                        result = json.loads(service_result)
-                        # 检查是否是验证码错误
-                        if result.get("success") == -2:
-                            logger.warning("服务查询失败: 验证码错误，准备重试")
-                            retry_count += 1
-                            if retry_count < max_retries:
-                                wait_time = retry_count
-                                logger.info(f"{wait_time}秒后重试...")
-                                time.sleep(wait_time)
-                            else:
-                                logger.error("已达到最大重试次数，服务查询失败")
-                                return jsonify({
-                                    "success": 0,
-                                    "message": "服务查询失败: 验证码错误"
-                                })
-                        # 检查是否是session失效
-                        elif "您必须先登录后才能进行相关操作" in service_result or (result.get("message") and "您必须先登录" in result.get("message", "")):
-                            logger.warning("服务查询失败: session已失效，准备重新登录")
-                            # 强制重新登录
-                            if login_client.force_login():
-                                logger.info("重新登录成功，准备重试查询")
-                                retry_count += 1
-                                if retry_count < max_retries:
-                                    wait_time = retry_count
-                                    logger.info(f"{wait_time}秒后重试...")
-                                    time.sleep(wait_time)
-                                else:
-                                    logger.error("已达到最大重试次数，服务查询失败")
-                                    return jsonify({
-                                        "success": 0,
-                                        "message": "服务查询失败: session失效且重试次数过多"
-                                    })
-                            else:
-                                logger.error("重新登录失败")
-                                return jsonify({
-                                    "success": 0,
-                                    "message": "服务查询失败: 重新登录失败"
-                                })
-                        else:
-                            # 解析服务查询成功的响应结果
-                            if "data" in result and isinstance(result["data"], list):
-                                # 处理data数组中的每个元素
-                                parsed_data = []
-                                for item in result["data"]:
-                                    parsed_item = {
-                                        "序列号": item.get("rnum", ""),
-                                        "网关id": item.get("rid", ""),
-                                        "设备型号": item.get("pdName", ""),
-                                        "服务商名称": item.get("cti_channame", ""),
-                                        "服务电话": item.get("cit_chanphone", ""),
-                                        "网络远程支持有效期": item.get("cti_day2_800", ""),
-                                        "同等功能软件升级有效期": item.get("cti_day2_up", ""),
-                                        "硬件维保有效期": item.get("cit_day2_rb", "")
-                                    }
-                                    parsed_data.append(parsed_item)
-                                
-                                parsed_result = {
-                                    "success": 1,
-                                    "data": parsed_data
-                                }
-                                # 使用json.dumps确保中文正确显示
-                                import json
-                                from flask import Response
-                                return Response(
-                                    json.dumps(parsed_result, ensure_ascii=False),
-                                    mimetype='application/json'
-                                )
-                            else:
-                                return jsonify(result)
-                    except json.JSONDecodeError as e:
-                        logger.error(f"解析JSON失败: {str(e)}")
-                        retry_count += 1
-                        if retry_count < max_retries:
-                            wait_time = retry_count
-                            logger.info(f"{wait_time}秒后重试...")
-                            time.sleep(wait_time)
-                        else:
-                            logger.error("已达到最大重试次数，解析结果失败")
-                            return jsonify({
-                                "success": 0,
-                                "message": "解析结果失败"
-                            })
-                else:
-                    logger.warning("服务查询失败，准备重试")
-                    # 检查是否是session失效导致的失败
-                    if not login_client.is_session_valid_for_query():
-                        logger.warning("检测到session已失效，准备重新登录")
-                        if login_client.force_login():
-                            logger.info("重新登录成功，准备重试查询")
-                            retry_count += 1
-                            if retry_count < max_retries:
-                                wait_time = retry_count
-                                logger.info(f"{wait_time}秒后重试...")
-                                time.sleep(wait_time)
-                            else:
-                                logger.error("已达到最大重试次数，服务查询失败")
-                                return jsonify({
-                                    "success": 0,
-                                    "message": "服务查询失败: session失效且重试次数过多"
-                                })
-                        else:
-                            logger.error("重新登录失败")
-                            return jsonify({
-                                "success": 0,
-                                "message": "服务查询失败: 重新登录失败"
-                            })
-                    else:
-                        retry_count += 1
-                        if retry_count < max_retries:
-                            wait_time = retry_count
-                            logger.info(f"{wait_time}秒后重试...")
-                            time.sleep(wait_time)
-                        else:
-                            logger.error("已达到最大重试次数，服务查询失败")
-                            return jsonify({
-                                "success": 0,
-                                "message": "服务查询失败"
-                            })
-            except Exception as e:
-                logger.error(f"服务查询异常: {str(e)}")
-                retry_count += 1
-                if retry_count < max_retries:
-                    wait_time = retry_count
-                    logger.info(f"{wait_time}秒后重试...")
-                    time.sleep(wait_time)
-                else:
-                    logger.error("已达到最大重试次数，服务查询异常")
-                    return jsonify({
-                        "success": 0,
-                        "message": f"服务查询异常: {str(e)}"
-                    })
-    except Exception as e:
-        logger.error(f"API请求异常: {str(e)}")
-        return jsonify({
-            "success": 0,
-            "message": f"请求异常: {str(e)}"
-        })
+        elif not session_usable(login_client.session):
+            logger.warning("session绑定的出口代理已被剔除，经其他代理重新登录")
+            login_client.force_login()
+    return login_client
+
+# 单个深信服查询最多尝试的步骤次数
+SANGFOR_QUERY_ATTEMPTS = 5
+
+def run_sangfor_query(serial_number):
+    """执行深信服维保查询，返回响应数据；失败时按失败类型只重做失败的步骤"""
+    if PIPELINE_ENABLED:
+        return get_pipeline("sangfor").run(serial_number, INTERACTIVE)
+    # 确保登录客户端已初始化
+    client = ensure_login_client()
+    
+    # 已完成的步骤：查询页面已打开、验证码已识别
+    page_ready = False
+    captcha = None
+    failure = None
+    for attempt in range(SANGFOR_QUERY_ATTEMPTS):
+        try:
+            logger.info(f"执行服务查询 (尝试 {attempt + 1}/{SANGFOR_QUERY_ATTEMPTS})")
+            session = client.session
+            if not page_ready:
+                client.open_query_page()
+                page_ready = True
+            if captcha is None:
+                captcha = client.solve_query_captcha()
+            return classify_sangfor_result(client.doquery(serial_number, *captcha))
+        except NotFound as e:
+            logger.info(f"深信服未查询到 {serial_number} 的维保记录: {str(e)}")
+            return e.payload
+        except QueryFailure as e:
+            failure = e
+            failure_stats.record("sangfor", e)
+            logger.warning(f"服务查询失败（{e.stage}: {e.kind}）: {str(e)}")
+            if isinstance(e, CaptchaRejected):
+                # 只重新获取并识别验证码
+                captcha = None
+            elif isinstance(e, SessionExpired):
+                page_ready = False
+                captcha = None
+                if not client.relogin(session):
+                    logger.error("重新登录失败")
+                    return {"success": 0, "message": "服务查询失败: 重新登录失败", "failure": SessionExpired.kind}
+            elif attempt + 1 < SANGFOR_QUERY_ATTEMPTS:
+                # 上游错误、超时或响应无法解析：等待后重试失败的步骤，已识别的验证码继续使用
+                logger.info(f"{attempt + 1}秒后重试...")
+                time.sleep(attempt + 1)
+        except Exception as e:
+            # 无法分类的异常：从头重试
+            failure = e
+            logger.error(f"服务查询异常: {str(e)}")
+            page_ready = False
+            captcha = None
+            if attempt + 1 < SANGFOR_QUERY_ATTEMPTS:
+                time.sleep(attempt + 1)
+    
+    logger.error("已达到最大重试次数，服务查询失败")
+    return {"success": 0, "message": f"服务查询失败: {failure}" if failure else "服务查询失败",
+            "failure": failure_kind(failure)}
 
 class HuaweiWarrantyQuery:
     """华为设备维保信息查询类"""
     def __init__(self):
-        self.session = requests.Session()
+        self.session = bind_session(create_session())
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; WOW64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.6285.209 Safari/537.36",
             "Accept": "*/*",
@@ -821,12 +1194,14 @@ class HuaweiWarrantyQuery:
             "Accept-Encoding": "gzip, deflate, br",
             "Connection": "keep-alive"
         }
-        self.portal_url = "https://app.huawei.com/escpportal"
-        self.entry_url = "https://support.huawei.com/enterprise/ecareWechat?lang=zh"
+        self.portal_url = HUAWEI_PORTAL_URL
+        self.entry_url = HUAWEI_ENTRY_URL
+        # 该客户端上次验证通过的验证码，归还后下一个借出该客户端的批量或流水线查询可继续使用
+        self.ticket = None
     
     def get_captcha(self):
-        """获取验证码"""
-        try:
+        """获取验证码图片；失败时抛出 QueryFailure"""
+        with failure_stage("captcha"):
             # 首先访问入口页面获取初始cookie
             self.session.get(self.entry_url, headers=self.headers, timeout=10)
             
@@ -836,124 +1211,27 @@ class HuaweiWarrantyQuery:
             
             # 获取验证码图片
             captcha_headers = self.headers.copy()
-            captcha_headers["Referer"] = "https://app.huawei.com/escpportal/pub/wechat.html?Language=CN"
+            captcha_headers["Referer"] = f"{self.portal_url}/pub/wechat.html?Language=CN"
             captcha_headers["X-Requested-With"] = "XMLHttpRequest"
             
             response = self.session.get(captcha_url, headers=captcha_headers, timeout=10)
-            
-            if response.status_code == 200:
-                # 保存验证码图片
-                with open('huawei_captcha.jpg', 'wb') as f:
-                    f.write(response.content)
-                logger.info("已保存华为验证码图片到 huawei_captcha.jpg")
-                return response.content
-            else:
-                logger.error(f"获取华为验证码失败，状态码: {response.status_code}")
-                return None
-        except Exception as e:
-            logger.error(f"获取华为验证码异常: {str(e)}")
-            return None
-    
-    def recognize_captcha(self, captcha_image):
-        """使用API识别验证码"""
-        try:
-            import base64
-            max_retries = 5
-            retry_count = 0
-            captcha_text = ""
-            
-            while retry_count < max_retries:
-                try:
-                    # 将验证码图片转换为base64编码
-                    img_base64 = base64.b64encode(captcha_image).decode('utf-8')
-                    
-                    # 构建API请求
-                    api_url = "http://char1es.cn:8888/reg"
-                    api_headers = {
-                        "Content-Type": "text/plain"
-                    }
-                    
-                    logger.info(f"使用API接口识别华为验证码 (尝试 {retry_count + 1}/{max_retries})")
-                    # 发送POST请求到API接口
-                    api_response = requests.post(
-                        api_url,
-                        headers=api_headers,
-                        data=img_base64,
-                        timeout=10
-                    )
-                    
-                    # 记录API响应详情
-                    logger.info(f"API响应状态码: {api_response.status_code}")
-                    logger.info(f"API响应内容: {api_response.text}")
-                    logger.info(f"API响应头: {dict(api_response.headers)}")
-                    
-                    if api_response.status_code == 200:
-                        # 获取API返回的验证码
-                        try:
-                            # 尝试解码响应内容
-                            raw_response = api_response.text
-                            logger.info(f"原始API响应: {raw_response}")
-                            
-                            # 清理和处理响应结果
-                            captcha_text = raw_response.strip().upper()
-                            # 清理返回结果，只保留字母和数字
-                            captcha_text = re.sub(r'[^A-Z0-9]', '', captcha_text)
-                            
-                            logger.info(f"处理后的华为验证码识别结果: {captcha_text}")
-                            
-                            # 验证验证码长度
-                            if len(captcha_text) > 0:
-                                logger.info("华为验证码识别成功")
-                                return captcha_text
-                            else:
-                                logger.warning(f"华为验证码识别结果为空: {captcha_text}")
-                                retry_count += 1
-                                if retry_count < max_retries:
-                                    logger.info(f"{retry_count}秒后重试...")
-                                    time.sleep(retry_count)  # 递增等待时间
-                                else:
-                                    logger.warning("已达到最大重试次数，华为验证码识别失败")
-                                    return ""
-                        except Exception as decode_e:
-                            logger.error(f"解码华为验证码响应失败: {str(decode_e)}")
-                            retry_count += 1
-                            if retry_count < max_retries:
-                                logger.info(f"{retry_count}秒后重试...")
-                                time.sleep(retry_count)  # 递增等待时间
-                            else:
-                                logger.warning("已达到最大重试次数，解码失败")
-                                return ""
-                    else:
-                        logger.error(f"API请求失败，状态码: {api_response.status_code}")
-                        retry_count += 1
-                        if retry_count < max_retries:
-                            logger.info(f"{retry_count}秒后重试...")
-                            time.sleep(retry_count)  # 递增等待时间
-                        else:
-                            logger.warning("已达到最大重试次数，使用默认验证码")
-                            return ""
-                except Exception as api_e:
-                    logger.error(f"API识别失败: {str(api_e)}")
-                    retry_count += 1
-                    if retry_count < max_retries:
-                        logger.info(f"{retry_count}秒后重试...")
-                        time.sleep(retry_count)  # 递增等待时间
-                    else:
-                        logger.warning("已达到最大重试次数，使用默认验证码")
-                        return ""
-        except Exception as e:
-            logger.error(f"识别华为验证码异常: {str(e)}")
-            return ""
+            check_status(response, "captcha", "获取华为验证码")
+        
+        # 保存验证码图片
+        with open('huawei_captcha.jpg', 'wb') as f:
+            f.write(response.content)
+        logger.info("已保存华为验证码图片到 huawei_captcha.jpg")
+        return response.content
     
     def validate_captcha(self, captcha_code):
-        """验证验证码"""
-        try:
+        """验证验证码，验证码被拒绝时返回 False；网络错误或上游错误时抛出 QueryFailure"""
+        with failure_stage("validate"):
             validate_url = f"{self.portal_url}/servlet/captchaValidate"
             validate_headers = self.headers.copy()
-            validate_headers["Host"] = "app.huawei.com"
+            validate_headers["Host"] = urlparse(self.portal_url).netloc
             validate_headers["Content-Type"] = "application/x-www-form-urlencoded; charset=UTF-8"
             validate_headers["X-Requested-With"] = "XMLHttpRequest"
-            validate_headers["Referer"] = "https://app.huawei.com/escpportal/pub/wechat.html?Language=CN"
+            validate_headers["Referer"] = f"{self.portal_url}/pub/wechat.html?Language=CN"
             validate_headers["Sec-Fetch-Site"] = "same-origin"
             validate_headers["Sec-Fetch-Mode"] = "cors"
             validate_headers["Sec-Fetch-Dest"] = "empty"
@@ -962,25 +1240,22 @@ class HuaweiWarrantyQuery:
             
             data = f"paramCode={captcha_code}"
             response = self.session.post(validate_url, headers=validate_headers, data=data, timeout=10)
-            
-            if response.status_code == 200 and response.text.strip() == "yes":
-                logger.info("华为验证码验证成功")
-                return True
-            else:
-                logger.error(f"华为验证码验证失败，响应: {response.text}")
-                return False
-        except Exception as e:
-            logger.error(f"验证华为验证码异常: {str(e)}")
-            return False
+            check_status(response, "validate", "验证华为验证码")
+        
+        if response.text.strip() == "yes":
+            logger.info("华为验证码验证成功")
+            return True
+        logger.error(f"华为验证码验证失败，响应: {response.text}")
+        return False
     
-    def query_warranty(self, serial_number, captcha_code):
-        """查询设备维保信息"""
-        try:
-            # 首先验证验证码
-            if not self.validate_captcha(captcha_code):
-                logger.error("验证码验证失败，无法查询维保信息")
-                return None
-            
+    def query_warranty(self, serial_number, captcha_code, validate=True, ticket=None):
+        """查询设备维保信息，返回原始响应内容；validate=False 时复用已验证通过的验证码（ticket，对冲时多计一次使用次数），
+        失败时抛出 QueryFailure"""
+        # 首先验证验证码
+        if validate and not self.validate_captcha(captcha_code):
+            raise CaptchaRejected("华为验证码验证失败", "validate")
+        
+        with failure_stage("query"):
             # 构建查询URL
             timestamp = int(time.time())
             query_url = f"{self.portal_url}/services/portal/vyborgTask/findHardWareVyborgForWeb"
@@ -996,185 +1271,806 @@ class HuaweiWarrantyQuery:
             
             # 构建请求头
             query_headers = self.headers.copy()
-            query_headers["Host"] = "app.huawei.com"
+            query_headers["Host"] = urlparse(self.portal_url).netloc
             query_headers["Content-Type"] = "application/json"
             query_headers["X-Requested-With"] = "XMLHttpRequest"
-            query_headers["Referer"] = "https://app.huawei.com/escpportal/pub/wechat.html?Language=CN"
+            query_headers["Referer"] = f"{self.portal_url}/pub/wechat.html?Language=CN"
             query_headers["Sec-Fetch-Site"] = "same-origin"
             query_headers["Sec-Fetch-Mode"] = "cors"
             query_headers["Sec-Fetch-Dest"] = "empty"
             query_headers["Pragma"] = "no-cache"
             query_headers["Cache-Control"] = "no-cache"
             
-            # 发送查询请求
-            response = self.session.get(query_url, headers=query_headers, params=query_params, timeout=15)
-            
-            if response.status_code == 200:
-                logger.info("查询华为设备维保信息成功")
-                return response.text
-            else:
-                logger.error(f"查询华为设备维保信息失败，状态码: {response.status_code}")
-                return None
-        except Exception as e:
-            logger.error(f"查询华为设备维保信息异常: {str(e)}")
-            return None
+            # 发送查询请求（慢请求可对冲）
+            response = huawei_query_hedger.request(
+                self.session, 'GET', query_url, headers=query_headers, params=query_params, timeout=15,
+                on_hedge=(lambda: huawei_captcha_reuse.hedged(ticket)) if ticket is not None else None
+            )
+            check_status(response, "query", "查询华为设备维保信息")
+        logger.info("查询华为设备维保信息成功")
+        return response.text
+    
+    def recognize_captcha_checked(self, captcha_image):
+        """识别验证码；结果为空时抛出 CaptchaRejected，OCR接口出错或超时时抛出 UpstreamError/UpstreamTimeout"""
+        return recognize_image(captcha_image)
+    
+    def solve_captcha(self):
+        """获取、识别并验证验证码，返回验证码；失败时抛出 QueryFailure"""
+        captcha_code = self.recognize_captcha_checked(self.get_captcha())
+        if not self.validate_captcha(captcha_code):
+            raise CaptchaRejected("华为验证码验证失败", "validate")
+        return captcha_code
+    
+    def query_warranty_many(self, serial_numbers):
+        """批量查询：验证通过的验证码连续用于多个序列号，仅在被拒绝或接近复用上限时重新识别，逐个返回 (序列号, 原始响应内容)"""
+        # 沿用该客户端上次验证通过的验证码
+        ticket = self.ticket
+        for serial_number in serial_numbers:
+            service_result = None
+            for attempt in range(BATCH_MAX_RESOLVES):
+                try:
+                    if huawei_captcha_reuse.should_resolve(ticket):
+                        # 接近复用上限的验证码不再使用，识别失败时也不计为被拒绝
+                        ticket = None
+                        ticket = huawei_captcha_reuse.new_ticket(self.solve_captcha())
+                    service_result = self.query_warranty(serial_number, ticket.value, validate=False, ticket=ticket)
+                    try:
+                        classify_huawei_result(service_result)
+                    except NotFound:
+                        pass
+                    huawei_captcha_reuse.accepted(ticket)
+                    break
+                except CaptchaRejected as e:
+                    failure_stats.record("huawei", e)
+                    if ticket is not None:
+                        logger.info(f"华为验证码已失效（已使用 {ticket.uses} 次，{ticket.age:.1f} 秒），重新识别")
+                        huawei_captcha_reuse.rejected(ticket)
+                    ticket = None
+                    service_result = None
+                except QueryFailure as e:
+                    # 上游错误、超时或响应无法解析：验证码仍可使用，只重试失败的步骤
+                    logger.warning(f"华为批量查询 {serial_number} 失败（{e.stage}: {e.kind}）: {str(e)}")
+                    failure_stats.record("huawei", e)
+                    service_result = None
+                    time.sleep(attempt + 1)
+                except Exception as e:
+                    logger.error(f"华为批量查询 {serial_number} 异常: {str(e)}")
+                    ticket = None
+                    service_result = None
+            self.ticket = ticket
+            yield serial_number, service_result
+
+class HuaweiClientPool:
+    """华为查询客户端池：复用已建立连接的客户端，避免每个请求重新建连"""
+    def __init__(self, size=HUAWEI_CLIENT_POOL_SIZE):
+        self.size = size
+        # 后进先出，优先使用刚归还、连接仍然活跃的客户端
+        self.idle = queue.LifoQueue()
+    
+    def acquire(self):
+        while True:
+            try:
+                huawei_client = self.idle.get_nowait()
+            except queue.Empty:
+                return HuaweiWarrantyQuery()
+            # 绑定的出口代理已被剔除时丢弃该客户端，新客户端会绑定到其他代理
+            if session_usable(huawei_client.session):
+                return huawei_client
+    
+    def release(self, huawei_client):
+        if self.idle.qsize() < self.size:
+            self.idle.put(huawei_client)
+    
+    @contextmanager
+    def client(self):
+        """借出一个客户端，用完后归还"""
+        huawei_client = self.acquire()
+        try:
+            yield huawei_client
+        finally:
+            self.release(huawei_client)
+    
+    def warm(self):
+        """预先创建客户端并访问入口页面，建立到华为站点的连接"""
+        clients = [self.acquire() for _ in range(self.size)]
+        try:
+            for huawei_client in clients:
+                response = huawei_client.session.get(huawei_client.entry_url, headers=huawei_client.headers, timeout=10)
+                if response.status_code >= 500:
+                    raise RuntimeError(f"访问华为入口页面失败，状态码: {response.status_code}")
+        finally:
+            for huawei_client in clients:
+                self.release(huawei_client)
+
+huawei_client_pool = HuaweiClientPool()
 
 @app.route('/sn_query/huawei', methods=['GET', 'POST'])
 def query_service_huawei():
     """API接口：查询华为设备维保信息"""
     try:
-        # 获取设备序列号
-        if request.method == 'GET':
-            serial_number = request.args.get('sn')
-        else:
-            serial_number = request.json.get('sn') if request.is_json else request.form.get('sn')
-        
+        serial_number = get_request_serial_number("huawei")
         if not serial_number:
-            return jsonify({
+            return json_response({
                 "success": 0,
                 "message": "设备序列号不能为空"
             })
         
         logger.info(f"收到华为查询请求，设备序列号: {serial_number}")
+        payload = fresh_result("huawei", serial_number, request_refresh())
+        if payload is None:
+            payload = lookup("huawei", serial_number, run_huawei_query)
+        return json_response(payload)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        logger.error(f"API请求异常: {str(e)}")
+        return json_response({
+            "success": 0,
+            "message": f"请求异常: {str(e)}"
+        })
+
+def run_huawei_query(serial_number):
+    """执行华为维保查询，返回响应数据"""
+    if PIPELINE_ENABLED:
+        return get_pipeline("huawei").run(serial_number, INTERACTIVE)
+    # 从客户端池借出华为查询客户端
+    with huawei_client_pool.client() as huawei_client:
+        return query_huawei_with_client(huawei_client, serial_number)
+
+# 单个华为查询最多尝试的步骤次数
+HUAWEI_QUERY_ATTEMPTS = 5
+
+def query_huawei_with_client(huawei_client, serial_number):
+    """使用指定的华为查询客户端执行查询，返回响应数据；失败时按失败类型只重做失败的步骤"""
+    # 已完成的步骤：验证码图片、识别结果、验证是否通过
+    captcha_image = None
+    captcha_code = None
+    validated = False
+    failure = None
+    for attempt in range(HUAWEI_QUERY_ATTEMPTS):
+        try:
+            logger.info(f"执行华为服务查询 (尝试 {attempt + 1}/{HUAWEI_QUERY_ATTEMPTS})")
+            if captcha_image is None:
+                captcha_image = huawei_client.get_captcha()
+            if captcha_code is None:
+                captcha_code = huawei_client.recognize_captcha_checked(captcha_image)
+            if not validated:
+                if not huawei_client.validate_captcha(captcha_code):
+                    raise CaptchaRejected("华为验证码验证失败", "validate")
+                validated = True
+            service_result = huawei_client.query_warranty(serial_number, captcha_code, validate=False)
+            logger.info(f"华为服务查询原始响应: {service_result}")
+            return classify_huawei_result(service_result)
+        except NotFound as e:
+            logger.info(f"华为未查询到 {serial_number} 的维保记录")
+            return e.payload
+        except QueryFailure as e:
+            failure = e
+            failure_stats.record("huawei", e)
+            logger.warning(f"华为服务查询失败（{e.stage}: {e.kind}）: {str(e)}")
+            if isinstance(e, CaptchaRejected):
+                # 只重新获取、识别并验证验证码
+                captcha_image = None
+                captcha_code = None
+                validated = False
+            elif attempt + 1 < HUAWEI_QUERY_ATTEMPTS:
+                # 上游错误、超时或响应无法解析：等待后重试失败的步骤
+                logger.info(f"{attempt + 1}秒后重试...")
+                time.sleep(attempt + 1)
+        except Exception as e:
+            # 无法分类的异常：从头重试
+            failure = e
+            logger.error(f"华为服务查询异常: {str(e)}")
+            captcha_image = None
+            captcha_code = None
+            validated = False
+            if attempt + 1 < HUAWEI_QUERY_ATTEMPTS:
+                time.sleep(attempt + 1)
+    
+    logger.error("已达到最大重试次数，华为服务查询失败")
+    return {"success": 0, "message": str(failure) if failure else "华为服务查询失败", "failure": failure_kind(failure)}
+
+class SangforPipelineFlow:
+    """深信服查询流水线：打开查询页面 → 获取验证码 → OCR识别 → 查询 → 解析；session失效时经登录阶段重新登录
+
+    识别出的验证码在后续请求之间复用，接近复用上限或被拒绝后才重新获取。
+    """
+    name = "sangfor"
+    
+    def __init__(self):
+        # 最近识别的验证码
+        self.ticket = None
+        self.stages = [
+            ("query_page", self.open_page, PIPELINE_WORKERS),
+            ("captcha", self.fetch_captcha, PIPELINE_WORKERS),
+            ("ocr", self.recognize, PIPELINE_WORKERS),
+            ("query", self.query, PIPELINE_WORKERS),
+            ("parse", self.parse, 1),
+            # 同一时间只需要一次重新登录
+            ("login", self.login, 1),
+        ]
+    
+    def open_page(self, task):
+        client = ensure_login_client()
+        task.state["session"] = client.session
+        ticket = self.ticket
+        if not sangfor_captcha_reuse.should_resolve(ticket):
+            task.state["ticket"] = ticket
+            return "query"
+        # 最近确认过session有效时不必再打开查询页面
+        if not is_trusted(client.validated_at):
+            client.open_query_page()
+        return "captcha"
+    
+    def fetch_captcha(self, task):
+        task.state["idhash"], task.state["image"] = ensure_login_client().fetch_seccode()
+        return "ocr"
+    
+    def recognize(self, task):
+        captcha_text = ensure_login_client().recognize_seccode(task.state["image"])
+        task.state["ticket"] = self.ticket = sangfor_captcha_reuse.new_ticket((task.state.pop("idhash"), captcha_text))
+        del task.state["image"]
+        return "query"
+    
+    def query(self, task):
+        ticket = task.state["ticket"]
+        task.state["response"] = ensure_login_client().doquery(task.serial_number, *ticket.value, ticket)
+        return "parse"
+    
+    def parse(self, task):
+        task.result = classify_sangfor_result(task.state.pop("response"))
+        sangfor_captcha_reuse.accepted(task.state["ticket"])
+        return None
+    
+    def login(self, task):
+        if not ensure_login_client().relogin(task.state.get("session")):
+            logger.error("重新登录失败")
+            task.result = {"success": 0, "message": "服务查询失败: 重新登录失败", "failure": SessionExpired.kind}
+            return None
+        return "query_page"
+    
+    def drop_ticket(self, task):
+        """task 使用的验证码不再复用"""
+        ticket = task.state.pop("ticket", None)
+        if ticket is not None and self.ticket is ticket:
+            self.ticket = None
+        return ticket
+    
+    def retry(self, task, error):
+        if not isinstance(error, QueryFailure):
+            # 无法分类的异常：从头重试
+            logger.error(f"深信服查询 {task.serial_number} 异常: {str(error)}")
+            self.drop_ticket(task)
+            return "query_page", task.attempts
+        failure_stats.record("sangfor", error)
+        if isinstance(error, NotFound):
+            logger.info(f"深信服未查询到 {task.serial_number} 的维保记录: {str(error)}")
+            sangfor_captcha_reuse.accepted(task.state["ticket"])
+            task.result = error.payload
+            return None
+        logger.warning(f"深信服查询 {task.serial_number} 失败（{error.stage}: {error.kind}）: {str(error)}")
+        if isinstance(error, CaptchaRejected):
+            # 只重新获取并识别验证码
+            ticket = self.drop_ticket(task)
+            if ticket is not None:
+                sangfor_captcha_reuse.rejected(ticket)
+            return "captcha", 0
+        if isinstance(error, SessionExpired):
+            # 验证码与session绑定，重新登录后一并重新获取
+            self.drop_ticket(task)
+            return "login", 0
+        # 上游错误、超时或响应无法解析：等待后重试失败的步骤，已识别的验证码继续使用
+        stage = "query" if error.stage == "parse" else error.stage or "query_page"
+        return stage, task.attempts
+    
+    def give_up(self, task):
+        task.result = {"success": 0, "message": f"服务查询失败: {task.failure}", "failure": failure_kind(task.failure)}
+    
+    def finish(self, task):
+        task.state.clear()
+
+class HuaweiPipelineFlow:
+    """华为查询流水线：获取验证码 → OCR识别 → 验证 → 查询 → 解析；客户端在整个查询期间归该查询独占
+
+    客户端上次验证通过的验证码仍可复用时跳过前三个阶段。
+    """
+    name = "huawei"
+    
+    def __init__(self):
+        self.stages = [
+            ("captcha", self.fetch_captcha, PIPELINE_WORKERS),
+            ("ocr", self.recognize, PIPELINE_WORKERS),
+            ("validate", self.validate, PIPELINE_WORKERS),
+            ("query", self.query, PIPELINE_WORKERS),
+            ("parse", self.parse, 1),
+        ]
+    
+    def fetch_captcha(self, task):
+        huawei_client = task.state.get("client")
+        if huawei_client is None:
+            huawei_client = task.state["client"] = huawei_client_pool.acquire()
+            if not huawei_captcha_reuse.should_resolve(huawei_client.ticket):
+                return "query"
+        huawei_client.ticket = None
+        task.state["image"] = huawei_client.get_captcha()
+        return "ocr"
+    
+    def recognize(self, task):
+        task.state["code"] = recognize_image(task.state["image"])
+        del task.state["image"]
+        return "validate"
+    
+    def validate(self, task):
+        huawei_client = task.state["client"]
+        if not huawei_client.validate_captcha(task.state["code"]):
+            raise CaptchaRejected("华为验证码验证失败", "validate")
+        huawei_client.ticket = huawei_captcha_reuse.new_ticket(task.state.pop("code"))
+        return "query"
+    
+    def query(self, task):
+        huawei_client = task.state["client"]
+        ticket = huawei_client.ticket
+        task.state["response"] = huawei_client.query_warranty(task.serial_number, ticket.value, validate=False, ticket=ticket)
+        return "parse"
+    
+    def parse(self, task):
+        task.result = classify_huawei_result(task.state.pop("response"))
+        huawei_captcha_reuse.accepted(task.state["client"].ticket)
+        return None
+    
+    def retry(self, task, error):
+        huawei_client = task.state.get("client")
+        if not isinstance(error, QueryFailure):
+            logger.error(f"华为查询 {task.serial_number} 异常: {str(error)}")
+            if huawei_client is not None:
+                huawei_client.ticket = None
+            return "captcha", task.attempts
+        failure_stats.record("huawei", error)
+        if isinstance(error, NotFound):
+            logger.info(f"华为未查询到 {task.serial_number} 的维保记录")
+            huawei_captcha_reuse.accepted(huawei_client.ticket)
+            task.result = error.payload
+            return None
+        logger.warning(f"华为查询 {task.serial_number} 失败（{error.stage}: {error.kind}）: {str(error)}")
+        if isinstance(error, CaptchaRejected):
+            # 只重新获取、识别并验证验证码
+            if huawei_client.ticket is not None:
+                huawei_captcha_reuse.rejected(huawei_client.ticket)
+                huawei_client.ticket = None
+            return "captcha", 0
+        # 上游错误、超时或响应无法解析：等待后重试失败的步骤
+        stage = "query" if error.stage == "parse" else error.stage or "captcha"
+        return stage, task.attempts
+    
+    def give_up(self, task):
+        task.result = {"success": 0, "message": str(task.failure) if task.failure else "华为服务查询失败",
+                       "failure": failure_kind(task.failure)}
+    
+    def finish(self, task):
+        huawei_client = task.state.pop("client", None)
+        if huawei_client is not None:
+            huawei_client_pool.release(huawei_client)
+        task.state.clear()
+
+PIPELINE_FLOWS = {
+    "sangfor": SangforPipelineFlow,
+    "huawei": HuaweiPipelineFlow,
+}
+
+# 各厂商的分阶段流水线，首次使用时创建
+vendor_pipelines = {}
+vendor_pipelines_lock = threading.Lock()
+
+def get_pipeline(vendor):
+    """获取厂商的分阶段流水线"""
+    with vendor_pipelines_lock:
+        if vendor not in vendor_pipelines:
+            vendor_pipelines[vendor] = StagePipeline(PIPELINE_FLOWS[vendor]())
+        return vendor_pipelines[vendor]
+
+def run_pipelined_batch(vendor, serial_numbers):
+    """同时把批量查询的序列号提交到流水线"""
+    payloads = get_pipeline(vendor).run_many(serial_numbers, BULK)
+    return [dict(sn=serial_number, **payload) for serial_number, payload in zip(serial_numbers, payloads)]
+
+def run_sangfor_batch(serial_numbers):
+    """深信服批量查询，验证码在多个序列号之间复用"""
+    if PIPELINE_ENABLED:
+        return run_pipelined_batch("sangfor", serial_numbers)
+    client = ensure_login_client()
+    return [dict(sn=serial_number, **parse_sangfor_result(service_result))
+            for serial_number, service_result in client.query_service_many(serial_numbers)]
+
+def run_huawei_batch(serial_numbers):
+    """华为批量查询，验证码在多个序列号之间复用"""
+    if PIPELINE_ENABLED:
+        return run_pipelined_batch("huawei", serial_numbers)
+    with huawei_client_pool.client() as huawei_client:
+        return [dict(sn=serial_number, **parse_huawei_result(service_result))
+                for serial_number, service_result in huawei_client.query_warranty_many(serial_numbers)]
+
+BATCH_RUNNERS = {
+    "sangfor": run_sangfor_batch,
+    "huawei": run_huawei_batch,
+}
+
+def run_batch_in_lane(vendor, lane, serial_numbers, deadline=None, on_chunk=None):
+    """在优先级通道中批量查询，每 LANE_BULK_CHUNK 个序列号占用一次名额
+
+    deadline 只约束第一批的排队：之后的批次不再检查期限，避免已经查询过上游的结果因后面的批次排队超时而被丢弃。
+    on_chunk(results) 在每批完成后立即调用，用于逐批保存结果。
+    """
+    results = []
+    for start in range(0, len(serial_numbers), LANE_BULK_CHUNK):
+        chunk = run_in_lane(vendor, lane, BATCH_RUNNERS[vendor], serial_numbers[start:start + LANE_BULK_CHUNK],
+                            deadline=deadline if start == 0 else None)
+        if on_chunk is not None:
+            on_chunk(chunk)
+        results.extend(chunk)
+    return results
+
+def run_vendor_batch(vendor, serial_numbers, refresh=False, lane=BULK, timeout=None):
+    """批量查询一个厂商的序列号：本地已有最新数据的直接返回，其余的在指定优先级通道中批量查询并保存
+
+    指定 timeout（秒）时先做准入检查：排队超过期限时抛出 Overloaded，批量本身超过期限内可完成的个数时抛出 BatchTooLarge。
+    每批结果完成后立即保存，后面的批次失败时已查询的结果不会丢失。
+    """
+    results = {}
+    for serial_number in serial_numbers:
+        payload = fresh_result(vendor, serial_number, refresh)
+        if payload is not None:
+            results[serial_number] = dict(sn=serial_number, **payload)
+    missing = [serial_number for serial_number in serial_numbers if serial_number not in results]
+    deadline = None
+    if missing and timeout is not None:
+        deadline = vendor_admission[vendor].admit(lane, timeout, -(-len(missing) // LANE_BULK_CHUNK))
+
+    def remember_chunk(chunk):
+        for result in chunk:
+            remember_result(vendor, result["sn"], result)
+            results[result["sn"]] = result
+
+    run_batch_in_lane(vendor, lane, missing, deadline, remember_chunk)
+    return [results[serial_number] for serial_number in serial_numbers if serial_number in results]
+
+# 单次批量查询最多允许的序列号个数
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', '500'))
+
+@app.route('/sn_query/<vendor>/batch', methods=['GET', 'POST'])
+def query_service_batch(vendor):
+    """API接口：批量查询设备维保信息，同一个验证码复用于多个序列号"""
+    try:
+        runner = BATCH_RUNNERS.get(vendor)
+        if not runner:
+            return json_response({
+                "success": 0,
+                "message": f"不支持批量查询的厂商: {vendor}"
+            }, status=404)
         
-        # 创建华为查询客户端
-        huawei_client = HuaweiWarrantyQuery()
+        serial_numbers = get_request_serial_numbers(vendor)
+        if not serial_numbers:
+            return json_response({
+                "success": 0,
+                "message": "设备序列号不能为空"
+            })
+        if len(serial_numbers) > BATCH_MAX_SIZE:
+            return json_response({
+                "success": 0,
+                "message": f"单次最多查询 {BATCH_MAX_SIZE} 个序列号"
+            })
         
-        # 执行服务查询，添加失败重试机制
-        max_retries = 3
-        retry_count = 0
-        service_result = None
+        logger.info(f"收到{vendor}批量查询请求，序列号个数: {len(serial_numbers)}")
+        return json_response({
+            "success": 1,
+            "data": run_vendor_batch(vendor, serial_numbers, request_refresh(), request_lane(BULK), request_deadline())
+        })
+    except Overloaded as e:
+        return overloaded_response(e)
+    except BatchTooLarge as e:
+        return batch_too_large_response(e)
+    except Exception as e:
+        logger.error(f"API请求异常: {str(e)}")
+        return json_response({
+            "success": 0,
+            "message": f"请求异常: {str(e)}"
+        })
+
+# 后台刷新调度器，首次使用时创建
+refresh_scheduler = None
+refresh_scheduler_lock = threading.Lock()
+
+def get_refresh_scheduler():
+    """获取后台刷新调度器"""
+    global refresh_scheduler
+    with refresh_scheduler_lock:
+        if refresh_scheduler is None:
+            # 后台刷新始终走批量通道
+            runners = {vendor: (lambda serial_numbers, vendor=vendor: run_batch_in_lane(vendor, BULK, serial_numbers))
+                       for vendor in BATCH_RUNNERS}
+            # 多个工作进程共用同一数据库时由租约选出唯一执行刷新的进程
+            store = get_warranty_store()
+            refresh_scheduler = RefreshScheduler(store, runners, store_result, SchedulerLease(store.path))
+        return refresh_scheduler
+
+@app.route('/inventory', methods=['GET'])
+def list_inventory():
+    """API接口：查看登记的设备清单及其数据新旧程度和下一次刷新时间"""
+    try:
+        scheduler = get_refresh_scheduler()
+        devices = []
+        for vendor, serial_number, updated_at, expiry_dates in get_warranty_store().inventory(request.args.get('vendor')):
+            devices.append({
+                "vendor": vendor,
+                "sn": serial_number,
+                "updated_at": updated_at,
+                "next_expiry": min((day for day in expiry_dates if day >= datetime.date.today().isoformat()), default=None),
+                "days_to_expiry": days_to_expiry(expiry_dates),
+                "next_refresh": scheduler.next_due(vendor, serial_number)
+            })
+        return json_response({
+            "success": 1,
+            "data": devices
+        })
+    except Exception as e:
+        logger.error(f"API请求异常: {str(e)}")
+        return json_response({
+            "success": 0,
+            "message": f"请求异常: {str(e)}"
+        })
+
+def register_devices(devices):
+    """登记设备并按数据新旧和到期日排定后台刷新，返回新增个数"""
+    store = get_warranty_store()
+    scheduler = get_refresh_scheduler()
+    added = store.register(devices)
+    for vendor, serial_number in devices:
+        record = store.get(vendor, serial_number)
+        scheduler.plan(vendor, serial_number, record["updated_at"] if record else None,
+                       store.expiry_dates(vendor, serial_number))
+    return added
+
+@app.route('/inventory', methods=['POST', 'DELETE'])
+def update_inventory():
+    """API接口：登记（POST）或移除（DELETE）需要后台定期刷新的设备"""
+    try:
+        devices = get_request_devices()
+        if not devices:
+            return json_response({
+                "success": 0,
+                "message": "设备清单不能为空"
+            })
+        invalid = [f"{vendor}/{serial_number}" for vendor, serial_number in devices
+                   if vendor not in BATCH_RUNNERS or not serial_number]
+        if invalid:
+            return json_response({
+                "success": 0,
+                "message": f"不支持的厂商或序列号为空: {', '.join(invalid[:10])}"
+            }, status=400)
         
-        while retry_count < max_retries:
-            try:
-                logger.info(f"执行华为服务查询 (尝试 {retry_count + 1}/{max_retries})")
-                
-                # 获取验证码
-                captcha_image = huawei_client.get_captcha()
-                if not captcha_image:
-                    logger.error("获取华为验证码失败")
-                    retry_count += 1
-                    if retry_count < max_retries:
-                        wait_time = retry_count
-                        logger.info(f"{wait_time}秒后重试...")
-                        time.sleep(wait_time)
-                    else:
-                        logger.error("已达到最大重试次数，获取华为验证码失败")
-                        return jsonify({
-                            "success": 0,
-                            "message": "获取华为验证码失败"
-                        })
-                
-                # 自动识别验证码
-                captcha_code = huawei_client.recognize_captcha(captcha_image)
-                if not captcha_code:
-                    logger.error("华为验证码识别失败")
-                    retry_count += 1
-                    if retry_count < max_retries:
-                        wait_time = retry_count
-                        logger.info(f"{wait_time}秒后重试...")
-                        time.sleep(wait_time)
-                    else:
-                        logger.error("已达到最大重试次数，华为验证码识别失败")
-                        return jsonify({
-                            "success": 0,
-                            "message": "华为验证码识别失败"
-                        })
-                
-                # 查询维保信息
-                service_result = huawei_client.query_warranty(serial_number, captcha_code)
-                
-                if service_result:
-                    logger.info("华为服务查询成功")
-                    # 记录原始响应内容
-                    logger.info(f"华为服务查询原始响应: {service_result}")
-                    # 解析结果
-                    import json
-                    try:
-                        result = json.loads(service_result)
-                        # 记录解析后的结果
-                        logger.info(f"华为服务查询解析结果: {result}")
-                        # 转换数据为人类可读格式
-                        parsed_data = []
-                        for item in result:
-                            parsed_item = {
-                                "序列号": item.get("barcode", ""),
-                                "设备型号": item.get("snModel", ""),
-                                "服务套餐": item.get("servicePackage", ""),
-                                "开始日期": item.get("startDate", ""),
-                                "结束日期": item.get("endDate", ""),
-                                "状态": item.get("vyborgStutas", ""),
-                                "国家/地区": item.get("country", ""),
-                                "保修区域": item.get("warrantyArea", ""),
-                                "描述": item.get("itemDescription", "")
-                            }
-                            parsed_data.append(parsed_item)
-                        
-                        # 使用json.dumps确保中文正确显示
-                        import json
-                        from flask import Response
-                        return Response(
-                            json.dumps({"success": 1, "data": parsed_data}, ensure_ascii=False),
-                            mimetype='application/json'
-                        )
-                    except json.JSONDecodeError as e:
-                        logger.error(f"解析华为查询结果失败: {str(e)}")
-                        retry_count += 1
-                        if retry_count < max_retries:
-                            wait_time = retry_count
-                            logger.info(f"{wait_time}秒后重试...")
-                            time.sleep(wait_time)
-                        else:
-                            logger.error("已达到最大重试次数，解析华为查询结果失败")
-                            return jsonify({
-                                "success": 0,
-                                "message": "解析华为查询结果失败"
-                            })
-                else:
-                    logger.warning("华为服务查询失败，准备重试")
-                    retry_count += 1
-                    if retry_count < max_retries:
-                        wait_time = retry_count
-                        logger.info(f"{wait_time}秒后重试...")
-                        time.sleep(wait_time)
-                    else:
-                        logger.error("已达到最大重试次数，华为服务查询失败")
-                        return jsonify({
-                            "success": 0,
-                            "message": "华为服务查询失败"
-                        })
-            except Exception as e:
-                logger.error(f"华为服务查询异常: {str(e)}")
-                retry_count += 1
-                if retry_count < max_retries:
-                    wait_time = retry_count
-                    logger.info(f"{wait_time}秒后重试...")
-                    time.sleep(wait_time)
-                else:
-                    logger.error("已达到最大重试次数，华为服务查询异常")
-                    return jsonify({
-                        "success": 0,
-                        "message": f"华为服务查询异常: {str(e)}"
-                    })
+        store = get_warranty_store()
+        scheduler = get_refresh_scheduler()
+        if request.method == 'DELETE':
+            removed = store.unregister(devices)
+            for vendor, serial_number in devices:
+                scheduler.unschedule(vendor, serial_number)
+            logger.info(f"移除登记设备 {removed} 台")
+            return json_response({"success": 1, "data": {"removed": removed}})
+        
+        added = register_devices(devices)
+        logger.info(f"登记设备 {len(devices)} 台，其中新增 {added} 台")
+        return json_response({"success": 1, "data": {"registered": len(devices), "added": added}})
     except Exception as e:
         logger.error(f"API请求异常: {str(e)}")
-        return jsonify({
+        return json_response({
             "success": 0,
             "message": f"请求异常: {str(e)}"
         })
 
+# 异步查询任务队列，首次使用时创建并启动工作线程
+job_queue = None
+job_queue_lock = threading.Lock()
+
+def get_job_queue():
+    """获取异步查询任务队列"""
+    global job_queue
+    with job_queue_lock:
+        if job_queue is None:
+            runner = lambda vendor, serial_numbers, options: run_vendor_batch(
+                vendor, serial_numbers, options.get("refresh", False), options.get("priority", BULK))
+            # 集群模式下任务放入共享队列，由所有节点的工作线程执行
+            cluster = get_cluster()
+            job_queue = (ClusterJobQueue(cluster, runner) if cluster is not None else JobQueue(runner)).start()
+        return job_queue
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """API接口：提交异步查询任务，立即返回任务ID"""
+    try:
+        devices = get_request_devices()
+        if not devices:
+            return json_response({
+                "success": 0,
+                "message": "设备序列号不能为空"
+            })
+        if len(devices) > JOB_MAX_SIZE:
+            return json_response({
+                "success": 0,
+                "message": f"单个任务最多包含 {JOB_MAX_SIZE} 个序列号"
+            })
+        invalid = [f"{vendor}/{serial_number}" for vendor, serial_number in devices
+                   if vendor not in BATCH_RUNNERS or not serial_number]
+        if invalid:
+            return json_response({
+                "success": 0,
+                "message": f"不支持的厂商或序列号为空: {', '.join(invalid[:10])}"
+            }, status=400)
+        
+        job_id = get_job_queue().submit(devices, {"refresh": request_refresh(), "priority": request_lane(BULK)})
+        return json_response({
+            "success": 1,
+            "data": {"id": job_id, "status": "queued", "total": len(devices)}
+        }, status=202, headers={"Location": f"/jobs/{job_id}"})
+    except Exception as e:
+        logger.error(f"API请求异常: {str(e)}")
+        return json_response({
+            "success": 0,
+            "message": f"请求异常: {str(e)}"
+        })
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """API接口：查询任务状态和已完成的结果，wait=秒数 时长轮询直到任务结束（或完成数超过 since）"""
+    try:
+        wait = float(request.args.get('wait', '0'))
+        since = request.args.get('since')
+        jobs = get_job_queue()
+        if wait > 0:
+            job = jobs.wait(job_id, wait, int(since) if since else None)
+        else:
+            job = jobs.get(job_id)
+        if job is None:
+            return json_response({
+                "success": 0,
+                "message": f"任务不存在: {job_id}"
+            }, status=404)
+        return json_response({
+            "success": 1,
+            "data": job
+        })
+    except ValueError as e:
+        return json_response({
+            "success": 0,
+            "message": f"参数错误: {str(e)}"
+        }, status=400)
+    except Exception as e:
+        logger.error(f"API请求异常: {str(e)}")
+        return json_response({
+            "success": 0,
+            "message": f"请求异常: {str(e)}"
+        })
+
+# 同步导入时最多查询的序列号个数，超出时需要以 async=1 提交为异步任务
+INGEST_SYNC_MAX_QUERIES = int(os.getenv('INGEST_SYNC_MAX_QUERIES', '500'))
+
+@app.route('/ingest', methods=['POST'])
+def ingest_inventory():
+    """API接口：导入CSV/XLSX设备清单，序列号规范化去重后只查询唯一且没有最新结果的部分，并把结果对应回每一行"""
+    try:
+        upload = request.files.get('file')
+        if upload is not None:
+            stream, filename = upload.stream, upload.filename or ''
+        else:
+            # 也可以直接以请求体上传文件
+            stream, filename = request.stream, request.args.get('filename', '')
+            if 'spreadsheetml' in (request.content_type or ''):
+                filename = filename or 'upload.xlsx'
+        vendor_value = request.values.get('vendor')
+        default_vendor = canonical_vendor(vendor_value)
+        if vendor_value and default_vendor not in BATCH_RUNNERS:
+            return json_response({
+                "success": 0,
+                "message": f"不支持的厂商: {vendor_value}"
+            }, status=400)
+        plan = IngestPlan(BATCH_RUNNERS, default_vendor).read(
+            stream, filename, request.values.get('encoding', 'utf-8-sig'))
+        if not plan.devices:
+            return json_response({
+                "success": 0,
+                "message": "文件中没有有效的序列号",
+                "data": {"summary": plan.summary(), "rows": plan.rows[:100]}
+            }, status=400)
+        
+        refresh = request_refresh()
+        results = {}
+        missing = []
+        for device in plan.devices:
+            payload = fresh_result(device[0], device[1], refresh)
+            if payload is not None:
+                results[device] = payload
+            else:
+                missing.append(device)
+        summary = dict(plan.summary(), cached=len(results), queried=len(missing))
+        logger.info(f"导入设备清单 {filename or '请求体'}：{summary}")
+        if request.values.get('register') == '1':
+            summary["registered_added"] = register_devices(list(plan.devices))
+        
+        if request.values.get('async') == '1':
+            # 需要查询的部分按 JOB_MAX_SIZE 拆成若干个异步任务提交，结果通过 /jobs/<id> 按 vendor 和 sn 对应
+            options = {"refresh": refresh, "priority": request_lane(BULK)}
+            jobs = []
+            job_of = {}
+            for start in range(0, len(missing), JOB_MAX_SIZE):
+                devices = missing[start:start + JOB_MAX_SIZE]
+                jobs.append(get_job_queue().submit(devices, options))
+                job_of.update((device, jobs[-1]) for device in devices)
+            for row in plan.rows:
+                if "sn" in row:
+                    device = (row["vendor"], row["sn"])
+                    row["result"] = results.get(device)
+                    row["status"] = "cached" if device in results else "queued"
+                    if device in job_of:
+                        row["job"] = job_of[device]
+            job_id = jobs[0] if jobs else None
+            return json_response({
+                "success": 1,
+                "data": {"summary": summary, "job": job_id, "jobs": jobs, "rows": plan.rows}
+            }, status=202 if job_id else 200, headers={"Location": f"/jobs/{job_id}"} if job_id else None)
+        
+        if len(missing) > INGEST_SYNC_MAX_QUERIES:
+            return json_response({
+                "success": 0,
+                "message": f"需要查询 {len(missing)} 个序列号，超过同步导入上限 {INGEST_SYNC_MAX_QUERIES}，请使用 async=1",
+                "data": {"summary": summary}
+            }, status=400)
+        lane = request_lane(BULK)
+        deadline = request_deadline()
+        by_vendor = {}
+        for vendor, serial_number in missing:
+            by_vendor.setdefault(vendor, []).append(serial_number)
+        for vendor, serial_numbers in by_vendor.items():
+            for result in run_vendor_batch(vendor, serial_numbers, refresh, lane, deadline):
+                results[(vendor, result["sn"])] = result
+        for row in plan.rows:
+            if "sn" in row:
+                row["result"] = results.get((row["vendor"], row["sn"]))
+        return json_response({
+            "success": 1,
+            "data": {"summary": summary, "rows": plan.rows}
+        })
+    except IngestError as e:
+        return json_response({
+            "success": 0,
+            "message": str(e)
+        }, status=400)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except BatchTooLarge as e:
+        return batch_too_large_response(e)
+    except Exception as e:
+        logger.error(f"API请求异常: {str(e)}")
+        return json_response({
+            "success": 0,
+            "message": f"请求异常: {str(e)}"
+        })
+
+@app.route('/stats/jobs', methods=['GET'])
+def job_queue_stats():
+    """API接口：异步任务统计"""
+    return json_response(get_job_queue().stats())
+
+@app.route('/stats/refresh', methods=['GET'])
+def refresh_scheduler_stats():
+    """API接口：后台刷新调度统计"""
+    return json_response(get_refresh_scheduler().stats())
+
 @app.route('/sn_query/lenovo', methods=['GET', 'POST'])
 def query_service_lenovo():
     """API接口：查询联想设备维保信息（预占位）"""
     try:
-        # 获取设备序列号
-        if request.method == 'GET':
-            serial_number = request.args.get('sn')
-        else:
-            serial_number = request.json.get('sn') if request.is_json else request.form.get('sn')
+        serial_number = get_request_serial_number("lenovo")
         
         if not serial_number:
-            return jsonify({
+            return json_response({
                 "success": 0,
                 "message": "设备序列号不能为空"
             })
@@ -1182,17 +2078,306 @@ def query_service_lenovo():
         logger.info(f"收到联想查询请求，设备序列号: {serial_number}")
         
         # 暂时返回空数据
-        return jsonify({
+        return json_response({
             "success": 1,
             "data": {}
         })
     except Exception as e:
         logger.error(f"API请求异常: {str(e)}")
-        return jsonify({
+        return json_response({
             "success": 0,
             "message": f"请求异常: {str(e)}"
         })
 
+@app.route('/warranty/expiring', methods=['GET'])
+def query_expiring_warranty():
+    """API接口：从已保存的查询结果中按到期日范围查询设备，不访问厂商网站"""
+    try:
+        today = datetime.date.today()
+        days = request.args.get('days')
+        before = request.args.get('before')
+        after = request.args.get('after')
+        if days:
+            before = before or (today + datetime.timedelta(days=int(days))).isoformat()
+            after = after or today.isoformat()
+        if not before:
+            return json_response({
+                "success": 0,
+                "message": "请指定 before 或 days 参数"
+            }, status=400)
+        
+        before_date = normalize_date(before)
+        after_date = normalize_date(after) if after else None
+        if not before_date or (after and not after_date):
+            return json_response({
+                "success": 0,
+                "message": "日期格式错误，应为 YYYY-MM-DD"
+            }, status=400)
+        
+        vendor = request.args.get('vendor')
+        if vendor and vendor not in EXPIRY_FIELDS:
+            return json_response({
+                "success": 0,
+                "message": f"不支持的厂商: {vendor}"
+            }, status=400)
+        
+        results = get_warranty_store().expiring(
+            before_date, after=after_date, vendor=vendor,
+            field=request.args.get('field'), limit=int(request.args.get('limit', '1000'))
+        )
+        return json_response({
+            "success": 1,
+            "data": results
+        })
+    except ValueError as e:
+        return json_response({
+            "success": 0,
+            "message": f"参数错误: {str(e)}"
+        }, status=400)
+    except Exception as e:
+        logger.error(f"API请求异常: {str(e)}")
+        return json_response({
+            "success": 0,
+            "message": f"请求异常: {str(e)}"
+        })
+
+# 变更订阅没有新记录时重新查询的间隔（秒），用于发现其他进程写入的记录；以及保活注释的发送间隔
+CHANGE_FEED_POLL_SECONDS = float(os.getenv('CHANGE_FEED_POLL_SECONDS', '1'))
+CHANGE_FEED_HEARTBEAT_SECONDS = float(os.getenv('CHANGE_FEED_HEARTBEAT_SECONDS', '15'))
+
+def change_events(cursor, vendor, serial_number):
+    """SSE事件流：依次输出编号大于 cursor 的变更记录，之后持续等待新的变更"""
+    store = get_warranty_store()
+    yield f"retry: {int(CHANGE_FEED_POLL_SECONDS * 1000) + 1000}\n\n"
+    last_sent = time.monotonic()
+    while True:
+        changes = store.changes(cursor, vendor=vendor, serial=serial_number)
+        for change in changes:
+            cursor = change["id"]
+            yield f"id: {cursor}\nevent: change\ndata: {dumps(change).decode('utf-8')}\n\n"
+        if changes:
+            last_sent = time.monotonic()
+            continue
+        if time.monotonic() - last_sent >= CHANGE_FEED_HEARTBEAT_SECONDS:
+            yield ": keepalive\n\n"
+            last_sent = time.monotonic()
+        store.wait_for_changes(CHANGE_FEED_POLL_SECONDS)
+
+@app.route('/warranty/changes', methods=['GET'])
+def warranty_changes():
+    """API接口：维保结果变更记录，Accept: text/event-stream 或 stream=1 时以SSE持续推送，否则返回JSON分页"""
+    try:
+        vendor = request.args.get('vendor')
+        if vendor and vendor not in EXPIRY_FIELDS:
+            return json_response({
+                "success": 0,
+                "message": f"不支持的厂商: {vendor}"
+            }, status=400)
+        serial_number = request.args.get('sn')
+        # 断线重连时浏览器和SSE客户端会带上 Last-Event-ID
+        cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+        stream = request.args.get('stream') == '1' or request.accept_mimetypes.best == 'text/event-stream'
+        if stream:
+            # 未指定游标时只推送之后的新变更
+            cursor = int(cursor) if cursor else get_warranty_store().latest_change_id()
+            return app.response_class(change_events(cursor, vendor, serial_number), mimetype='text/event-stream',
+                                      headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        cursor = int(cursor) if cursor else 0
+        changes = get_warranty_store().changes(cursor, vendor=vendor, serial=serial_number,
+                                               limit=int(request.args.get('limit', '100')))
+        return json_response({
+            "success": 1,
+            "data": changes,
+            "cursor": changes[-1]["id"] if changes else cursor
+        })
+    except ValueError as e:
+        return json_response({
+            "success": 0,
+            "message": f"参数错误: {str(e)}"
+        }, status=400)
+    except Exception as e:
+        logger.error(f"API请求异常: {str(e)}")
+        return json_response({
+            "success": 0,
+            "message": f"请求异常: {str(e)}"
+        })
+
+@app.route('/warranty/export', methods=['GET'])
+def export_warranty():
+    """API接口：流式导出全部已保存的维保记录，format 为 csv、jsonl、arrow 或 parquet（后两种需要安装 pyarrow）"""
+    fmt = request.args.get('format', 'csv')
+    vendor = request.args.get('vendor')
+    if fmt not in EXPORT_FORMATS:
+        return json_response({
+            "success": 0,
+            "message": f"不支持的导出格式: {fmt}"
+        }, status=400)
+    if vendor and vendor not in EXPIRY_FIELDS:
+        return json_response({
+            "success": 0,
+            "message": f"不支持的厂商: {vendor}"
+        }, status=400)
+    try:
+        chunks = export_chunks(fmt, vendor)
+    except RuntimeError as e:
+        return json_response({
+            "success": 0,
+            "message": str(e)
+        }, status=501)
+    suffix, mimetype = EXPORT_FORMATS[fmt]
+    filename = f"warranty-{vendor or 'all'}-{datetime.date.today().isoformat()}{suffix}"
+    return app.response_class(chunks, mimetype=mimetype,
+                              headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+@app.route('/stats/http', methods=['GET'])
+def http_transport_stats():
+    """API接口：上游连接池复用率与占用情况"""
+    return json_response(pool_stats())
+
+@app.route('/stats/hedge', methods=['GET'])
+def hedge_stats():
+    """API接口：对冲请求统计"""
+    return json_response({
+        "enabled": HEDGE_ENABLED,
+        "sangfor": sangfor_query_hedger.stats(),
+        "huawei": huawei_query_hedger.stats()
+    })
+
+@app.route('/stats/lanes', methods=['GET'])
+def lane_stats():
+    """API接口：各厂商优先级通道的名额占用与排队情况"""
+    return json_response({vendor: lanes.stats() for vendor, lanes in vendor_lanes.items()})
+
+@app.route('/stats/admission', methods=['GET'])
+def admission_stats():
+    """API接口：准入控制统计"""
+    return json_response({
+        "requests": request_limiter.stats(),
+        "vendors": {vendor: admission.stats() for vendor, admission in vendor_admission.items()}
+    })
+
+@app.route('/stats/cluster', methods=['GET'])
+def cluster_stats():
+    """API接口：集群模式状态"""
+    cluster = get_cluster()
+    if cluster is None:
+        return json_response({"enabled": False})
+    try:
+        return json_response(dict(enabled=True, **cluster.stats()))
+    except Exception as e:
+        logger.error(f"获取集群状态失败: {str(e)}")
+        return json_response({"success": 0, "message": f"获取集群状态失败: {str(e)}"}, status=503)
+
+@app.route('/stats/failures', methods=['GET'])
+def query_failure_stats():
+    """API接口：按厂商、失败类型和步骤统计的查询失败次数"""
+    return json_response(failure_stats.stats())
+
+@app.route('/stats/shm-cache', methods=['GET'])
+def shm_cache_stats():
+    """API接口：本机共享结果缓存状态"""
+    shm_cache = get_shm_cache()
+    if shm_cache is None:
+        return json_response({"enabled": False})
+    return json_response(dict(enabled=True, **shm_cache.stats()))
+
+@app.route('/stats/proxies', methods=['GET'])
+def proxy_stats():
+    """API接口：出口代理池状态与各代理吞吐统计"""
+    proxy_pool = get_proxy_pool()
+    if proxy_pool is None:
+        return json_response({"enabled": False})
+    return json_response(dict(enabled=True, **proxy_pool.stats()))
+
+@app.route('/stats/pipeline', methods=['GET'])
+def pipeline_stats():
+    """API接口：分阶段流水线各阶段的排队长度、耗时与利用率"""
+    if not PIPELINE_ENABLED:
+        return json_response({"enabled": False})
+    with vendor_pipelines_lock:
+        pipelines = dict(vendor_pipelines)
+    return json_response({"enabled": True, "vendors": {vendor: pipeline.stats() for vendor, pipeline in pipelines.items()}})
+
+@app.route('/admin/profile/sample', methods=['GET', 'POST'])
+def sample_profile():
+    """API接口：在指定秒数内采样所有线程的调用栈，返回折叠栈文本或JSON摘要（仅管理员）"""
+    if not is_admin(request_admin_token()):
+        return json_response({"success": 0, "message": "需要管理员令牌"}, status=403)
+    try:
+        seconds = float(request.values.get('seconds', '10'))
+        interval = float(request.values.get('interval', PROFILE_SAMPLE_INTERVAL))
+    except ValueError:
+        return json_response({"success": 0, "message": "seconds 和 interval 必须是数字"}, status=400)
+    sampler = StackSampler(interval, include_idle=request.values.get('idle', '1') != '0')
+    if not sampler.run(seconds):
+        return json_response({"success": 0, "message": "已有采样正在运行，请稍后重试"}, status=409)
+    if request.values.get('format') == 'json':
+        return json_response({"success": 1, "data": sampler.summary()})
+    return app.response_class(sampler.folded(), mimetype='text/plain; charset=utf-8',
+                              headers={"X-Profiled-Pid": str(os.getpid())})
+
+@app.route('/stats/captcha', methods=['GET'])
+def captcha_reuse_stats():
+    """API接口：验证码复用统计"""
+    return json_response({
+        "sangfor": sangfor_captcha_reuse.stats(),
+        "huawei": huawei_captcha_reuse.stats()
+    })
+
+# 验证码识别模型，首次使用（或预热）时加载，之后复用
+ocr_model = None
+ocr_model_lock = threading.Lock()
+
+def get_ocr_model():
+    """获取ddddocr模型实例，未安装ddddocr时抛出 ImportError"""
+    global ocr_model
+    with ocr_model_lock:
+        if ocr_model is None:
+            import ddddocr
+            ocr_model = ddddocr.DdddOcr()
+        return ocr_model
+
+def warm_sangfor():
+    """预热：深信服登录"""
+    if not ensure_login_client().session:
+        raise RuntimeError("获取深信服session失败")
+
+def warm_ocr_model():
+    """预热：加载本地验证码识别模型"""
+    try:
+        get_ocr_model()
+    except ImportError:
+        raise ComponentUnavailable("ddddocr库未安装")
+
+def warm_ocr_api():
+    """预热：建立到验证码识别接口的连接，任何HTTP响应都说明连接可用"""
+    shared_session('ocr').get(OCR_API_URL, timeout=10)
+
+# 各组件的就绪状态，服务启动后在后台预热
+readiness = Readiness()
+readiness.register('sangfor', warm_sangfor)
+readiness.register('huawei', huawei_client_pool.warm)
+readiness.register('ocr_model', warm_ocr_model, required=False)
+readiness.register('ocr_api', warm_ocr_api, required=False)
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """API接口：存活检查，进程能处理请求即返回200"""
+    return json_response({"status": "ok"})
+
+@app.route('/readyz', methods=['GET'])
+@app.route('/readyz/<component>', methods=['GET'])
+def readyz(component=None):
+    """API接口：就绪检查，所有必需组件（或指定组件）就绪时返回200，否则返回503"""
+    snapshot = readiness.snapshot()
+    if component is not None:
+        if component not in snapshot["components"]:
+            return json_response({"ready": False, "message": f"未知组件: {component}"}, status=404)
+        ready = readiness.is_ready(component)
+        return json_response({"ready": ready, component: snapshot["components"][component]},
+                             status=200 if ready else 503)
+    return json_response(snapshot, status=200 if snapshot["ready"] else 503)
+
 @app.route('/reg', methods=['POST'])
 def handle_captcha():
     """API接口：验证码识别"""
@@ -1202,15 +2387,12 @@ def handle_captcha():
         logger.info(f"收到验证码识别请求，图片大小: {len(img_base64)} 字节")
         
         # 解码base64字符串为图片字节
-        import base64
         img_bytes = base64.b64decode(img_base64)
         logger.info(f"解码后图片大小: {len(img_bytes)} 字节")
         
         # 尝试使用ddddocr识别验证码
         try:
-            import ddddocr
-            ocr = ddddocr.DdddOcr()
-            result = ocr.classification(img_bytes)
+            result = get_ocr_model().classification(img_bytes)
             # 取前四位
             captcha_text = result[0:4]
             logger.info(f"验证码识别成功: {captcha_text}")
@@ -1234,12 +2416,12 @@ if __name__ == "__main__":
     
     # 初始化登录客户端
     logger.info("初始化登录客户端")
-    login_client = SangforBBSLogin(username, password)
+    login_client = use_shared_session(SangforBBSLogin(username, password))
     
-    # 预登录，确保session有效
-    logger.info("预登录，确保session有效")
-    login_client.get_session()
+    # 后台预热、异步任务工作线程和后台刷新调度器
+    start_background()
     
     # 启动Flask应用
-    logger.info("启动Flask应用，监听端口9876")
-    app.run(host='0.0.0.0', port=9876, debug=False)
+    port = int(os.getenv('PORT', '9876'))
+    logger.info(f"启动Flask应用，监听端口{port}")
+    app.run(host='0.0.0.0', port=port, debug=False)
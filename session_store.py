@@ -0,0 +1,112 @@
+"""登录session持久化：cookie以带格式版本号的JSON原子写入本地文件，并记录最近一次确认session有效的时间
+
+重启时在信任时长内验证过的session直接使用，不再访问厂商网站验证；写入先写临时文件再替换，进程中途退出不会留下损坏的文件。
+"""
+import logging
+import os
+import pickle
+import tempfile
+import time
+
+from cluster import export_cookies
+from response_encoding import dumps, loads
+
+logger = logging.getLogger('ServiceQueryAPI.SessionStore')
+
+# session文件路径
+SESSION_FILE = os.getenv('SESSION_FILE', 'session.json')
+# 最近一次验证有效后多少秒内信任session，不再访问网站验证（0表示每次都验证）
+SESSION_TRUST_SECONDS = float(os.getenv('SESSION_TRUST_SECONDS', '300'))
+# 旧版本以pickle保存的session文件，读取后迁移为JSON
+LEGACY_SESSION_FILE = 'session.pkl'
+
+SESSION_FORMAT = 1
+
+
+def is_trusted(validated_at, now=None):
+    """validated_at 是否仍在信任时长内"""
+    if SESSION_TRUST_SECONDS <= 0 or not validated_at:
+        return False
+    return 0 <= (now or time.time()) - validated_at < SESSION_TRUST_SECONDS
+
+
+class SessionFile:
+    """本地session文件：{"format", "saved_at", "validated_at", "proxies", "cookies"}"""
+    def __init__(self, path=SESSION_FILE, legacy_path=LEGACY_SESSION_FILE):
+        self.path = path
+        self.legacy_path = legacy_path if legacy_path != path else None
+
+    def exists(self):
+        return os.path.exists(self.path) or bool(self.legacy_path and os.path.exists(self.legacy_path))
+
+    def load(self):
+        """读取保存的session，返回 {"cookies", "proxies", "validated_at"}；文件不存在、损坏或格式不兼容时返回 None"""
+        if not os.path.exists(self.path):
+            return self._load_legacy()
+        try:
+            with open(self.path, 'rb') as f:
+                data = loads(f.read())
+            if data.get("format") != SESSION_FORMAT or not isinstance(data.get("cookies"), list):
+                logger.warning(f"session文件 {self.path} 格式不兼容，忽略")
+                return None
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning(f"session文件 {self.path} 无法读取，忽略: {str(e)}")
+            return None
+        now = time.time()
+        # 已过期的cookie不再恢复
+        cookies = [cookie for cookie in data["cookies"] if not cookie.get("expires") or cookie["expires"] > now]
+        return {"cookies": cookies, "proxies": data.get("proxies") or {}, "validated_at": data.get("validated_at") or 0}
+
+    def _load_legacy(self):
+        if not self.legacy_path or not os.path.exists(self.legacy_path):
+            return None
+        try:
+            with open(self.legacy_path, 'rb') as f:
+                session = pickle.load(f)
+            logger.info(f"读取旧版session文件 {self.legacy_path}，验证后迁移为 {self.path}")
+            # 旧文件没有验证时间，需要重新验证
+            return {"cookies": export_cookies(session.cookies), "proxies": dict(session.proxies), "validated_at": 0}
+        except Exception as e:
+            logger.warning(f"旧版session文件 {self.legacy_path} 无法读取，忽略: {str(e)}")
+            return None
+
+    def save(self, session, validated_at=0):
+        """原子写入session的cookie、出口代理和验证时间"""
+        data = dumps({
+            "format": SESSION_FORMAT,
+            "saved_at": time.time(),
+            "validated_at": validated_at,
+            "proxies": dict(session.proxies),
+            "cookies": export_cookies(session.cookies),
+        })
+        directory = os.path.dirname(os.path.abspath(self.path))
+        # 临时文件与目标文件在同一目录，保证替换是原子的；mkstemp 创建的文件只有当前用户可读写
+        fd, temp_path = tempfile.mkstemp(prefix='.session-', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        if self.legacy_path and os.path.exists(self.legacy_path):
+            self._remove(self.legacy_path)
+
+    def remove(self):
+        """删除session文件（包括旧版文件）"""
+        for path in (self.path, self.legacy_path):
+            if path and os.path.exists(path):
+                self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            logger.info(f"已删除session文件 {path}")
+        except OSError as e:
+            logger.error(f"删除session文件失败: {str(e)}")
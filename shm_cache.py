@@ -0,0 +1,204 @@
+"""主机内共享结果缓存：同一台机器上的多个工作进程通过内存映射文件共享查询结果
+
+文件划分为固定大小的槽位，键经哈希后在相邻几个槽位中查找。读取不加锁：每个槽位带有序号（seqlock），
+写入前后各加一，读取时序号为奇数或前后不一致、或校验和不符就重读；写入在进程内加线程锁、进程间加文件锁。
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from response_encoding import dumps, loads
+
+logger = logging.getLogger('ServiceQueryAPI.ShmCache')
+
+# 缓存文件路径，为空时不启用；建议放在 /dev/shm 等内存文件系统上
+SHM_CACHE_PATH = os.getenv('SHM_CACHE_PATH', '')
+# 缓存文件大小（MB）与每个槽位的字节数，超过槽位大小的结果不缓存
+SHM_CACHE_SIZE_MB = int(os.getenv('SHM_CACHE_SIZE_MB', '64'))
+SHM_CACHE_SLOT_BYTES = int(os.getenv('SHM_CACHE_SLOT_BYTES', '4096'))
+# 每个键可以存放的相邻槽位数
+SHM_CACHE_PROBES = 4
+# 读取时遇到并发写入的最多重试次数
+READ_RETRIES = 8
+
+MAGIC = b'SQAPISHM'
+FORMAT_VERSION = 1
+# 文件头：标识、格式版本、槽位数、槽位字节数
+HEADER = struct.Struct('<8sIII')
+HEADER_SIZE = 64
+# 槽位头：序号、键哈希、过期时间、值长度、键长度、保留、校验和
+SLOT_HEADER = struct.Struct('<QQdIHHI')
+SLOT_HEADER_SIZE = 40
+SEQ = struct.Struct('<Q')
+
+
+def _hash(key):
+    """64位键哈希，0 表示空槽位"""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') | 1
+
+
+class ShmCache:
+    """基于内存映射文件的多进程共享缓存"""
+    def __init__(self, path=SHM_CACHE_PATH, size_mb=SHM_CACHE_SIZE_MB, slot_bytes=SHM_CACHE_SLOT_BYTES):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "expired": 0, "writes": 0, "evictions": 0,
+                         "too_large": 0, "read_retries": 0}
+        with self._write_lock():
+            size = os.fstat(self.fd).st_size
+            wanted = HEADER_SIZE + max(1, size_mb * 1024 * 1024 // slot_bytes) * slot_bytes
+            if size < HEADER_SIZE:
+                os.ftruncate(self.fd, wanted)
+                size = wanted
+            self.mm = mmap.mmap(self.fd, size)
+            magic, version, slot_count, existing_slot_bytes = HEADER.unpack_from(self.mm, 0)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                slot_count = (size - HEADER_SIZE) // slot_bytes
+                existing_slot_bytes = slot_bytes
+                self.mm[:] = bytes(size)
+                HEADER.pack_into(self.mm, 0, MAGIC, FORMAT_VERSION, slot_count, slot_bytes)
+                logger.info(f"已初始化共享缓存 {path}，槽位 {slot_count} 个，每个 {slot_bytes} 字节")
+            elif existing_slot_bytes != slot_bytes:
+                # 以文件中已有的布局为准，其他进程正在使用
+                logger.warning(f"共享缓存 {path} 已按每槽位 {existing_slot_bytes} 字节创建，忽略当前配置")
+        self.slot_count = slot_count
+        self.slot_bytes = existing_slot_bytes
+
+    @contextmanager
+    def _write_lock(self):
+        """写入锁：进程内的线程锁加进程间的文件锁"""
+        with self.lock:
+            if fcntl is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _count(self, name, amount=1):
+        # 统计只在本进程内累计，计数偶尔不准不影响结果
+        self.counters[name] += amount
+
+    def _offsets(self, key_hash):
+        for probe in range(SHM_CACHE_PROBES):
+            yield HEADER_SIZE + ((key_hash + probe) % self.slot_count) * self.slot_bytes
+
+    def get(self, key):
+        """读取键对应的字节串，不存在或已过期时返回 None"""
+        key = key.encode('utf-8')
+        key_hash = _hash(key)
+        mm = self.mm
+        for offset in self._offsets(key_hash):
+            for _ in range(READ_RETRIES):
+                seq, slot_hash, expires, value_len, key_len, _, checksum = SLOT_HEADER.unpack_from(mm, offset)
+                if seq & 1:
+                    # 正在写入
+                    self._count('read_retries')
+                    time.sleep(0)
+                    continue
+                if slot_hash != key_hash or key_len + value_len > self.slot_bytes - SLOT_HEADER_SIZE:
+                    break
+                start = offset + SLOT_HEADER_SIZE
+                data = mm[start:start + key_len + value_len]
+                if SEQ.unpack_from(mm, offset)[0] != seq or zlib.crc32(data) != checksum:
+                    self._count('read_retries')
+                    continue
+                if data[:key_len] != key:
+                    break
+                if expires < time.time():
+                    self._count('expired')
+                    return None
+                self._count('hits')
+                return data[key_len:]
+        self._count('misses')
+        return None
+
+    def _choose_slot(self, key_hash, key, now):
+        """选择写入的槽位：优先覆盖同一个键，其次空槽位或已过期的槽位，都没有时淘汰最早过期的；返回（偏移，是否淘汰）"""
+        free = None
+        oldest = None
+        for offset in self._offsets(key_hash):
+            _, slot_hash, expires, _, key_len, _, _ = SLOT_HEADER.unpack_from(self.mm, offset)
+            start = offset + SLOT_HEADER_SIZE
+            if slot_hash == key_hash and self.mm[start:start + key_len] == key:
+                return offset, False
+            if slot_hash == 0 or expires < now:
+                free = free if free is not None else offset
+            elif oldest is None or expires < oldest[1]:
+                oldest = (offset, expires)
+        if free is not None:
+            return free, False
+        return oldest[0], True
+
+    def set(self, key, value, ttl):
+        """写入键值，ttl 秒后过期；值超过槽位大小时不写入并返回 False"""
+        key = key.encode('utf-8')
+        if SLOT_HEADER_SIZE + len(key) + len(value) > self.slot_bytes:
+            self._count('too_large')
+            return False
+        key_hash = _hash(key)
+        data = key + value
+        now = time.time()
+        with self._write_lock():
+            offset, evicted = self._choose_slot(key_hash, key, now)
+            seq = SEQ.unpack_from(self.mm, offset)[0]
+            # 序号为奇数说明上次写入中途退出，直接加一使其变为偶数后再开始
+            seq += 2 if seq & 1 == 0 else 1
+            SEQ.pack_into(self.mm, offset, seq - 1)
+            start = offset + SLOT_HEADER_SIZE
+            self.mm[start:start + len(data)] = data
+            SLOT_HEADER.pack_into(self.mm, offset, seq - 1, key_hash, now + ttl, len(value), len(key), 0, zlib.crc32(data))
+            SEQ.pack_into(self.mm, offset, seq)
+        self._count('writes')
+        if evicted:
+            self._count('evictions')
+        return True
+
+    def get_json(self, key):
+        raw = self.get(key)
+        return loads(raw) if raw is not None else None
+
+    def set_json(self, key, payload, ttl):
+        return self.set(key, dumps(payload), ttl)
+
+    def stats(self):
+        """本进程的计数，以及整个文件中未过期的槽位数"""
+        now = time.time()
+        used = 0
+        for index in range(self.slot_count):
+            _, slot_hash, expires, _, _, _, _ = SLOT_HEADER.unpack_from(self.mm, HEADER_SIZE + index * self.slot_bytes)
+            used += slot_hash != 0 and expires >= now
+        return dict(self.counters, path=self.path, slots=self.slot_count, slot_bytes=self.slot_bytes, used_slots=used)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_cache_failed = False
+
+
+def get_shm_cache():
+    """获取共享缓存，未配置 SHM_CACHE_PATH 或打开失败时返回 None"""
+    global _cache, _cache_failed
+    if not SHM_CACHE_PATH or _cache_failed:
+        return None
+    with _cache_lock:
+        if _cache is None and not _cache_failed:
+            try:
+                _cache = ShmCache()
+            except Exception as e:
+                _cache_failed = True
+                logger.error(f"打开共享缓存 {SHM_CACHE_PATH} 失败，不使用共享缓存: {str(e)}")
+        return _cache
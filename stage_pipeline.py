@@ -0,0 +1,219 @@
+"""分阶段流水线执行器：把一次查询拆成获取验证码、OCR识别、验证、查询、解析等阶段，每个阶段有独立的队列和工作线程
+
+不同请求的不同阶段同时进行：一个请求等待OCR时，下一个请求的验证码已经在下载。吞吐量受最慢的阶段限制，而不是各阶段耗时之和；
+各阶段的利用率和排队长度可用于判断应给哪个阶段增加并发。
+"""
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+
+from priority_lanes import INTERACTIVE
+from profiling import current_profile, profiled
+
+logger = logging.getLogger('ServiceQueryAPI.Pipeline')
+
+# 是否以分阶段流水线执行单个查询和批量查询
+PIPELINE_ENABLED = os.getenv('PIPELINE_ENABLED', '0') == '1'
+# 每个阶段的默认工作线程数，可用 PIPELINE_WORKERS_<厂商>_<阶段> 单独指定
+PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', '4'))
+# 单个查询最多失败的次数，超过后返回失败
+PIPELINE_MAX_ATTEMPTS = int(os.getenv('PIPELINE_MAX_ATTEMPTS', '5'))
+
+
+def stage_workers(vendor, stage, default=PIPELINE_WORKERS):
+    """读取厂商某个阶段的工作线程数"""
+    return max(1, int(os.getenv(f'PIPELINE_WORKERS_{vendor.upper()}_{stage.upper()}', str(default))))
+
+
+class PipelineTask:
+    """流水线中的一个查询；state 保存各阶段之间传递的中间结果，result 为最终的响应数据"""
+    def __init__(self, serial_number, priority, sequence):
+        self.serial_number = serial_number
+        self.priority = priority
+        self.sequence = sequence
+        self.state = {}
+        self.attempts = 0
+        self.failure = None
+        self.result = None
+        self.enqueued_at = 0.0
+        self.done = threading.Event()
+        # 提交任务的请求正在剖析时，各阶段的执行一并计入该请求的剖析结果
+        self.profile = current_profile()
+
+    def wait(self):
+        self.done.wait()
+        return self.result
+
+
+class StageStats:
+    __slots__ = ('processed', 'failed', 'busy', 'busy_time', 'wait_total', 'wait_max')
+
+    def __init__(self):
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0
+        self.busy_time = 0.0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class Stage:
+    """一个阶段：按优先级和进入流水线的先后排队，由固定个数的工作线程处理"""
+    def __init__(self, name, handler, workers):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        # (优先级, 序号, 任务)：交互查询优先，同优先级时先进入流水线的请求先处理，尽早完成已开始的请求
+        self.queue = queue.PriorityQueue()
+        self.stats = StageStats()
+
+
+class StagePipeline:
+    """按 flow 定义的阶段执行查询
+
+    flow 需要提供：
+    - name：厂商名
+    - stages：[(阶段名, 处理函数, 默认工作线程数)]，第一个为入口阶段；处理函数接收任务，返回下一个阶段名，
+      设置好 task.result 后返回 None 表示完成，失败时抛出异常
+    - retry(task, error)：返回 (重试的阶段名, 延迟秒数)，返回 None 表示不再重试
+    - give_up(task)：重试次数用完或不再重试且没有结果时设置 task.result
+    - finish(task)：任务完成后释放占用的资源
+    """
+    def __init__(self, flow, max_attempts=PIPELINE_MAX_ATTEMPTS):
+        self.flow = flow
+        self.max_attempts = max_attempts
+        self.stages = {}
+        for name, handler, workers in flow.stages:
+            self.stages[name] = Stage(name, handler, stage_workers(flow.name, name, workers))
+        self.entry = flow.stages[0][0]
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+        self.started_at = time.monotonic()
+        self.in_flight = 0
+        self.completed = 0
+        self.retries = 0
+        for stage in self.stages.values():
+            for index in range(stage.workers):
+                threading.Thread(target=self._work, args=(stage,), daemon=True,
+                                 name=f"pipeline-{flow.name}-{stage.name}-{index}").start()
+
+    def submit(self, serial_number, lane=INTERACTIVE):
+        """提交一个查询，返回任务，调用 task.wait() 等待结果"""
+        task = PipelineTask(serial_number, 0 if lane == INTERACTIVE else 1, next(self.sequence))
+        with self.lock:
+            self.in_flight += 1
+        self._enqueue(task, self.entry)
+        return task
+
+    def run(self, serial_number, lane=INTERACTIVE):
+        """查询单个序列号，返回响应数据"""
+        return self.submit(serial_number, lane).wait()
+
+    def run_many(self, serial_numbers, lane=INTERACTIVE):
+        """同时提交多个序列号，按顺序返回响应数据"""
+        tasks = [self.submit(serial_number, lane) for serial_number in serial_numbers]
+        return [task.wait() for task in tasks]
+
+    def _enqueue(self, task, stage_name):
+        stage = self.stages.get(stage_name)
+        if stage is None:
+            logger.error(f"{self.flow.name} 流水线没有阶段 {stage_name}，从入口阶段重新开始")
+            stage = self.stages[self.entry]
+        task.enqueued_at = time.monotonic()
+        stage.queue.put((task.priority, task.sequence, task))
+
+    def _work(self, stage):
+        while True:
+            _, _, task = stage.queue.get()
+            started = time.monotonic()
+            waited = started - task.enqueued_at
+            with self.lock:
+                stage.stats.busy += 1
+                stage.stats.wait_total += waited
+                stage.stats.wait_max = max(stage.stats.wait_max, waited)
+            error = None
+            next_stage = None
+            try:
+                next_stage = profiled(task.profile, stage.handler, task)
+            except Exception as e:
+                error = e
+            with self.lock:
+                stage.stats.busy -= 1
+                stage.stats.busy_time += time.monotonic() - started
+                stage.stats.processed += 1
+                if error is not None:
+                    stage.stats.failed += 1
+            if error is not None:
+                self._retry(task, stage.name, error)
+            elif next_stage is None:
+                self._finish(task)
+            else:
+                self._enqueue(task, next_stage)
+
+    def _retry(self, task, stage_name, error):
+        task.attempts += 1
+        task.failure = error
+        try:
+            route = self.flow.retry(task, error)
+        except Exception as e:
+            logger.error(f"{self.flow.name} 流水线处理 {stage_name} 阶段失败时出错: {str(e)}")
+            route = None
+        if route is not None and task.attempts >= self.max_attempts:
+            logger.error(f"{task.serial_number} 已失败 {task.attempts} 次，不再重试")
+            route = None
+        if route is None:
+            if task.result is None:
+                self.flow.give_up(task)
+            self._finish(task)
+            return
+        retry_stage, delay = route
+        with self.lock:
+            self.retries += 1
+        if delay > 0:
+            timer = threading.Timer(delay, self._enqueue, (task, retry_stage))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._enqueue(task, retry_stage)
+
+    def _finish(self, task):
+        try:
+            self.flow.finish(task)
+        except Exception as e:
+            logger.error(f"{self.flow.name} 流水线释放资源失败: {str(e)}")
+        with self.lock:
+            self.in_flight -= 1
+            self.completed += 1
+        task.done.set()
+
+    def stats(self):
+        """各阶段的排队长度、处理次数、平均等待与处理耗时，以及利用率（忙碌时间 / (工作线程数 × 运行时间)）"""
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        stages = {}
+        with self.lock:
+            for name, stage in self.stages.items():
+                stats = stage.stats
+                stages[name] = {
+                    "workers": stage.workers,
+                    "queued": stage.queue.qsize(),
+                    "busy": stats.busy,
+                    "processed": stats.processed,
+                    "failed": stats.failed,
+                    "avg_wait_ms": round(stats.wait_total / stats.processed * 1000, 2) if stats.processed else 0.0,
+                    "max_wait_ms": round(stats.wait_max * 1000, 2),
+                    "avg_service_ms": round(stats.busy_time / stats.processed * 1000, 2) if stats.processed else 0.0,
+                    "utilization": round(stats.busy_time / (stage.workers * elapsed), 3),
+                }
+            in_flight, completed, retries = self.in_flight, self.completed, self.retries
+        # 利用率最高的阶段限制了流水线的吞吐量
+        bottleneck = max(stages, key=lambda name: stages[name]["utilization"]) if completed else None
+        return {
+            "in_flight": in_flight,
+            "completed": completed,
+            "retries": retries,
+            "bottleneck": bottleneck,
+            "stages": stages,
+        }
@@ -0,0 +1,261 @@
+"""上游HTTP流量录制与回放：将真实的上游交互保存为压缩的cassette文件（敏感信息已脱敏），并可按原始耗时或最快速度回放"""
+import argparse
+import base64
+import collections
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from io import BytesIO
+from urllib.parse import urlsplit, parse_qsl
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+logger = logging.getLogger('ServiceQueryAPI.Cassette')
+
+REDACTED = "<redacted>"
+# 需要脱敏的请求/响应头
+SECRET_HEADERS = {"cookie", "set-cookie", "authorization", "proxy-authorization"}
+# 需要脱敏的表单/查询字段
+SECRET_FIELDS = {"username", "password", "auth", "saltkey"}
+# 回放时用于区分同一路径下不同操作的查询参数，其余参数（随机数、验证码、序列号等）不参与匹配
+ROUTE_PARAMS = ("mod", "action", "op", "id", "type", "loginsubmit")
+
+
+def _redact_headers(headers):
+    return {k: (REDACTED if k.lower() in SECRET_HEADERS else v) for k, v in headers.items()}
+
+
+def _redact_body(body):
+    """对 x-www-form-urlencoded 请求体中的敏感字段脱敏"""
+    if body is None:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', errors='replace')
+    if "=" not in body:
+        return body
+    pairs = parse_qsl(body, keep_blank_values=True)
+    if not pairs:
+        return body
+    return "&".join(f"{k}={REDACTED if k in SECRET_FIELDS else v}" for k, v in pairs)
+
+
+def _encode_content(content):
+    try:
+        return {"text": content.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {"b64": base64.b64encode(content).decode('ascii')}
+
+
+def _decode_content(body):
+    if "b64" in body:
+        return base64.b64decode(body["b64"])
+    return body.get("text", "").encode('utf-8')
+
+
+def route_key(method, url):
+    """回放匹配键：请求方法 + 路径 + 路由参数"""
+    parts = urlsplit(url)
+    params = dict(parse_qsl(parts.query, keep_blank_values=True))
+    route = "&".join(f"{name}={params[name]}" for name in ROUTE_PARAMS if name in params)
+    return f"{method.upper()} {parts.path or '/'}?{route}"
+
+
+class CassetteRecorder:
+    """将上游交互追加写入cassette文件（gzip压缩的JSON Lines）"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def record(self, request, response, elapsed):
+        exchange = {
+            "t": round(time.time() - elapsed - self.started, 4),
+            "elapsed": round(elapsed, 4),
+            "request": {
+                "method": request.method,
+                "url": request.url,
+                "headers": _redact_headers(request.headers),
+                "body": _redact_body(request.body),
+            },
+            "response": {
+                "status": response.status_code,
+                "reason": response.reason,
+                "headers": _redact_headers(response.headers),
+                "body": _encode_content(response.content),
+            },
+        }
+        line = json.dumps(exchange, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self.lock:
+            # 以追加模式写入独立的gzip成员，进程中断也不会损坏已录制的内容
+            with gzip.open(self.path, 'ab') as f:
+                f.write(line.encode('utf-8'))
+
+
+class RecordingAdapter(HTTPAdapter):
+    """正常发送请求，同时把交互写入cassette"""
+    def __init__(self, recorder, **kwargs):
+        self.recorder = recorder
+        super().__init__(**kwargs)
+
+    def __reduce__(self):
+        # session被pickle保存时退化为普通适配器，加载后由 install_adapters 重新挂载
+        return (HTTPAdapter, ())
+
+    def send(self, request, **kwargs):
+        start = time.perf_counter()
+        response = super().send(request, **kwargs)
+        # 读取完整响应体后再计时，包含传输耗时
+        response.content
+        try:
+            self.recorder.record(request, response, time.perf_counter() - start)
+        except Exception as e:
+            logger.error(f"录制上游交互失败: {str(e)}")
+        return response
+
+
+def load_cassette(path):
+    """读取cassette中的全部交互"""
+    exchanges = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                exchanges.append(json.loads(line))
+    return exchanges
+
+
+def arrivals(exchanges, vendor):
+    """返回cassette中该厂商每次设备查询（深信服 doquery、华为 findHardWareVyborgForWeb）的录制时刻，从0开始的秒数
+
+    录制时刻是查询步骤发出的时间，比客户端请求到达服务的时间晚验证码等前置步骤的耗时，用作回放时的到达时刻。
+    """
+    offsets = []
+    for exchange in exchanges:
+        request = exchange["request"]
+        parts = urlsplit(request["url"])
+        if vendor == "sangfor":
+            matched = dict(parse_qsl(parts.query)).get("op") == "doquery"
+        else:
+            matched = parts.path.endswith("/findHardWareVyborgForWeb")
+        if matched:
+            offsets.append(exchange["t"])
+    offsets.sort()
+    return [offset - offsets[0] for offset in offsets]
+
+
+class ReplayAdapter(BaseAdapter):
+    """从cassette回放上游响应，不访问网络；realtime 只按每次交互的录制耗时延迟返回，请求的发起时刻由调用方决定"""
+    def __init__(self, exchanges, speed="fast"):
+        super().__init__()
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.tracks = collections.defaultdict(list)
+        self.cursors = collections.defaultdict(int)
+        for exchange in exchanges:
+            request = exchange["request"]
+            self.tracks[route_key(request["method"], request["url"])].append(exchange)
+
+    def next_exchange(self, key):
+        """按录制顺序取出下一条匹配的交互，用完后循环"""
+        with self.lock:
+            track = self.tracks.get(key)
+            if not track:
+                return None
+            index = self.cursors[key]
+            self.cursors[key] = index + 1
+            return track[index % len(track)]
+
+    def send(self, request, **kwargs):
+        key = route_key(request.method, request.url)
+        exchange = self.next_exchange(key)
+        response = Response()
+        response.request = request
+        response.url = request.url
+        if exchange is None:
+            logger.warning(f"cassette中没有匹配的交互: {key}")
+            response.status_code = 599
+            response.reason = "Not Recorded"
+            response.raw = BytesIO(b"")
+            return response
+        if self.speed == "realtime":
+            time.sleep(exchange["elapsed"])
+        recorded = exchange["response"]
+        content = _decode_content(recorded["body"])
+        headers = CaseInsensitiveDict(recorded["headers"])
+        # 录制时的响应体已解压，去掉压缩与分块相关的头
+        for name in ("Content-Encoding", "Transfer-Encoding", "Set-Cookie"):
+            headers.pop(name, None)
+        headers["Content-Length"] = str(len(content))
+        response.status_code = recorded["status"]
+        response.reason = recorded.get("reason")
+        response.headers = headers
+        response.raw = BytesIO(content)
+        response.encoding = get_encoding_from_headers(headers)
+        return response
+
+    def close(self):
+        pass
+
+    def __reduce__(self):
+        return (HTTPAdapter, ())
+
+
+_recorder = None
+_replayer = None
+_install_lock = threading.Lock()
+
+
+def cassette_mode():
+    """当前录制/回放模式：record、replay 或 off"""
+    return os.getenv('UPSTREAM_CASSETTE_MODE', 'off').lower()
+
+
+def install_adapters(session, **adapter_kwargs):
+    """按环境变量为session挂载录制或回放适配器，adapter_kwargs 传给录制适配器的连接池"""
+    global _recorder, _replayer
+    mode = cassette_mode()
+    if mode not in ("record", "replay"):
+        return session
+    path = os.getenv('UPSTREAM_CASSETTE', 'upstream_cassette.jsonl.gz')
+    with _install_lock:
+        if mode == "record":
+            if _recorder is None:
+                _recorder = CassetteRecorder(path)
+                logger.info(f"上游流量录制已开启，写入 {path}")
+            adapter = RecordingAdapter(_recorder, **adapter_kwargs)
+        else:
+            if _replayer is None:
+                speed = os.getenv('UPSTREAM_REPLAY_SPEED', 'fast').lower()
+                _replayer = ReplayAdapter(load_cassette(path), speed=speed)
+                logger.info(f"上游流量回放已开启，读取 {path}，速度: {speed}")
+            adapter = _replayer
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def summarize(path):
+    """按路由统计cassette中的交互数量和耗时"""
+    stats = collections.defaultdict(list)
+    for exchange in load_cassette(path):
+        request = exchange["request"]
+        stats[route_key(request["method"], request["url"])].append(exchange["elapsed"])
+    print("| 路由 | 次数 | p50(ms) | p95(ms) | max(ms) |")
+    print("|------|------|---------|---------|---------|")
+    for key, values in sorted(stats.items()):
+        values.sort()
+        p50 = values[int(0.50 * (len(values) - 1))] * 1000
+        p95 = values[int(0.95 * (len(values) - 1))] * 1000
+        print(f"| {key} | {len(values)} | {p50:.1f} | {p95:.1f} | {values[-1] * 1000:.1f} |")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="查看上游流量cassette")
+    parser.add_argument("cassette", help="cassette文件路径")
+    summarize(parser.parse_args().cassette)
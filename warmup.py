@@ -0,0 +1,117 @@
+"""后台预热与就绪状态：服务启动后立即监听端口，各组件（登录、客户端池、OCR模型、上游连接）在后台线程中预热并分别报告就绪状态"""
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('ServiceQueryAPI.Warmup')
+
+# 预热失败后的首次重试间隔与最长重试间隔（秒），按指数退避
+WARMUP_RETRY_DELAY = float(os.getenv('WARMUP_RETRY_DELAY', '5'))
+WARMUP_RETRY_MAX_DELAY = float(os.getenv('WARMUP_RETRY_MAX_DELAY', '300'))
+
+# 组件状态
+PENDING = 'pending'
+WARMING = 'warming'
+READY = 'ready'
+FAILED = 'failed'
+UNAVAILABLE = 'unavailable'
+
+
+class ComponentUnavailable(Exception):
+    """组件在当前环境中不可用（如未安装可选依赖），不再重试"""
+
+
+class Component:
+    """一个需要预热的组件及其状态"""
+    def __init__(self, name, warm, required=True):
+        self.name = name
+        self.warm = warm
+        self.required = required
+        self.status = PENDING
+        self.error = None
+        self.attempts = 0
+        self.ready_at = None
+        self.duration = None
+
+    def snapshot(self):
+        return {
+            "status": self.status,
+            "required": self.required,
+            "attempts": self.attempts,
+            "duration_s": round(self.duration, 3) if self.duration is not None else None,
+            "ready_at": self.ready_at,
+            "error": self.error,
+        }
+
+
+class Readiness:
+    """组件就绪状态注册表，每个组件在独立线程中预热，失败时退避重试直到成功"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.components = {}
+        self.started_at = time.time()
+        self.threads = []
+
+    def register(self, name, warm, required=True):
+        with self.lock:
+            self.components[name] = Component(name, warm, required)
+
+    def _warm(self, component):
+        delay = WARMUP_RETRY_DELAY
+        while component.status != READY:
+            component.status = WARMING
+            component.attempts += 1
+            start = time.perf_counter()
+            try:
+                component.warm()
+                component.duration = time.perf_counter() - start
+                self.mark_ready(component.name)
+                logger.info(f"组件 {component.name} 预热完成，耗时 {component.duration:.2f} 秒")
+                return
+            except ComponentUnavailable as e:
+                component.status = UNAVAILABLE
+                component.error = str(e)
+                logger.warning(f"组件 {component.name} 不可用: {str(e)}")
+                return
+            except Exception as e:
+                component.status = FAILED
+                component.error = str(e)
+                logger.error(f"组件 {component.name} 预热失败（第 {component.attempts} 次），{delay:.0f}秒后重试: {str(e)}")
+            time.sleep(delay)
+            delay = min(delay * 2, WARMUP_RETRY_MAX_DELAY)
+
+    def start(self):
+        """在后台线程中预热所有组件，立即返回"""
+        with self.lock:
+            if self.threads:
+                return self
+            for component in self.components.values():
+                thread = threading.Thread(target=self._warm, args=(component,), name=f'warmup-{component.name}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        return self
+
+    def mark_ready(self, name):
+        """标记组件已就绪（请求处理中首次成功时也可调用）"""
+        component = self.components.get(name)
+        if component is not None and component.status != READY:
+            component.status = READY
+            component.error = None
+            component.ready_at = time.time()
+
+    def is_ready(self, name=None):
+        """指定组件是否就绪；不指定时判断所有必需组件"""
+        if name is not None:
+            component = self.components.get(name)
+            return component is not None and component.status == READY
+        return all(component.status == READY for component in self.components.values() if component.required)
+
+    def snapshot(self):
+        with self.lock:
+            components = {name: component.snapshot() for name, component in self.components.items()}
+        return {
+            "ready": self.is_ready(),
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "components": components,
+        }
@@ -0,0 +1,236 @@
+"""维保数据导出：分批读取全部已保存的维保记录，统一各厂商字段后以CSV、JSONL、Arrow或Parquet格式流式输出，内存占用与数据量无关"""
+import argparse
+import csv
+import datetime
+import functools
+import io
+import logging
+import os
+import sys
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from response_encoding import dumps
+from warranty_fields import EXPIRY_FIELDS, normalize_date
+from warranty_store import WarrantyStore, get_warranty_store, WARRANTY_DB_PATH
+
+logger = logging.getLogger('ServiceQueryAPI.Export')
+
+# 每批输出的行数，也是Arrow记录批和Parquet行组的大小
+EXPORT_BATCH_ROWS = int(os.getenv('EXPORT_BATCH_ROWS', '10000'))
+# Parquet压缩算法：snappy、zstd、gzip 或 none
+EXPORT_PARQUET_COMPRESSION = os.getenv('EXPORT_PARQUET_COMPRESSION', 'snappy')
+
+# 统一的导出列：(列名, 类型)，“到期日”为各厂商的主要到期字段（深信服硬件维保有效期、华为结束日期）
+EXPORT_COLUMNS = (
+    ("厂商", "string"),
+    ("序列号", "string"),
+    ("记录序号", "int"),
+    ("设备型号", "string"),
+    ("服务套餐", "string"),
+    ("开始日期", "date"),
+    ("到期日", "date"),
+    ("状态", "string"),
+    ("网络远程支持有效期", "date"),
+    ("同等功能软件升级有效期", "date"),
+    ("服务商名称", "string"),
+    ("服务电话", "string"),
+    ("网关id", "string"),
+    ("国家/地区", "string"),
+    ("保修区域", "string"),
+    ("描述", "string"),
+    ("更新时间", "timestamp"),
+)
+COLUMN_NAMES = tuple(name for name, _ in EXPORT_COLUMNS)
+
+# 格式: (文件扩展名, MIME类型)；arrow 为Arrow IPC文件格式（即Feather v2），可内存映射零拷贝读取
+EXPORT_FORMATS = {
+    "csv": (".csv", "text/csv; charset=utf-8"),
+    "jsonl": (".jsonl", "application/x-ndjson"),
+    "arrow": (".arrow", "application/vnd.apache.arrow.file"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+COLUMNAR_FORMATS = ("arrow", "parquet")
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_date(value):
+    # 同一批设备的日期大多相同，缓存解析结果
+    date = normalize_date(value)
+    return datetime.date.fromisoformat(date) if date else None
+
+
+@functools.lru_cache(maxsize=None)
+def _column_sources(vendor):
+    """厂商记录中与“记录序号”和“更新时间”之间各列对应的 (原字段, 是否日期) 列表"""
+    sources = []
+    for name, kind in EXPORT_COLUMNS[3:-1]:
+        field = EXPIRY_FIELDS[vendor][0] if name == "到期日" and vendor in EXPIRY_FIELDS else name
+        sources.append((field, kind == "date"))
+    return tuple(sources)
+
+
+def normalize_item(vendor, serial, index, item, updated_at):
+    """把一条厂商记录转换为统一列的取值列表，日期列为 date，更新时间为UTC datetime，缺失为 None"""
+    values = [vendor, item.get("序列号") or serial, index]
+    for field, is_date in _column_sources(vendor):
+        value = item.get(field)
+        if is_date:
+            value = _parse_date(value) if isinstance(value, (str, int, float)) else None
+        elif value == "":
+            value = None
+        values.append(value)
+    values.append(datetime.datetime.fromtimestamp(updated_at, datetime.timezone.utc))
+    return values
+
+
+def iter_batches(store, vendor=None, batch_rows=EXPORT_BATCH_ROWS):
+    """逐批返回按列组织的导出数据：{列名: 取值列表}"""
+    columns = {name: [] for name in COLUMN_NAMES}
+    rows = 0
+    for vendor_name, serial, items, updated_at in store.iter_records(vendor):
+        for index, item in enumerate(items):
+            for name, value in zip(COLUMN_NAMES, normalize_item(vendor_name, serial, index, item, updated_at)):
+                columns[name].append(value)
+            rows += 1
+            if rows >= batch_rows:
+                yield columns
+                columns = {name: [] for name in COLUMN_NAMES}
+                rows = 0
+    if rows:
+        yield columns
+
+
+def _text(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(timespec='seconds')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMN_NAMES)
+    for columns in batches:
+        writer.writerows(zip(*(map(_text, columns[name]) for name in COLUMN_NAMES)))
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    # 没有任何记录时仍输出表头
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def jsonl_chunks(batches):
+    for columns in batches:
+        yield b"".join(
+            dumps(dict(zip(COLUMN_NAMES, map(_text, row)))) + b"\n"
+            for row in zip(*(columns[name] for name in COLUMN_NAMES)))
+
+
+class _ChunkSink(io.RawIOBase):
+    """只追加的输出缓冲，pyarrow 写入后由调用方取走已写出的字节"""
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_schema():
+    types = {"string": pyarrow.string(), "int": pyarrow.int32(), "date": pyarrow.date32(),
+             "timestamp": pyarrow.timestamp('s', tz='UTC')}
+    return pyarrow.schema([(name, types[kind]) for name, kind in EXPORT_COLUMNS])
+
+
+def columnar_chunks(batches, fmt):
+    """Arrow IPC文件或Parquet：每批写成一个记录批/行组后立即输出"""
+    schema = arrow_schema()
+    sink = _ChunkSink()
+    if fmt == "arrow":
+        writer = pyarrow.ipc.new_file(sink, schema)
+    else:
+        compression = None if EXPORT_PARQUET_COMPRESSION == 'none' else EXPORT_PARQUET_COMPRESSION
+        writer = pyarrow.parquet.ParquetWriter(sink, schema, compression=compression)
+    try:
+        for columns in batches:
+            writer.write_batch(pyarrow.record_batch(
+                [pyarrow.array(columns[field.name], type=field.type) for field in schema], schema=schema))
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export_chunks(fmt, vendor=None, store=None):
+    """按格式逐块返回导出内容（字节串）；列式格式需要安装 pyarrow"""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"不支持的导出格式: {fmt}")
+    if fmt in COLUMNAR_FORMATS and pyarrow is None:
+        raise RuntimeError(f"导出 {fmt} 格式需要安装 pyarrow")
+    batches = iter_batches(store or get_warranty_store(), vendor)
+    if fmt == "csv":
+        return csv_chunks(batches)
+    if fmt == "jsonl":
+        return jsonl_chunks(batches)
+    return columnar_chunks(batches, fmt)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="导出已保存的维保记录")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), help="导出格式，默认根据输出文件扩展名推断，否则为jsonl")
+    parser.add_argument("--output", "-o", default="-", help="输出文件，默认输出到标准输出")
+    parser.add_argument("--vendor", choices=list(EXPIRY_FIELDS), help="只导出指定厂商")
+    parser.add_argument("--db", default=WARRANTY_DB_PATH, help="维保结果数据库文件")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    fmt = args.format
+    if fmt is None:
+        ext = os.path.splitext(args.output)[1].lower()
+        fmt = next((name for name, (suffix, _) in EXPORT_FORMATS.items() if suffix == ext), "jsonl")
+    try:
+        chunks = export_chunks(fmt, args.vendor, WarrantyStore(args.db))
+    except (ValueError, RuntimeError) as e:
+        print(str(e), file=sys.stderr)
+        return 2
+    stream = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    try:
+        for chunk in chunks:
+            stream.write(chunk)
+    finally:
+        if stream is not sys.stdout.buffer:
+            stream.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""厂商维保字段映射：将厂商原始字段转换为统一的中文字段"""
+import datetime
+import re
+
+# (中文字段, 深信服原始字段)
+SANGFOR_FIELD_MAP = (
+    ("序列号", "rnum"),
+    ("网关id", "rid"),
+    ("设备型号", "pdName"),
+    ("服务商名称", "cti_channame"),
+    ("服务电话", "cit_chanphone"),
+    ("网络远程支持有效期", "cti_day2_800"),
+    ("同等功能软件升级有效期", "cti_day2_up"),
+    ("硬件维保有效期", "cit_day2_rb"),
+)
+
+# (中文字段, 华为原始字段)
+HUAWEI_FIELD_MAP = (
+    ("序列号", "barcode"),
+    ("设备型号", "snModel"),
+    ("服务套餐", "servicePackage"),
+    ("开始日期", "startDate"),
+    ("结束日期", "endDate"),
+    ("状态", "vyborgStutas"),
+    ("国家/地区", "country"),
+    ("保修区域", "warrantyArea"),
+    ("描述", "itemDescription"),
+)
+
+SANGFOR_FIELDS = tuple(name for name, _ in SANGFOR_FIELD_MAP)
+HUAWEI_FIELDS = tuple(name for name, _ in HUAWEI_FIELD_MAP)
+
+# 各厂商表示到期日的字段
+EXPIRY_FIELDS = {
+    "sangfor": ("硬件维保有效期", "网络远程支持有效期", "同等功能软件升级有效期"),
+    "huawei": ("结束日期",),
+}
+
+# 2024-10-06、2024/10/06、2024.10.06、2024年10月6日，可带时间部分
+_DATE_PATTERN = re.compile(r'^(\d{4})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})\s*日?(?:[\sT].*)?$')
+
+
+def translate_items(items, field_map):
+    """按字段映射把厂商原始记录列表转换为中文字段记录列表"""
+    return [{name: item.get(key, "") for name, key in field_map} for item in items]
+
+
+def normalize_date(value):
+    """将厂商返回的各种日期格式统一为可排序的 YYYY-MM-DD 字符串，无法识别时返回 None"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        # 毫秒或秒级时间戳
+        timestamp = value / 1000 if value > 1e11 else value
+        return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).date().isoformat()
+    value = str(value).strip()
+    if re.fullmatch(r'\d{8}', value):
+        value = f"{value[:4]}-{value[4:6]}-{value[6:]}"
+    match = _DATE_PATTERN.match(value)
+    if not match:
+        return None
+    try:
+        return datetime.date(*(int(part) for part in match.groups())).isoformat()
+    except ValueError:
+        return None
+
+
+# 比较前后两次查询结果时用于对应同一条记录的字段，取值相同的多条记录按出现顺序对应
+ITEM_KEY_FIELDS = {
+    "sangfor": ("序列号",),
+    "huawei": ("服务套餐", "开始日期"),
+}
+
+
+def _item_keys(vendor, items):
+    """为每条记录生成对应用的键"""
+    key_fields = ITEM_KEY_FIELDS.get(vendor, ())
+    seen = {}
+    keys = []
+    for index, item in enumerate(items):
+        base = "|".join(str(item.get(field, "")) for field in key_fields) if key_fields else str(index)
+        seen[base] = seen.get(base, 0) + 1
+        keys.append(base if seen[base] == 1 else f"{base}#{seen[base]}")
+    return keys
+
+
+def _same_value(vendor, field, old, new):
+    """日期字段按统一格式比较，避免格式不同被当作变更"""
+    if old == new:
+        return True
+    if field in EXPIRY_FIELDS.get(vendor, ()):
+        old_date, new_date = normalize_date(old), normalize_date(new)
+        return old_date is not None and old_date == new_date
+    return False
+
+
+def diff_items(vendor, old_items, new_items):
+    """比较同一序列号前后两次的记录列表，返回变更列表；没有变化时返回空列表
+
+    每项变更为 {"op": "added"/"removed", "item": 键, "record": 记录} 或
+    {"op": "changed", "item": 键, "field": 字段, "old": 原值, "new": 新值}
+    """
+    old_by_key = dict(zip(_item_keys(vendor, old_items), old_items))
+    new_by_key = dict(zip(_item_keys(vendor, new_items), new_items))
+    changes = []
+    for key, item in new_by_key.items():
+        old = old_by_key.get(key)
+        if old is None:
+            changes.append({"op": "added", "item": key, "record": item})
+            continue
+        for field in list(old) + [field for field in item if field not in old]:
+            if not _same_value(vendor, field, old.get(field), item.get(field)):
+                changes.append({"op": "changed", "item": key, "field": field,
+                                "old": old.get(field), "new": item.get(field)})
+    for key, item in old_by_key.items():
+        if key not in new_by_key:
+            changes.append({"op": "removed", "item": key, "record": item})
+    return changes
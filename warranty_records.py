@@ -0,0 +1,117 @@
+"""紧凑的维保记录表示
+
+缓存和存储层按厂商字段顺序只保存取值（[值, ...]），不再在每条记录中重复 "网络远程支持有效期" 这类中文字段名；
+读出后用带 __slots__ 的记录对象保存，型号、套餐、日期等在设备之间大量重复的取值驻留后共享同一个字符串对象。
+记录对象可按只读映射使用（item["设备型号"]、item.get(...)），序列化响应时才转换为原来的 {中文字段: 值} 格式。
+"""
+import sys
+from collections.abc import Mapping
+
+from warranty_fields import SANGFOR_FIELD_MAP, HUAWEI_FIELD_MAP
+
+# 每台设备取值都不同的字段，驻留没有收益
+UNIQUE_FIELDS = frozenset(("序列号", "网关id"))
+
+
+class WarrantyRecord(Mapping):
+    """一条维保记录；子类以厂商原始字段名为 __slots__，FIELDS 为对应的中文字段名"""
+    __slots__ = ()
+    FIELDS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.SLOT_OF = dict(zip(cls.FIELDS, cls.__slots__))
+        cls.INTERNED = tuple(field not in UNIQUE_FIELDS for field in cls.FIELDS)
+
+    def __init__(self, row):
+        for slot, interned, value in zip(self.__slots__, self.INTERNED, row):
+            setattr(self, slot, sys.intern(value) if interned and type(value) is str else value)
+
+    @classmethod
+    def load(cls, item):
+        """把存储格式的一条记录转换为记录对象；字段与厂商字段不一致的记录原样返回"""
+        if isinstance(item, list):
+            return cls(item) if len(item) == len(cls.FIELDS) else item
+        if isinstance(item, dict) and len(item) == len(cls.FIELDS) and all(field in item for field in cls.FIELDS):
+            return cls([item[field] for field in cls.FIELDS])
+        return item
+
+    @classmethod
+    def pack(cls, item):
+        """把一条记录转换为存储格式：按字段顺序的取值数组；字段与厂商字段不一致的记录原样返回"""
+        if isinstance(item, cls):
+            return item.row()
+        if isinstance(item, Mapping) and len(item) == len(cls.FIELDS) and all(field in item for field in cls.FIELDS):
+            return [item[field] for field in cls.FIELDS]
+        return item
+
+    def __getitem__(self, field):
+        slot = self.SLOT_OF.get(field)
+        if slot is None:
+            raise KeyError(field)
+        return getattr(self, slot)
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def row(self):
+        """按字段顺序的取值列表"""
+        return [getattr(self, slot) for slot in self.__slots__]
+
+    def to_dict(self):
+        """转换为响应格式 {中文字段: 值}"""
+        return {field: getattr(self, slot) for field, slot in zip(self.FIELDS, self.__slots__)}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class SangforRecord(WarrantyRecord):
+    """深信服维保记录"""
+    __slots__ = tuple(key for _, key in SANGFOR_FIELD_MAP)
+    FIELDS = tuple(name for name, _ in SANGFOR_FIELD_MAP)
+
+
+class HuaweiRecord(WarrantyRecord):
+    """华为维保记录"""
+    __slots__ = tuple(key for _, key in HUAWEI_FIELD_MAP)
+    FIELDS = tuple(name for name, _ in HUAWEI_FIELD_MAP)
+
+
+RECORD_TYPES = {
+    "sangfor": SangforRecord,
+    "huawei": HuaweiRecord,
+}
+
+
+def pack_items(vendor, items):
+    """把记录列表转换为存储格式，没有紧凑格式的厂商原样返回"""
+    record_type = RECORD_TYPES.get(vendor)
+    if record_type is None:
+        return items
+    return [record_type.pack(item) for item in items]
+
+
+def load_items(vendor, items):
+    """把存储格式的记录列表（包括旧版本保存的 {中文字段: 值} 记录）读取为记录对象"""
+    record_type = RECORD_TYPES.get(vendor)
+    if record_type is None:
+        return items
+    return [record_type.load(item) for item in items]
+
+
+def pack_payload(vendor, payload):
+    """把响应数据中的记录转换为存储格式，用于写入缓存"""
+    if not isinstance(payload.get("data"), list):
+        return payload
+    return dict(payload, data=pack_items(vendor, payload["data"]))
+
+
+def load_payload(vendor, payload):
+    """把缓存中读出的响应数据的记录转换为记录对象"""
+    if payload is None or not isinstance(payload.get("data"), list):
+        return payload
+    return dict(payload, data=load_items(vendor, payload["data"]))
@@ -0,0 +1,307 @@
+"""维保结果存储：将查询成功的维保记录保存到SQLite并为到期日建立索引，记录每次结果的实际变更，同时保存需要定期刷新的设备清单"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from response_encoding import dumps, loads
+from warranty_fields import EXPIRY_FIELDS, diff_items, normalize_date
+from warranty_records import pack_items, load_items
+
+logger = logging.getLogger('ServiceQueryAPI.Store')
+
+# 维保结果数据库文件路径
+WARRANTY_DB_PATH = os.getenv('WARRANTY_DB_PATH', 'warranty.db')
+# 到期查询单次最多返回的条数
+EXPIRING_MAX_LIMIT = int(os.getenv('EXPIRING_MAX_LIMIT', '10000'))
+# 单个查询接口直接返回本地记录的最长时间（秒），0表示总是查询厂商网站
+WARRANTY_FRESH_SECONDS = float(os.getenv('WARRANTY_FRESH_SECONDS', '86400'))
+# 变更记录保留天数（0表示一直保留）与单次最多返回的条数
+WARRANTY_CHANGES_RETENTION_DAYS = float(os.getenv('WARRANTY_CHANGES_RETENTION_DAYS', '180'))
+WARRANTY_CHANGES_MAX_LIMIT = int(os.getenv('WARRANTY_CHANGES_MAX_LIMIT', '1000'))
+# 清理过期变更记录的间隔（秒）
+CHANGES_PRUNE_INTERVAL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS warranty (
+    vendor TEXT NOT NULL,
+    serial TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (vendor, serial)
+);
+CREATE TABLE IF NOT EXISTS warranty_expiry (
+    vendor TEXT NOT NULL,
+    serial TEXT NOT NULL,
+    item INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    expires TEXT NOT NULL,
+    PRIMARY KEY (vendor, serial, item, field)
+);
+CREATE INDEX IF NOT EXISTS idx_warranty_expiry_expires ON warranty_expiry (expires);
+CREATE INDEX IF NOT EXISTS idx_warranty_expiry_vendor_expires ON warranty_expiry (vendor, expires);
+CREATE TABLE IF NOT EXISTS warranty_changes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    vendor TEXT NOT NULL,
+    serial TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    changes TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_warranty_changes_serial ON warranty_changes (vendor, serial, id);
+CREATE TABLE IF NOT EXISTS inventory (
+    vendor TEXT NOT NULL,
+    serial TEXT NOT NULL,
+    registered_at REAL NOT NULL,
+    PRIMARY KEY (vendor, serial)
+);
+"""
+
+
+class WarrantyStore:
+    """维保记录存储，按 (厂商, 序列号) 保存最新一次查询结果"""
+    def __init__(self, path=WARRANTY_DB_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        # 有新的变更记录时通知等待中的订阅者
+        self.changed = threading.Condition()
+        self.pruned_at = 0.0
+
+    def save(self, vendor, serial, items):
+        """保存一个序列号的维保记录列表，并重建其到期日索引；与上次保存的记录相比有变化时写入变更记录并返回，否则返回 None"""
+        expiry_rows = []
+        for index, item in enumerate(items):
+            for field in EXPIRY_FIELDS.get(vendor, ()):
+                expires = normalize_date(item.get(field))
+                if expires:
+                    expiry_rows.append((vendor, serial, index, field, expires))
+        # 按字段顺序只保存取值，不在每条记录中重复字段名
+        data = dumps(pack_items(vendor, items)).decode('utf-8')
+        now = time.time()
+        change = None
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                row = self.conn.execute(
+                    "SELECT data FROM warranty WHERE vendor = ? AND serial = ?", (vendor, serial)).fetchone()
+                if row is None or row[0] != data:
+                    changes = diff_items(vendor, load_items(vendor, loads(row[0])) if row is not None else [], items)
+                    if changes:
+                        change = {"vendor": vendor, "sn": serial, "kind": "created" if row is None else "updated",
+                                  "changes": changes, "created_at": now}
+                        cursor = self.conn.execute(
+                            "INSERT INTO warranty_changes (vendor, serial, kind, changes, created_at) VALUES (?, ?, ?, ?, ?)",
+                            (vendor, serial, change["kind"], dumps(changes).decode('utf-8'), now))
+                        change["id"] = cursor.lastrowid
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO warranty (vendor, serial, data, updated_at) VALUES (?, ?, ?, ?)",
+                    (vendor, serial, data, now))
+                self.conn.execute("DELETE FROM warranty_expiry WHERE vendor = ? AND serial = ?", (vendor, serial))
+                self.conn.executemany(
+                    "INSERT INTO warranty_expiry (vendor, serial, item, field, expires) VALUES (?, ?, ?, ?, ?)",
+                    expiry_rows)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        if change is not None:
+            with self.changed:
+                self.changed.notify_all()
+            self._prune_changes(now)
+        return change
+
+    def _prune_changes(self, now):
+        """按保留天数清理变更记录，每隔 CHANGES_PRUNE_INTERVAL 秒最多执行一次"""
+        if WARRANTY_CHANGES_RETENTION_DAYS <= 0 or now - self.pruned_at < CHANGES_PRUNE_INTERVAL:
+            return
+        self.pruned_at = now
+        with self.lock:
+            self.conn.execute("DELETE FROM warranty_changes WHERE created_at < ?",
+                              (now - WARRANTY_CHANGES_RETENTION_DAYS * 86400,))
+
+    def changes(self, cursor=0, vendor=None, serial=None, limit=100):
+        """返回编号大于 cursor 的变更记录，按编号升序；编号可作为下次查询的 cursor"""
+        conditions = ["id > ?"]
+        params = [cursor]
+        if vendor:
+            conditions.append("vendor = ?")
+            params.append(vendor)
+        if serial:
+            conditions.append("serial = ?")
+            params.append(serial)
+        params.append(min(limit, WARRANTY_CHANGES_MAX_LIMIT))
+        sql = (
+            "SELECT id, vendor, serial, kind, changes, created_at FROM warranty_changes "
+            f"WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?"
+        )
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [{"id": change_id, "vendor": vendor_name, "sn": serial_number, "kind": kind,
+                 "changes": loads(changes), "created_at": created_at}
+                for change_id, vendor_name, serial_number, kind, changes, created_at in rows]
+
+    def latest_change_id(self):
+        """最新一条变更记录的编号，没有记录时为0"""
+        with self.lock:
+            return self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM warranty_changes").fetchone()[0]
+
+    def wait_for_changes(self, timeout):
+        """等待本进程写入新的变更记录，最多等待 timeout 秒；其他进程写入的记录需要调用方定期重新查询"""
+        with self.changed:
+            self.changed.wait(timeout)
+
+    def get(self, vendor, serial):
+        """读取一个序列号已保存的维保记录，不存在时返回 None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data, updated_at FROM warranty WHERE vendor = ? AND serial = ?", (vendor, serial)).fetchone()
+        if row is None:
+            return None
+        return {"data": load_items(vendor, loads(row[0])), "updated_at": row[1]}
+
+    def fresh(self, vendor, serial, max_age=WARRANTY_FRESH_SECONDS):
+        """返回未超过 max_age 秒的已保存记录（响应数据格式），否则返回 None"""
+        if max_age <= 0:
+            return None
+        record = self.get(vendor, serial)
+        if record is None or time.time() - record["updated_at"] > max_age:
+            return None
+        return {"success": 1, "data": record["data"]}
+
+    def register(self, devices):
+        """登记设备清单，devices 为 (厂商, 序列号) 列表，返回新增个数"""
+        now = time.time()
+        with self.lock:
+            before = self.conn.total_changes
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO inventory (vendor, serial, registered_at) VALUES (?, ?, ?)",
+                [(vendor, serial, now) for vendor, serial in devices])
+            self.conn.execute("COMMIT")
+            return self.conn.total_changes - before
+
+    def unregister(self, devices):
+        """从设备清单中移除设备，返回移除个数"""
+        with self.lock:
+            before = self.conn.total_changes
+            self.conn.execute("BEGIN")
+            self.conn.executemany("DELETE FROM inventory WHERE vendor = ? AND serial = ?", list(devices))
+            self.conn.execute("COMMIT")
+            return self.conn.total_changes - before
+
+    def inventory(self, vendor=None):
+        """返回设备清单及其最后查询时间和全部到期日：[(厂商, 序列号, 最后查询时间, [到期日...]), ...]"""
+        sql = (
+            "SELECT i.vendor, i.serial, w.updated_at, GROUP_CONCAT(e.expires) "
+            "FROM inventory i "
+            "LEFT JOIN warranty w ON w.vendor = i.vendor AND w.serial = i.serial "
+            "LEFT JOIN warranty_expiry e ON e.vendor = i.vendor AND e.serial = i.serial "
+        )
+        params = []
+        if vendor:
+            sql += "WHERE i.vendor = ? "
+            params.append(vendor)
+        sql += "GROUP BY i.vendor, i.serial ORDER BY i.vendor, i.serial"
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [(row[0], row[1], row[2], row[3].split(',') if row[3] else []) for row in rows]
+
+    def expiry_dates(self, vendor, serial):
+        """返回一个序列号已保存的全部到期日"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT expires FROM warranty_expiry WHERE vendor = ? AND serial = ?", (vendor, serial)).fetchall()
+        return [row[0] for row in rows]
+
+    def expiring(self, before, after=None, vendor=None, field=None, limit=1000):
+        """查询到期日在 [after, before) 区间内的记录，按到期日升序返回"""
+        conditions = ["e.expires < ?"]
+        params = [before]
+        if after:
+            conditions.append("e.expires >= ?")
+            params.append(after)
+        if vendor:
+            conditions.append("e.vendor = ?")
+            params.append(vendor)
+        if field:
+            conditions.append("e.field = ?")
+            params.append(field)
+        params.append(min(limit, EXPIRING_MAX_LIMIT))
+        sql = (
+            "SELECT e.vendor, e.serial, e.item, e.field, e.expires, w.data, w.updated_at "
+            "FROM warranty_expiry e JOIN warranty w ON w.vendor = e.vendor AND w.serial = e.serial "
+            f"WHERE {' AND '.join(conditions)} ORDER BY e.expires, e.vendor, e.serial LIMIT ?"
+        )
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        results = []
+        decoded = {}
+        for vendor_name, serial, item, field_name, expires, data, updated_at in rows:
+            # 同一序列号的多条到期记录只解析一次
+            items = decoded.get((vendor_name, serial))
+            if items is None:
+                items = decoded[(vendor_name, serial)] = load_items(vendor_name, loads(data))
+            results.append({
+                "vendor": vendor_name,
+                "sn": serial,
+                "field": field_name,
+                "expires": expires,
+                "record": items[item] if item < len(items) else {},
+                "updated_at": updated_at,
+            })
+        return results
+
+    def iter_records(self, vendor=None, batch_size=1000):
+        """按 (厂商, 序列号) 顺序分批读取全部已保存记录，逐条返回 (厂商, 序列号, 记录列表, 更新时间)；每批读完即释放锁"""
+        last = ("", "")
+        while True:
+            conditions = ["(vendor, serial) > (?, ?)"]
+            params = list(last)
+            if vendor:
+                conditions.append("vendor = ?")
+                params.append(vendor)
+            params.append(batch_size)
+            sql = (
+                "SELECT vendor, serial, data, updated_at FROM warranty "
+                f"WHERE {' AND '.join(conditions)} ORDER BY vendor, serial LIMIT ?"
+            )
+            with self.lock:
+                rows = self.conn.execute(sql, params).fetchall()
+            for vendor_name, serial, data, updated_at in rows:
+                yield vendor_name, serial, load_items(vendor_name, loads(data)), updated_at
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][:2]
+
+    def count(self):
+        """返回已保存的序列号个数"""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM warranty").fetchone()[0]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_warranty_store():
+    """获取进程内共享的维保记录存储"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = WarrantyStore()
+        return _store
+
+
+def store_result(vendor, serial, payload):
+    """保存查询成功的响应数据，存储失败只记录日志，不影响查询结果"""
+    if payload.get("success") != 1 or not isinstance(payload.get("data"), list):
+        return
+    try:
+        get_warranty_store().save(vendor, serial, payload["data"])
+    except Exception as e:
+        logger.error(f"保存维保记录失败 {vendor}/{serial}: {str(e)}")